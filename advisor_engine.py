@@ -0,0 +1,171 @@
+import bisect
+from collections import defaultdict
+
+import numpy as np
+
+# Time windows supported by the Upgrade Advisor
+ADVISOR_TIME_MODIFIERS = {'7d': '-7 days', '30d': '-30 days'}
+
+# Usage statistics the advisor can size against (P95 of the hourly peaks, so one busy hour in twenty is ignored)
+ADVISOR_STATISTICS = {'peak': 'Peak', 'p95': 'P95 Hourly Peak'}
+
+
+def _generation_number(generation):
+    """Returns the numeric part of a generation label (e.g. '4' -> 4), or None if it has none."""
+    digits = ''.join(filter(str.isdigit, str(generation)))
+    return int(digits) if digits else None
+
+
+class ModelSpecIndex:
+    """
+    Model specifications pre-indexed for upgrade lookups.
+
+    Each generation's models are kept sorted by throughput capacity so the next model up in the
+    same generation is a positional lookup and next-generation candidates are found with bisect.
+    Recommendations only depend on the model, so they are memoized per model.
+    """
+    def __init__(self, specs):
+        self.specs = {s['model']: s for s in specs}
+        self._by_generation = defaultdict(list)
+        for spec in self.specs.values():
+            self._by_generation[str(spec.get('generation'))].append(spec)
+        self._position = {}
+        self._throughputs = {}
+        for generation, models in self._by_generation.items():
+            models.sort(key=lambda s: s['max_throughput_mbps'] or 0)
+            self._throughputs[generation] = [s['max_throughput_mbps'] or 0 for s in models]
+            for i, spec in enumerate(models):
+                self._position[spec['model']] = i
+        self._next_gen_cache = {}
+        self._recommendation_cache = {}
+
+    def _next_generation_models(self, next_gen_str):
+        """All models whose generation label starts with next_gen_str, sorted by throughput."""
+        if next_gen_str not in self._next_gen_cache:
+            models = sorted(
+                (s for gen, specs in self._by_generation.items() if gen.startswith(next_gen_str) for s in specs),
+                key=lambda s: s['max_throughput_mbps'] or 0
+            )
+            self._next_gen_cache[next_gen_str] = (models, [s['max_throughput_mbps'] or 0 for s in models])
+        return self._next_gen_cache[next_gen_str]
+
+    def recommend(self, model):
+        """Returns the upgrade recommendation strings for an over-threshold firewall of this model."""
+        if model in self._recommendation_cache:
+            return self._recommendation_cache[model]
+
+        spec = self.specs[model]
+        generation = str(spec.get('generation'))
+        recommendations = []
+
+        # --- Same-gen upgrade logic ---
+        same_gen_models = self._by_generation[generation]
+        current_index = self._position[model]
+        if current_index < len(same_gen_models) - 1:
+            recommendations.append(f"Same Gen: {same_gen_models[current_index + 1]['model']}")
+        else:
+            recommendations.append("Highest in Series")
+
+        # --- Next-gen upgrade logic ---
+        current_gen_num = _generation_number(generation)
+        if current_gen_num is not None:
+            candidates, throughputs = self._next_generation_models(str(current_gen_num + 1))
+            max_throughput = spec['max_throughput_mbps'] or 0
+            max_sessions = spec['max_sessions'] or 0
+            # Skip every candidate with less throughput, then take the first one with enough sessions
+            for candidate in candidates[bisect.bisect_left(throughputs, max_throughput):]:
+                if (candidate['max_sessions'] or 0) >= max_sessions:
+                    recommendations.append(f"Next Gen: {candidate['model']}")
+                    break
+
+        self._recommendation_cache[model] = recommendations
+        return recommendations
+
+
+def _nearest_rank(values, percentile):
+    """Nearest-rank percentile of a NumPy array (partial sort only)."""
+    rank = int(np.ceil(len(values) * (percentile / 100.0))) - 1
+    return np.partition(values, rank)[rank]
+
+
+def fleet_usage(conn, time_modifier, statistic='peak'):
+    """
+    Returns {firewall_id: (sessions, throughput_bps)} for the whole fleet in a single query.
+    Throughput is the greater of input and output, matching the per-firewall analysis.
+
+    P95 is taken over the hourly peaks in stats_hourly rather than every raw sample, so its cost is
+    bounded by hours x firewalls (720 values per firewall over 30 days) instead of the poll rate.
+    """
+    cursor = conn.cursor()
+    cursor.row_factory = None  # Plain tuples convert straight into NumPy arrays
+    if statistic == 'p95':
+        # One row per firewall; SQLite concatenates the hourly peaks in C, NumPy parses them
+        rows = cursor.execute(
+            "SELECT firewall_id, group_concat(max_sessions), group_concat(max_throughput_bps) "
+            "FROM stats_hourly WHERE hour >= datetime('now', 'localtime', ?) GROUP BY firewall_id", (time_modifier,)
+        ).fetchall()
+        return {fw_id: (_nearest_rank(np.fromstring(sessions, sep=','), 95).item(), _nearest_rank(np.fromstring(throughput, sep=','), 95).item())
+                for fw_id, sessions, throughput in rows}
+    rows = cursor.execute(
+        "SELECT firewall_id, MAX(active_sessions), MAX(total_input_bps), MAX(total_output_bps) "
+        "FROM stats WHERE timestamp >= datetime('now', 'localtime', ?) GROUP BY firewall_id", (time_modifier,)
+    ).fetchall()
+    if not rows:
+        return {}
+    data = np.array(rows, dtype=np.float64)
+    data = np.nan_to_num(data)  # MAX() over all-NULL columns comes back as None -> nan
+    ids = data[:, 0].astype(np.int64)
+    sessions = data[:, 1]
+    throughput = np.maximum(data[:, 2], data[:, 3])
+    return dict(zip(ids.tolist(), zip(sessions.tolist(), throughput.tolist())))
+
+
+def analyze_fleet(conn, timespan, alert_threshold, statistic='peak'):
+    """Runs the Upgrade Advisor for every firewall and returns one result dict per firewall."""
+    time_modifier = ADVISOR_TIME_MODIFIERS.get(timespan, '-7 days')
+    spec_index = ModelSpecIndex([dict(m) for m in conn.execute("SELECT * FROM firewall_models").fetchall()])
+    firewalls = conn.execute('SELECT id, ip_address, hostname, model FROM firewalls ORDER BY id').fetchall()
+    usage = fleet_usage(conn, time_modifier, statistic)
+
+    count = len(firewalls)
+    peak_sessions = np.zeros(count)
+    peak_throughput_mbps = np.zeros(count)
+    max_sessions = np.zeros(count)
+    max_throughput = np.zeros(count)
+    known_model = np.zeros(count, dtype=bool)
+    for i, fw in enumerate(firewalls):
+        sessions, throughput_bps = usage.get(fw['id'], (0.0, 0.0))
+        peak_sessions[i] = sessions
+        peak_throughput_mbps[i] = throughput_bps / 1000000
+        spec = spec_index.specs.get(fw['model']) if fw['model'] else None
+        if spec:
+            known_model[i] = True
+            max_sessions[i] = spec['max_sessions'] or 0
+            max_throughput[i] = spec['max_throughput_mbps'] or 0
+
+    # Utilization for the whole fleet at once; models with a zero capacity report 0%
+    session_util = np.divide(peak_sessions * 100, max_sessions, out=np.zeros(count), where=max_sessions > 0)
+    throughput_util = np.divide(peak_throughput_mbps * 100, max_throughput, out=np.zeros(count), where=max_throughput > 0)
+    needs_upgrade = known_model & ((session_util >= alert_threshold) | (throughput_util >= alert_threshold))
+
+    results = []
+    for i, fw in enumerate(firewalls):
+        res = {
+            'ip_address': fw['ip_address'], 'model': fw['model'], 'hostname': fw['hostname'],
+            'peak_sessions': peak_sessions[i].item(), 'peak_throughput': peak_throughput_mbps[i].item(),
+        }
+        if known_model[i]:
+            spec = spec_index.specs[fw['model']]
+            recommendations = spec_index.recommend(fw['model']) if needs_upgrade[i] else []
+            res.update({
+                'generation': spec.get('generation', 'N/A'),
+                'max_sessions': spec['max_sessions'],
+                'max_throughput': spec['max_throughput_mbps'],
+                'session_util': session_util[i].item(),
+                'throughput_util': throughput_util[i].item(),
+                'recommendation': " | ".join(recommendations) if recommendations else 'Sized Appropriately',
+            })
+        else:
+            res.update({'generation': 'N/A', 'max_sessions': 'N/A', 'max_throughput': 'N/A', 'session_util': 0, 'throughput_util': 0, 'recommendation': 'Unknown Model'})
+        results.append(res)
+    return results
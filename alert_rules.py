@@ -0,0 +1,79 @@
+class ThresholdRule:
+    """
+    A threshold on one time-series metric.
+
+    The rule fires once the metric has stayed at or above `threshold` for `duration` seconds, and
+    re-arms only after the metric drops below `clear_threshold` (hysteresis), so a value hovering
+    around the threshold does not raise an alert every poll cycle.
+    """
+    __slots__ = ('name', 'metric', 'threshold', 'duration', 'clear_threshold')
+
+    def __init__(self, name, metric, threshold, duration=0, clear_threshold=None):
+        self.name = name
+        self.metric = metric
+        self.threshold = threshold
+        self.duration = duration
+        self.clear_threshold = threshold if clear_threshold is None else clear_threshold
+
+
+# Default rules applied to every sample ingested by the poller. All metrics are percentages.
+DEFAULT_RULES = [
+    ThresholdRule('Management CPU', 'cpu_load', 90, duration=300, clear_threshold=80),
+    ThresholdRule('Dataplane Load', 'dataplane_load', 85, duration=300, clear_threshold=75),
+    ThresholdRule('Memory Utilization', 'memory_utilization', 90, duration=300, clear_threshold=85),
+    ThresholdRule('Session Table', 'session_utilization', 80, duration=300, clear_threshold=70),
+]
+
+
+class _RuleState:
+    __slots__ = ('breach_start', 'active')
+
+    def __init__(self):
+        self.breach_start = None
+        self.active = False
+
+
+class StreamingAlertEngine:
+    """
+    Evaluates threshold rules against each sample as it is ingested.
+
+    Only the start time of the current breach and whether the rule is firing are kept per
+    (device, rule), so evaluation never needs to query historical stats.
+    """
+    def __init__(self, rules=None):
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        self._state = {}
+
+    def evaluate(self, device_id, timestamp, sample):
+        """
+        Feeds one sample (a dict of metric -> value) taken at `timestamp` (epoch seconds).
+        Returns a list of (rule, value) for every rule that started firing on this sample.
+        """
+        fired = []
+        for rule in self.rules:
+            value = sample.get(rule.metric)
+            if value is None:
+                continue
+            key = (device_id, rule.name)
+            state = self._state.get(key)
+            if state is None:
+                state = self._state[key] = _RuleState()
+
+            if state.active:
+                if value < rule.clear_threshold:
+                    state.active = False
+                    state.breach_start = None
+            elif value >= rule.threshold:
+                if state.breach_start is None:
+                    state.breach_start = timestamp
+                if timestamp - state.breach_start >= rule.duration:
+                    state.active = True
+                    fired.append((rule, value))
+            else:
+                state.breach_start = None
+        return fired
+
+    def forget(self, device_id):
+        """Drops all state for a device (e.g. after it is removed from monitoring)."""
+        for key in [k for k in self._state if k[0] == device_id]:
+            del self._state[key]
@@ -3,16 +3,30 @@ from flask import Response, send_file
 import sqlite3
 import os
 import time
-import requests, shutil, re
-from datetime import datetime
+import requests, shutil
+from datetime import datetime, timedelta
 import xml.etree.ElementTree as ET
 from urllib3.exceptions import InsecureRequestWarning
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import threading
 from cryptography.fernet import Fernet
 import uuid
-import report_generator
+import alert_rules
+import poll_scheduler
+import panorama_proxy
+import interface_stats
+import panos_parsers
+import device_collection
+import poll_loop
+import prometheus_metrics
+import request_profiler
+import collector_lease
+import remote_ingest
 import logging
+import json
+import functools
+import queue
 
 # --- Configuration ---
 DB_FILE = "monitoring.db"
@@ -21,45 +35,6 @@ KEY_FILE = "secret.key"
 # Suppress insecure request warnings
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
-# --- NEW: Import FPDF for the custom PDF class ---
-from fpdf import FPDF
-
-# --- NEW: Custom PDF class for branded header and footer ---
-class PDF(FPDF):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.PANW_RED = (255, 69, 0)
-        self.PANW_GRAY = (70, 70, 70)
-        # Correctly join path relative to the app's location
-        self.LOGO_PATH = os.path.join(os.path.dirname(__file__), 'static', 'panw-logo.png')
-        self._draw_header_footer = True
-
-    def set_draw_header_footer(self, draw):
-        self._draw_header_footer = draw
-
-    def header(self):
-        if not self._draw_header_footer: return
-        if os.path.exists(self.LOGO_PATH):
-            self.image(self.LOGO_PATH, 10, 8, 33)
-        self.set_font('Helvetica', 'B', 20)
-        self.set_text_color(*self.PANW_RED)
-        self.cell(0, 10, 'PAN-OS Performance & Capacity Report', 0, 1, 'C')
-        self.ln(5)
-        # Draw a line under the header
-        self.set_draw_color(*self.PANW_RED)
-        self.line(10, 30, self.w - 10, 30)
-        self.ln(10)
-
-    def footer(self):
-        if not self._draw_header_footer: return
-        self.set_y(-15)
-        self.set_font('Helvetica', 'I', 8)
-        # Add a watermark logo
-        if os.path.exists(self.LOGO_PATH):
-            self.image(self.LOGO_PATH, x=self.w - 40, y=self.h - 12, w=8, link='', type='PNG')
-        self.set_text_color(128)
-        self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
-
 # --- Encryption Functions ---
 def generate_key():
     key = Fernet.generate_key()
@@ -86,6 +61,237 @@ background_task_running = threading.Event()
 background_task_message = ""
 message_lock = threading.Lock()
 manual_poll_event = threading.Event()
+# Wakes the poller when a manual poll is requested or a device poll finishes
+poller_wakeup = threading.Event()
+
+# ** NEW: Opt-in request and SQL profiling (enabled from /internal/profiling) **
+profiler = request_profiler.RequestProfiler()
+# Not profiled: the long-lived live-update stream, static files and the profiling page itself
+PROFILER_EXCLUDED_ENDPOINTS = {'stream', 'static', 'profiling'}
+
+@app.before_request
+def _begin_request_profile():
+    if profiler.enabled and flask.request.endpoint not in PROFILER_EXCLUDED_ENDPOINTS:
+        profiler.begin(flask.request.method, flask.request.full_path.rstrip('?'), flask.request.endpoint)
+
+@app.after_request
+def _end_request_profile(response):
+    profiler.end(response.status_code)
+    return response
+
+@app.teardown_request
+def _abandon_request_profile(exc):
+    # Requests that raised never reach after_request
+    profiler.end(500)
+
+def _template_render_started(sender, **extra):
+    profiler.template_started()
+
+def _template_render_finished(sender, **extra):
+    profiler.template_finished()
+
+flask.before_render_template.connect(_template_render_started, app)
+flask.template_rendered.connect(_template_render_finished, app)
+
+# --- Live update event stream (Server-Sent Events) ---
+class EventBroker:
+    """Fans out live dashboard events to every connected SSE client."""
+    CLOSE = None  # Queued to a dropped subscriber: its stream ends
+
+    def __init__(self, max_queued_events=100):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._max_queued_events = max_queued_events
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=self._max_queued_events)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def publish(self, event, data):
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # A stalled client should not block the poller; drop it and close its stream so the browser reconnects.
+                self.unsubscribe(q)
+                self._close(q)
+
+    @staticmethod
+    def _close(q):
+        """Replaces a dropped subscriber's backlog with the CLOSE sentinel, which ends its stream."""
+        while True:
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                q.put_nowait(EventBroker.CLOSE)
+                return
+            except queue.Full:
+                continue  # A publish that started before the unsubscribe refilled it
+
+event_broker = EventBroker()
+_last_published_rows = {}
+
+# Set when background_worker_loop runs in this process (python app.py, or collector.py). Under a
+# multi-worker WSGI server the web workers have no poller and learn about its writes from the database.
+poller_in_process = False
+# ** NEW: This process's collector leases, so that only one collector (or one per shard) polls each firewall **
+collector_leases = collector_lease.CollectorLease()
+# How often a web worker without the poller checks the database for new data for its live clients
+LIVE_UPDATE_CHECK_SECONDS = 2
+_live_update_thread = None
+_live_update_lock = threading.Lock()
+
+class DatabaseChangeWatch:
+    """
+    Detects bump_data_version() calls made by other processes (the collector, other web workers)
+    through the shared counter in the data_version table, read on a connection of its own.
+    """
+    def __init__(self):
+        self._conn = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def changed(self):
+        """True if another connection committed since the previous call (False on the first)."""
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+            row = self._conn.execute('SELECT version FROM data_version').fetchone()
+            version = row[0] if row else None
+            changed = self._version is not None and version != self._version
+            self._version = version
+            return changed
+
+def _watch_for_live_updates():
+    """Publishes dashboard changes committed by the collector process to this worker's SSE clients."""
+    watch = DatabaseChangeWatch()
+    watch.changed()
+    while True:
+        time.sleep(LIVE_UPDATE_CHECK_SECONDS)
+        if watch.changed() and event_broker.has_subscribers():
+            conn = get_db_connection()
+            _publish_dashboard_changes(conn)
+            conn.close()
+
+def _ensure_live_updates():
+    """Starts the live update watcher (on the first SSE client) when the poller runs in another process."""
+    global _live_update_thread
+    with _live_update_lock:
+        if poller_in_process or (_live_update_thread is not None and _live_update_thread.is_alive()):
+            return
+        _live_update_thread = threading.Thread(target=_watch_for_live_updates, daemon=True)
+        _live_update_thread.start()
+
+def _set_background_task(message):
+    """Marks a background task as running and notifies live clients."""
+    global background_task_message
+    with message_lock:
+        background_task_message = message
+    background_task_running.set()
+    event_broker.publish('task', {'running': True, 'message': message})
+
+def _clear_background_task():
+    """Marks the current background task as finished and notifies live clients."""
+    global background_task_message
+    with message_lock:
+        background_task_message = ""
+    background_task_running.clear()
+    event_broker.publish('task', {'running': False, 'message': ''})
+
+def _publish_dashboard_changes(conn):
+    """Publishes only the dashboard rows that changed since the last poll cycle."""
+    if not event_broker.has_subscribers():
+        # Nobody is watching: skip the fleet-wide query; the next subscriber's first update carries every row
+        _last_published_rows.clear()
+        return
+    rows = {row['firewall_id']: row for row in _fetch_dashboard_rows(conn)}
+    changed = [row for fw_id, row in rows.items() if _last_published_rows.get(fw_id) != row]
+    removed = [fw_id for fw_id in _last_published_rows if fw_id not in rows]
+    _last_published_rows.clear()
+    _last_published_rows.update(rows)
+    if changed or removed:
+        event_broker.publish('stats', {'changed': changed, 'removed': removed})
+
+# --- Data-versioned response cache ---
+# Dashboard pages only change when a poll cycle, capacity refresh or alert/config write commits.
+# Every such writer calls bump_data_version(), and cached renders from older versions are discarded.
+data_version = 0
+data_version_lock = threading.Lock()
+_response_cache = {}
+RESPONSE_CACHE_MAX_ENTRIES = 256
+# Data changes recorded by the collector process or other web workers also invalidate this process's cache
+_page_cache_watch = DatabaseChangeWatch()
+
+def _invalidate_page_cache():
+    global data_version
+    with data_version_lock:
+        data_version += 1
+        _response_cache.clear()
+
+def bump_data_version():
+    """Invalidates all cached dashboard responses after a committed data change, in this process and (through the database) in the others."""
+    _invalidate_page_cache()
+    try:
+        conn = sqlite3.connect(DB_FILE, timeout=30)
+        try:
+            conn.execute('UPDATE data_version SET version = version + 1')
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"Could not record the data change for other processes: {e}")
+
+def cached_page(view):
+    """Caches a view's rendered HTML until the next data version bump."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # Flashed messages are one-shot and must never be served from (or stored in) the cache
+        if '_flashes' in flask.session:
+            return view(*args, **kwargs)
+        if _page_cache_watch.changed():
+            _invalidate_page_cache()
+
+        with message_lock:
+            task_state = (background_task_running.is_set(), background_task_message)
+        cache_key = (
+            flask.request.endpoint, flask.request.method,
+            tuple(sorted(kwargs.items())),
+            tuple(sorted(flask.request.args.items(multi=True))),
+            tuple(sorted(flask.request.form.items(multi=True))),
+            task_state,
+        )
+        with data_version_lock:
+            version = data_version
+            cached = _response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        body = view(*args, **kwargs)
+        if isinstance(body, str):
+            with data_version_lock:
+                # Only store the render if no writer committed while it was being built
+                if version == data_version:
+                    if len(_response_cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+                        _response_cache.clear()
+                    _response_cache[cache_key] = body
+        return body
+    return wrapper
 
 # --- NEW: Context processor to inject background task status into all templates ---
 @app.context_processor
@@ -103,12 +309,37 @@ def inject_theme():
 
 # --- Database Functions ---
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, factory=profiler.connection_factory())
     conn.row_factory = sqlite3.Row
+    # ** NEW: Per connection (and only outside a transaction), so deleting a firewall cascades to its history **
+    conn.execute('PRAGMA foreign_keys = ON;')
     return conn
 
+def _begin_write(conn):
+    """
+    Starts a write transaction and returns the ids of the firewalls that exist at that point. Writers of
+    data collected earlier drop the rows of firewalls deleted meanwhile, since (with foreign keys on)
+    one of them would fail the whole transaction. The caller holds db_lock.
+    """
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    return {row[0] for row in conn.execute('SELECT id FROM firewalls').fetchall()}
+
+# ** NEW: Stored in the database (PRAGMA user_version) once init_db has brought it up to date. Bump it
+# whenever init_db creates or alters anything, so existing databases run the migrations once more. **
+SCHEMA_VERSION = 6
+
 def init_db():
     conn = get_db_connection()
+    # ** NEW: An up-to-date database starts with this one query instead of the checks below **
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        if version > SCHEMA_VERSION:
+            print(f"Database schema version {version} is newer than this application's ({SCHEMA_VERSION}); skipping migrations.")
+        conn.close()
+        return
+    # ** NEW: Write-ahead logging, so the collector's writes and the web workers' reads do not block each other **
+    conn.execute('PRAGMA journal_mode = WAL;')
     conn.execute('PRAGMA foreign_keys = ON;')
     conn.execute('''CREATE TABLE IF NOT EXISTS firewalls (id INTEGER PRIMARY KEY AUTOINCREMENT, ip_address TEXT UNIQUE NOT NULL, last_checked TIMESTAMP, status TEXT DEFAULT 'unknown', last_poll_status TEXT);''')
     conn.execute('''CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY AUTOINCREMENT, firewall_id INTEGER NOT NULL, timestamp TIMESTAMP NOT NULL, active_sessions INTEGER, ssl_decrypt_sessions INTEGER, total_input_bps REAL, total_output_bps REAL, cpu_load REAL, dataplane_load REAL, FOREIGN KEY (firewall_id) REFERENCES firewalls (id) ON DELETE CASCADE);''')
@@ -119,6 +350,15 @@ def init_db():
     conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('ALERT_THRESHOLD', '80')")
     conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('POLL_INTERVAL', '30')")
     conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('DATA_RETENTION_DAYS', '90')")
+    conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('ALERT_ARCHIVE_DAYS', '30')")
+    # ** NEW: Fleet-wide interval for each metric group (throughput keeps POLL_INTERVAL) **
+    for group, setting_key in poll_scheduler.GROUP_INTERVAL_SETTINGS.items():
+        conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (setting_key, str(poll_scheduler.METRIC_GROUPS[group])))
+    # ** NEW: 'direct' polls each firewall itself; 'panorama' proxies through Panorama by serial **
+    conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('COLLECTION_MODE', 'direct')")
+    conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('THROUGHPUT_SOURCE', 'physical')")
+    conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('INTERFACE_RAW_RETENTION_DAYS', '1')")
+    conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('PANORAMA_MAX_CONCURRENT', ?)", (str(panorama_proxy.DEFAULT_MAX_CONCURRENT),))
     
     # ** NEW: Add 'model' column to the firewalls table if it doesn't exist **
     cursor = conn.cursor()
@@ -132,6 +372,17 @@ def init_db():
         conn.execute("ALTER TABLE firewalls ADD COLUMN sw_version TEXT;")
     if 'last_poll_status' not in columns:
         conn.execute("ALTER TABLE firewalls ADD COLUMN last_poll_status TEXT;")
+    # ** NEW: Inventory fields from Panorama; 'source' is 'panorama' for devices a Panorama sync may remove **
+    if 'serial' not in columns:
+        conn.execute("ALTER TABLE firewalls ADD COLUMN serial TEXT;")
+    if 'ha_state' not in columns:
+        conn.execute("ALTER TABLE firewalls ADD COLUMN ha_state TEXT;")
+    if 'source' not in columns:
+        conn.execute("ALTER TABLE firewalls ADD COLUMN source TEXT;")
+    # ** NEW: Remote collector the firewall is assigned to (NULL: polled by the local collector) **
+    if 'collector' not in columns:
+        conn.execute("ALTER TABLE firewalls ADD COLUMN collector TEXT;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_firewalls_collector ON firewalls (collector)")
 
     # ** NEW: Table for detailed firewall specifications/capacities **
     conn.execute('''
@@ -215,6 +466,77 @@ def init_db():
         );
     ''')
 
+    # ** NEW: Archive for old acknowledged alerts, moved out of the hot alerts table **
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS alerts_archive (
+            id INTEGER PRIMARY KEY,
+            firewall_id INTEGER NOT NULL,
+            metric_name TEXT NOT NULL,
+            utilization REAL NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            acknowledged BOOLEAN DEFAULT 1
+        );
+    ''')
+
+    # ** NEW: At most one open alert per firewall/metric. Collapse any legacy duplicates before indexing. **
+    conn.execute("""
+        DELETE FROM alerts WHERE acknowledged = 0 AND id NOT IN (
+            SELECT MIN(id) FROM alerts WHERE acknowledged = 0 GROUP BY firewall_id, metric_name
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_alerts_open ON alerts (firewall_id, metric_name) WHERE acknowledged = 0")
+
+    # ** NEW: Latest-sample lookups per firewall (dashboard, detail pages) and retention pruning by time **
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_firewall_timestamp ON stats (firewall_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_timestamp ON stats (timestamp)")
+    # ** NEW: Shared counter behind bump_data_version(), watched by every process's page cache and live updates **
+    conn.execute("CREATE TABLE IF NOT EXISTS data_version (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)")
+    conn.execute("INSERT OR IGNORE INTO data_version (id, version) VALUES (0, 0)")
+
+    # ** NEW: Hourly peaks of each firewall's stats, kept as the samples are written; the advisor's P95 reads these **
+    hourly_is_new = not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_hourly'").fetchone()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            firewall_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            max_sessions INTEGER NOT NULL,
+            max_throughput_bps REAL NOT NULL,
+            PRIMARY KEY (firewall_id, hour),
+            FOREIGN KEY (firewall_id) REFERENCES firewalls (id) ON DELETE CASCADE
+        ) WITHOUT ROWID;
+    ''')
+    if hourly_is_new:
+        rebuild_hourly_peaks(conn)
+
+    # ** NEW: Per-interface throughput time series (interface dictionary, raw samples, rollups) **
+    interface_stats.create_tables(conn)
+
+    # ** NEW: Last interface-counter snapshot per firewall, so rates survive a restart **
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS counter_state (
+            firewall_id INTEGER PRIMARY KEY,
+            timestamp REAL NOT NULL,
+            counters TEXT NOT NULL,
+            FOREIGN KEY (firewall_id) REFERENCES firewalls (id) ON DELETE CASCADE
+        );
+    ''')
+
+    # ** NEW: Collector membership and shard leases (see collector_lease.py) **
+    collector_lease.create_tables(conn)
+    # ** NEW: Remote collectors pushing results to /api/ingest (see remote_ingest.py) **
+    remote_ingest.create_tables(conn)
+
+    # ** NEW: Per-device poll interval overrides for individual metric groups **
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS poll_interval_overrides (
+            firewall_id INTEGER NOT NULL,
+            metric_group TEXT NOT NULL,
+            interval_seconds INTEGER NOT NULL,
+            PRIMARY KEY (firewall_id, metric_group),
+            FOREIGN KEY (firewall_id) REFERENCES firewalls (id) ON DELETE CASCADE
+        );
+    ''')
+
     # ** NEW: Table for storing PDF generation jobs **
     conn.execute('''
         CREATE TABLE IF NOT EXISTS pdf_jobs (
@@ -270,15 +592,31 @@ def init_db():
         print("Database schema outdated. Adding column 'memory_utilization' to 'stats' table...")
         conn.execute("ALTER TABLE stats ADD COLUMN memory_utilization REAL;")
 
+    # ** FIX: Remove history left behind by firewalls deleted while foreign keys were not enforced **
+    for table in ('stats', 'stats_hourly', 'firewall_details', 'firewall_current_usage', 'alerts', 'counter_state', 'poll_interval_overrides', 'interfaces'):
+        cursor = conn.execute(f"DELETE FROM {table} WHERE firewall_id NOT IN (SELECT id FROM firewalls)")
+        if cursor.rowcount > 0:
+            print(f"Removed {cursor.rowcount} row(s) of deleted firewalls from '{table}'.")
+
     # ** NEW: One-time data seeding from pa_models.py to the database **
     seed_firewall_models(conn)
 
     # ** NEW: Seed the database with a default list of firewalls if it's empty **
     seed_initial_firewalls(conn)
 
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
     conn.commit()
     conn.close()
 
+def rebuild_hourly_peaks(conn):
+    """Recomputes stats_hourly from the stats table (on upgrade, or after writing stats directly)."""
+    conn.execute("""
+        INSERT OR REPLACE INTO stats_hourly (firewall_id, hour, max_sessions, max_throughput_bps)
+        SELECT firewall_id, strftime('%Y-%m-%d %H:00:00', timestamp), MAX(COALESCE(active_sessions, 0)),
+               MAX(MAX(COALESCE(total_input_bps, 0), COALESCE(total_output_bps, 0)))
+        FROM stats GROUP BY firewall_id, strftime('%Y-%m-%d %H:00:00', timestamp)
+    """)
+
 def seed_firewall_models(conn):
     """One-time migration of firewall specs from pa_models.py into the database."""
     cursor = conn.cursor()
@@ -372,15 +710,9 @@ def load_specs_from_db(conn):
     models = conn.execute("SELECT * FROM firewall_models").fetchall()
     return {m['model']: dict(m) for m in models}
 
-# --- Web Page Routes ---
-@app.route('/')
-def index():
-    conn = get_db_connection()
+def _fetch_dashboard_rows(conn):
+    """Returns the latest stats row for every firewall, formatted for the status dashboard."""
     specs_map = load_specs_from_db(conn)
-    
-    settings_row = conn.execute("SELECT value FROM settings WHERE key = 'POLL_INTERVAL'").fetchone()
-    polling_interval = int(settings_row['value']) if settings_row else 30
-
     query = """
         SELECT f.id as firewall_id, f.ip_address, f.hostname, f.model, s.timestamp,
                COALESCE(s.active_sessions, 0) as active_sessions, 
@@ -391,14 +723,11 @@ def index():
                COALESCE(s.memory_utilization, 0) as memory_utilization,
                f.status
         FROM firewalls f
-        LEFT JOIN (
-            SELECT firewall_id, MAX(timestamp) as max_ts FROM stats GROUP BY firewall_id
-        ) as latest_s ON f.id = latest_s.firewall_id
-        LEFT JOIN stats s ON s.firewall_id = latest_s.firewall_id AND s.timestamp = latest_s.max_ts
+        LEFT JOIN stats s ON s.firewall_id = f.id
+            AND s.timestamp = (SELECT MAX(timestamp) FROM stats WHERE firewall_id = f.id)  -- one index seek per firewall
         ORDER BY f.ip_address;
     """
     stats_from_db = conn.execute(query).fetchall()
-    conn.close()
     
     # Process the results to add generation and format the timestamp
     processed_stats = []
@@ -421,11 +750,66 @@ def index():
                 pass
         
         processed_stats.append(stat_dict)
+    return processed_stats
+
+# --- Web Page Routes ---
+@app.route('/')
+@cached_page
+def index():
+    conn = get_db_connection()
+    settings_row = conn.execute("SELECT value FROM settings WHERE key = 'POLL_INTERVAL'").fetchone()
+    polling_interval = int(settings_row['value']) if settings_row else 30
+    processed_stats = _fetch_dashboard_rows(conn)
+    conn.close()
 
     return flask.render_template('index.html', stats=processed_stats, polling_interval=polling_interval)
 
+_stream_refused_warned = False
+
+@app.route('/stream')
+def stream():
+    """Server-Sent Events stream of dashboard row changes and background task status."""
+    # ** FIX: A single-threaded worker (gunicorn's default sync class) would be held by the stream for
+    # as long as the page is open; 204 tells EventSource not to reconnect, and pages work without live updates **
+    if not flask.request.environ.get('wsgi.multithread'):
+        global _stream_refused_warned
+        if not _stream_refused_warned:
+            _stream_refused_warned = True
+            print("Live updates are off: the WSGI server is single-threaded. Run gunicorn with -k gthread --threads N (or -k gevent).")
+        return '', 204
+    _ensure_live_updates()
+
+    def generate():
+        q = event_broker.subscribe()
+        try:
+            # Send the current task state so a freshly opened page is immediately in sync
+            with message_lock:
+                message = background_task_message if background_task_running.is_set() else ""
+            yield f"event: task\ndata: {json.dumps({'running': background_task_running.is_set(), 'message': message})}\n\n"
+            while True:
+                try:
+                    message = q.get(timeout=15)
+                except queue.Empty:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                if message is EventBroker.CLOSE:
+                    # Dropped for falling behind; ending the response makes EventSource reconnect
+                    return
+                yield message
+        finally:
+            event_broker.unsubscribe(q)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/advisor', methods=['GET', 'POST'])
+@cached_page
 def advisor():
+    # ** NEW: Imported on first use; it pulls in numpy, which nothing else in the app needs **
+    import advisor_engine
     results = None
     # ** FIX: Fetch threshold on both GET and POST **
     conn = get_db_connection()
@@ -434,89 +818,62 @@ def advisor():
     conn.close()
 
     selected_timespan = '7d' # Default value
+    selected_statistic = 'peak'
     if flask.request.method == 'POST':
         selected_timespan = flask.request.form['timespan']
-        time_modifier = {'7d': '-7 days', '30d': '-30 days'}.get(selected_timespan, '-7 days')
+        selected_statistic = flask.request.form.get('statistic', 'peak')
+        if selected_statistic not in advisor_engine.ADVISOR_STATISTICS:
+            selected_statistic = 'peak'
 
+        # ** NEW: Whole-fleet batch analysis (one aggregate query, vectorized utilization) **
         conn = get_db_connection()
-        specs_map = load_specs_from_db(conn)
-        specs_list = conn.execute("SELECT * FROM firewall_models").fetchall()
-        firewalls = conn.execute('SELECT id, ip_address, hostname, model FROM firewalls').fetchall()
-        
-        results = []
-        for fw in firewalls:
-            res = {'ip_address': fw['ip_address'], 'model': fw['model'], 'hostname': fw['hostname']}
-            
-            query = f"SELECT MAX(active_sessions) as max_s, MAX(total_input_bps) as max_in, MAX(total_output_bps) as max_out FROM stats WHERE firewall_id = ? AND timestamp >= datetime('now', 'localtime', '{time_modifier}');"
-            peak_stats = conn.execute(query, (fw['id'],)).fetchone()
-
-            peak_sessions = peak_stats['max_s'] or 0
-            # ** NEW: Use the greater of peak input or peak output for the analysis **
-            peak_throughput_mbps = max(peak_stats['max_in'] or 0, peak_stats['max_out'] or 0) / 1000000
-            
-            res['peak_sessions'] = peak_sessions
-            res['peak_throughput'] = peak_throughput_mbps
-
-            if fw['model'] and fw['model'] in specs_map:
-                spec = specs_map[fw['model']]
-                # ** NEW: Add generation to the results dictionary **
-                res['generation'] = spec.get('generation', 'N/A')
-                res['max_sessions'] = spec['max_sessions']
-                res['max_throughput'] = spec['max_throughput_mbps']
-                
-                res['session_util'] = (peak_sessions / spec['max_sessions']) * 100 if spec['max_sessions'] > 0 else 0
-                res['throughput_util'] = (peak_throughput_mbps / spec['max_throughput_mbps']) * 100 if spec['max_throughput_mbps'] > 0 else 0
-
-                recommendations = []
-                if res['session_util'] >= alert_threshold or res['throughput_util'] >= alert_threshold:
-                    # --- Same-gen upgrade logic ---
-                    current_generation = spec.get('generation', 'N/A')
-                    same_gen_models = sorted([s for s in specs_list if s['generation'] == current_generation], key=lambda x: x['max_throughput_mbps'])
-                    current_index = next((i for i, item in enumerate(same_gen_models) if item["model"] == fw['model']), -1)
-
-                    if 0 <= current_index < len(same_gen_models) - 1:
-                        recommendations.append(f"Same Gen: {same_gen_models[current_index + 1]['model']}")
-                    else:
-                        recommendations.append("Highest in Series")
-
-                    # --- Next-gen upgrade logic ---
-                    try:
-                        current_gen_num = int(''.join(filter(str.isdigit, str(current_generation))))
-                        next_gen_str = str(current_gen_num + 1)
-                        
-                        # Find potential next-gen models
-                        next_gen_candidates = sorted(
-                            [s for s in specs_list if str(s['generation']).startswith(next_gen_str) and s['max_throughput_mbps'] >= spec['max_throughput_mbps'] and s['max_sessions'] >= spec['max_sessions']],
-                            key=lambda x: x['max_throughput_mbps']
-                        )
-                        
-                        if next_gen_candidates:
-                            recommendations.append(f"Next Gen: {next_gen_candidates[0]['model']}")
-
-                    except (ValueError, TypeError):
-                        # This handles cases where generation is not a simple number (e.g., 'N/A')
-                        pass
-
-                res['recommendation'] = " | ".join(recommendations) if recommendations else 'Sized Appropriately'
-
-            else:
-                res.update({'generation': 'N/A', 'max_sessions': 'N/A', 'max_throughput': 'N/A', 'session_util': 0, 'throughput_util': 0, 'recommendation': 'Unknown Model'})
-            
-            results.append(res)
+        results = advisor_engine.analyze_fleet(conn, selected_timespan, alert_threshold, statistic=selected_statistic)
         conn.close()
 
-    return flask.render_template('advisor.html', results=results, selected_timespan=selected_timespan, alert_threshold=alert_threshold)
+    return flask.render_template('advisor.html', results=results, selected_timespan=selected_timespan, selected_statistic=selected_statistic,
+                                 statistic_label=advisor_engine.ADVISOR_STATISTICS[selected_statistic], alert_threshold=alert_threshold)
 
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
     conn = get_db_connection()
     key = load_key()
     if flask.request.method == 'POST':
+        # ** FIX: Validated before anything is saved, so a bad value rejects the form instead of failing the request **
+        collector_shards = flask.request.form.get('collector_shards')
+        if collector_shards:
+            try:
+                collector_shards = max(1, int(collector_shards))
+            except ValueError:
+                conn.close()
+                flask.flash("Collector shards must be a whole number.", "error")
+                return flask.redirect(flask.url_for('settings'))
+        pano_max_concurrent = flask.request.form.get('pano_max_concurrent')
+        if pano_max_concurrent:
+            try:
+                pano_max_concurrent = int(pano_max_concurrent)
+            except ValueError:
+                pano_max_concurrent = 0
+            if pano_max_concurrent < 1:
+                conn.close()
+                flask.flash("Max concurrent Panorama calls must be a whole number of at least 1.", "error")
+                return flask.redirect(flask.url_for('settings'))
         # Save firewall polling settings
         conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", 
                      ('FW_USER', flask.request.form['username']))
         conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", 
                      ('POLL_INTERVAL', flask.request.form['interval']))
+        if flask.request.form.get('throughput_source') in device_collection.THROUGHPUT_SOURCES:
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                         ('THROUGHPUT_SOURCE', flask.request.form['throughput_source']))
+        # ** NEW: Save the per-metric-group polling intervals **
+        for group, setting_key in poll_scheduler.GROUP_INTERVAL_SETTINGS.items():
+            if setting_key != 'POLL_INTERVAL' and flask.request.form.get(f'interval_{group}'):
+                conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                             (setting_key, flask.request.form[f'interval_{group}']))
+        # ** NEW: Number of shards the fleet is split into between collectors (see collector_lease.py) **
+        if collector_shards:
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                         ('COLLECTOR_SHARDS', str(collector_shards)))
         if flask.request.form['password']:
             encrypted_pass = encrypt_message(flask.request.form['password'], key)
             conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", 
@@ -531,6 +888,12 @@ def settings():
             encrypted_pano_pass = encrypt_message(flask.request.form['pano_pass'], key)
             conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", 
                          ('PANORAMA_PASSWORD', encrypted_pano_pass))
+        # ** NEW: Save the collection mode (direct or Panorama-proxied) **
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                     ('COLLECTION_MODE', 'panorama' if flask.request.form.get('collection_mode') == 'panorama' else 'direct'))
+        if pano_max_concurrent:
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                         ('PANORAMA_MAX_CONCURRENT', str(pano_max_concurrent)))
         
         # ** NEW: Save Alerting settings **
         conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
@@ -538,22 +901,53 @@ def settings():
         # ** NEW: Save Data Retention settings **
         conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
                      ('DATA_RETENTION_DAYS', flask.request.form['retention_days']))
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                     ('ALERT_ARCHIVE_DAYS', flask.request.form['alert_archive_days']))
+        if flask.request.form.get('interface_raw_retention_days'):
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                         ('INTERFACE_RAW_RETENTION_DAYS', flask.request.form['interface_raw_retention_days']))
         
         conn.commit()
+        # Existing usage data is re-evaluated against the (possibly new) threshold
+        with db_lock:
+            _re_evaluate_alerts(conn, int(flask.request.form['alert_threshold']))
+        bump_data_version()
         flask.flash("Settings saved successfully!")
         return flask.redirect(flask.url_for('settings'))
 
     # Display settings (unchanged)
     settings_data = {row['key']: row['value'] for row in conn.execute("SELECT key, value FROM settings").fetchall()}
+    collectors = collector_lease.describe(conn)
+    remote_collectors = conn.execute("""
+        SELECT r.name, r.last_seen, r.last_address, r.batches, r.results, COUNT(f.id) AS firewalls
+        FROM remote_collectors r LEFT JOIN firewalls f ON f.collector = r.name GROUP BY r.name ORDER BY r.name
+    """).fetchall()
     conn.close()
-    return flask.render_template('settings.html', settings=settings_data)
+    return flask.render_template('settings.html', settings=settings_data, poller_stats=get_poller_stats(), throughput_sources=device_collection.THROUGHPUT_SOURCES, metric_groups=poll_scheduler.METRIC_GROUPS,
+                                 group_labels=poll_scheduler.GROUP_LABELS, group_settings=poll_scheduler.GROUP_INTERVAL_SETTINGS, collectors=collectors,
+                                 remote_collectors=remote_collectors, now=time.time())
 
 @app.route('/backup_database', methods=['POST'])
 def backup_database():
-    """Serves the database file for download with a timestamp."""
+    """Serves a consistent copy of the database for download with a timestamp."""
     timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    return send_file(DB_FILE, as_attachment=True,
-                     download_name=f'monitoring-backup-{timestamp}.db')
+    # SQLite's online backup includes commits still in the write-ahead log and cannot catch a write half done
+    backup_path = f"{DB_FILE}.backup-{uuid.uuid4().hex}"
+    source, target = get_db_connection(), sqlite3.connect(backup_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    def stream_and_remove():
+        try:
+            with open(backup_path, 'rb') as f:
+                while chunk := f.read(1024 * 1024):
+                    yield chunk
+        finally:
+            os.remove(backup_path)
+    return Response(stream_and_remove(), mimetype='application/octet-stream', headers={
+        'Content-Disposition': f'attachment; filename=monitoring-backup-{timestamp}.db', 'Content-Length': str(os.path.getsize(backup_path))})
 
 @app.route('/restore_database', methods=['POST'])
 def restore_database():
@@ -569,51 +963,56 @@ def restore_database():
         # Save the file with a specific name to indicate it's a pending restore
         restore_path = os.path.join(os.path.dirname(__file__), f"{DB_FILE}.pending_restore")
         file.save(restore_path)
-        flask.flash("Restore file uploaded successfully. Please stop the application, replace 'monitoring.db' with 'monitoring.db.pending_restore', and restart the application to complete the process.", "success")
+        flask.flash("Restore file uploaded successfully. Please stop the application (and the collector, if it runs separately), replace 'monitoring.db' with 'monitoring.db.pending_restore', delete any 'monitoring.db-wal' and 'monitoring.db-shm' files next to it, and restart to complete the process.", "success")
     else:
         flask.flash('Invalid file type. Please upload a .db file.', 'error')
     
     return flask.redirect(flask.url_for('settings'))
 
+# (alert label, current usage column, max capacity column) for every capacity metric that can raise an alert
+ALERT_METRICS = [
+    ('Security Rules', 'current_rules', 'max_rules'), ('NAT Rules', 'current_nat_rules', 'max_nat_rules'),
+    ('Address Objects', 'current_address_objects', 'max_address_objects'), ('Service Objects', 'current_service_objects', 'max_service_objects'),
+    ('IPsec Tunnels', 'current_ipsec_tunnels', 'max_ipsec_tunnels'), ('Routes', 'current_routes', 'max_routes'),
+    ('Multicast Routes', 'current_mroutes', 'max_mroutes'), ('ARP Entries', 'current_arp_entries', 'max_arp_entries'),
+    ('BFD Sessions', 'current_bfd_sessions', 'max_bfd_sessions'), ('DNS Cache Entries', 'current_dns_cache', 'max_dns_cache'),
+    ('Registered IPs (User-ID)', 'current_registered_ips', 'max_registered_ips')
+]
+
+# One set-based pass over every firewall x metric. Breaches are upserted against the partial unique
+# index on open alerts, so an already-open alert just has its utilization refreshed.
+_ALERT_BREACHES_SQL = " UNION ALL ".join(
+    f"SELECT u.firewall_id, '{label}' AS metric_name, u.{current_col} * 100.0 / d.{max_col} AS utilization "
+    f"FROM firewall_current_usage u JOIN firewalls f ON f.id = u.firewall_id JOIN firewall_details d ON d.firewall_id = u.firewall_id "
+    f"WHERE u.last_updated IS NOT NULL AND u.{current_col} IS NOT NULL AND d.{max_col} > 0"
+    for label, current_col, max_col in ALERT_METRICS
+)
+_ALERT_UPSERT_SQL = f"""
+    INSERT INTO alerts (firewall_id, metric_name, utilization, timestamp)
+    SELECT firewall_id, metric_name, utilization, ? FROM ({_ALERT_BREACHES_SQL}) WHERE utilization >= ?
+    ON CONFLICT (firewall_id, metric_name) WHERE acknowledged = 0
+    DO UPDATE SET utilization = excluded.utilization
+"""
+
 def _re_evaluate_alerts(conn, alert_threshold):
     """Re-evaluates all current usage data against a given threshold and creates alerts."""
     print(f"Re-evaluating alerts with threshold: {alert_threshold}%")
-    # Get all current usage and max capacity data
-    firewalls_data = conn.execute("""
-        SELECT 
-            f.id as firewall_id, f.model,
-            m.max_ssl_decrypt_sessions,
-            d.*, 
-            u.*
-        FROM firewalls f
-        LEFT JOIN firewall_models m ON f.model = m.model
-        LEFT JOIN firewall_details d ON f.id = d.firewall_id
-        LEFT JOIN firewall_current_usage u ON f.id = u.firewall_id
-    """).fetchall()
-
-    metrics_to_check = [
-        ('Security Rules', 'current_rules', 'max_rules'), ('NAT Rules', 'current_nat_rules', 'max_nat_rules'),
-        ('Address Objects', 'current_address_objects', 'max_address_objects'), ('Service Objects', 'current_service_objects', 'max_service_objects'),
-        ('IPsec Tunnels', 'current_ipsec_tunnels', 'max_ipsec_tunnels'), ('Routes', 'current_routes', 'max_routes'),
-        ('Multicast Routes', 'current_mroutes', 'max_mroutes'), ('ARP Entries', 'current_arp_entries', 'max_arp_entries'),
-        ('BFD Sessions', 'current_bfd_sessions', 'max_bfd_sessions'), ('DNS Cache Entries', 'current_dns_cache', 'max_dns_cache'),
-        ('Registered IPs (User-ID)', 'current_registered_ips', 'max_registered_ips')
-    ]
-
-    for fw in firewalls_data:
-        if not fw['last_updated']: continue # Skip if no usage data
-        for label, current_key, max_key in metrics_to_check:
-            current_val = fw[current_key]
-            max_val = fw[max_key]
-            if current_val is not None and max_val is not None and max_val > 0:
-                utilization = (current_val / max_val) * 100
-                if utilization >= alert_threshold:
-                    exists = conn.execute("SELECT 1 FROM alerts WHERE firewall_id = ? AND metric_name = ? AND acknowledged = 0", (fw['firewall_id'], label)).fetchone()
-                    if not exists:
-                        conn.execute("INSERT INTO alerts (firewall_id, metric_name, utilization, timestamp) VALUES (?, ?, ?, ?)",
-                                     (fw['firewall_id'], label, utilization, datetime.now().isoformat()))
+    cursor = conn.execute(_ALERT_UPSERT_SQL, (datetime.now().isoformat(), alert_threshold))
+    print(f"Alert evaluation complete. {cursor.rowcount} alert(s) raised or refreshed.")
     conn.commit()
 
+def _archive_acknowledged_alerts(conn, archive_days):
+    """Moves acknowledged alerts older than archive_days into alerts_archive to keep the hot table small."""
+    cutoff = (datetime.now() - timedelta(days=archive_days)).isoformat()
+    conn.execute("""
+        INSERT INTO alerts_archive (id, firewall_id, metric_name, utilization, timestamp, acknowledged)
+        SELECT id, firewall_id, metric_name, utilization, timestamp, acknowledged FROM alerts
+        WHERE acknowledged = 1 AND timestamp < ?
+    """, (cutoff,))
+    cursor = conn.execute("DELETE FROM alerts WHERE acknowledged = 1 AND timestamp < ?", (cutoff,))
+    if cursor.rowcount > 0: print(f"Archived {cursor.rowcount} acknowledged alerts (older than {archive_days} days).")
+    return cursor.rowcount
+
 @app.route('/export/csv/<int:fw_id>')
 def export_csv(fw_id):
     timespan = flask.request.args.get('timespan', '1h')
@@ -649,11 +1048,8 @@ def export_csv(fw_id):
 
 def _generate_pdf_worker(report_type, job_id, timespan=None, start_date=None, end_date=None):
     """Worker function to generate PDF in the background."""
-    global background_task_message
-    with message_lock:
-        background_task_message = "Generating PDF..."
     print(f"Background PDF worker started for job {job_id}.")
-    background_task_running.set()
+    _set_background_task("Generating PDF...")
     try:
         with app.app_context():
             try:
@@ -661,6 +1057,8 @@ def _generate_pdf_worker(report_type, job_id, timespan=None, start_date=None, en
                 reports_dir = os.path.join(app.static_folder, 'reports')
                 os.makedirs(reports_dir, exist_ok=True)
 
+                # ** NEW: Imported on first use, so only processes that build reports load matplotlib and fpdf **
+                import report_generator
                 pdf_data = report_generator.generate_report_pdf(DB_FILE, report_type, timespan=timespan, start_date=start_date, end_date=end_date)
                 if pdf_data:
                     file_path = os.path.join(reports_dir, f"{job_id}.pdf")
@@ -683,9 +1081,7 @@ def _generate_pdf_worker(report_type, job_id, timespan=None, start_date=None, en
                     conn.close()
     finally:
         print(f"Background PDF worker for job {job_id} finished.")
-        with message_lock:
-            background_task_message = ""
-        background_task_running.clear()
+        _clear_background_task()
 
 @app.route('/export/pdf', methods=['GET', 'POST'])
 def export_pdf():
@@ -808,6 +1204,13 @@ def firewall_detail(fw_id):
     # ** NEW: Fetch detailed specs and pass them to the template **
     details = conn.execute('SELECT * FROM firewall_details WHERE firewall_id = ?', (fw_id,)).fetchone()
 
+    # ** NEW: This firewall's busiest interfaces right now **
+    top_interfaces = interface_stats.top_interfaces(conn, window='now', limit=10, firewall_id=fw_id)
+
+    # ** NEW: Per-device poll interval overrides **
+    poll_overrides = {row['metric_group']: row['interval_seconds'] for row in conn.execute('SELECT metric_group, interval_seconds FROM poll_interval_overrides WHERE firewall_id = ?', (fw_id,)).fetchall()}
+    global_intervals = poll_scheduler.group_intervals_from_settings({row['key']: row['value'] for row in conn.execute("SELECT key, value FROM settings").fetchall()})
+
     summary_stats = None
     if chart_data:
         if start_date and end_date:
@@ -832,20 +1235,56 @@ def firewall_detail(fw_id):
         sw_version=fw['sw_version'],
         generation=generation,
         full_data=full_data if full_data else None,
-        current_timespan=timespan
+        current_timespan=timespan,
+        poll_overrides=poll_overrides,
+        top_interfaces=top_interfaces,
+        global_intervals=global_intervals,
+        group_labels=poll_scheduler.GROUP_LABELS
     )
 
+@app.route('/firewall/<int:fw_id>/poll_intervals', methods=['POST'])
+def update_poll_intervals(fw_id):
+    """Saves per-device poll interval overrides. A blank field falls back to the fleet-wide interval."""
+    conn = get_db_connection()
+    with db_lock:
+        for group in poll_scheduler.METRIC_GROUPS:
+            value = flask.request.form.get(f'interval_{group}', '').strip()
+            if value.isdigit() and int(value) > 0:
+                conn.execute("INSERT OR REPLACE INTO poll_interval_overrides (firewall_id, metric_group, interval_seconds) VALUES (?, ?, ?)", (fw_id, group, int(value)))
+            else:
+                conn.execute("DELETE FROM poll_interval_overrides WHERE firewall_id = ? AND metric_group = ?", (fw_id, group))
+        conn.commit()
+    conn.close()
+    bump_data_version()
+    flask.flash("Polling intervals updated. Changes apply from each metric group's next poll.")
+    return flask.redirect(flask.url_for('firewall_detail', fw_id=fw_id))
+
 @app.route('/firewalls')
 def manage_firewalls():
     conn = get_db_connection()
     firewalls = conn.execute('SELECT * FROM firewalls ORDER BY ip_address').fetchall()
+    remote_collectors = [row['name'] for row in conn.execute('SELECT name FROM remote_collectors ORDER BY name').fetchall()]
     conn.close()
-    return flask.render_template('firewalls.html', firewalls=firewalls)
-
-@app.route('/capacity')
-def capacity_dashboard():
-    """Renders the new Capacity Dashboard page."""
-    conn = get_db_connection()
+    return flask.render_template('firewalls.html', firewalls=firewalls, remote_collectors=remote_collectors)
+
+# (template key, current usage column, max capacity column) for each bar on the Capacity Dashboard
+CAPACITY_UTILIZATION_METRICS = [
+    ('util_rules', 'current_rules', 'max_rules'),
+    ('util_nat_rules', 'current_nat_rules', 'max_nat_rules'),
+    ('util_address', 'current_address_objects', 'max_address_objects'),
+    ('util_service', 'current_service_objects', 'max_service_objects'),
+    ('util_ipsec', 'current_ipsec_tunnels', 'max_ipsec_tunnels'),
+    ('util_routes', 'current_routes', 'max_routes'),
+    ('util_mroutes', 'current_mroutes', 'max_mroutes'),
+    ('util_arp', 'current_arp_entries', 'max_arp_entries'),
+    ('util_bfd', 'current_bfd_sessions', 'max_bfd_sessions'),
+    ('util_dns_cache', 'current_dns_cache', 'max_dns_cache'),
+    ('util_registered_ips', 'current_registered_ips', 'max_registered_ips'),
+    ('util_ssl_decrypt_sessions', 'current_ssl_decrypt_sessions', 'max_ssl_decrypt_sessions'),
+]
+
+def _fetch_capacity_rows(conn):
+    """Returns every firewall's capacity limits and current usage, with the CAPACITY_UTILIZATION_METRICS percentages."""
     query = """
         SELECT
             f.id, f.hostname, f.ip_address, f.model,
@@ -865,29 +1304,46 @@ def capacity_dashboard():
             f.hostname, f.ip_address;
     """
     firewalls_data = conn.execute(query).fetchall()
-    conn.close()
 
     # Calculate utilization percentages
     results = []
     for fw in firewalls_data:
         fw_dict = dict(fw)
-        fw_dict['util_rules'] = (fw['current_rules'] / fw['max_rules'] * 100) if fw['current_rules'] is not None and fw['max_rules'] else 0
-        fw_dict['util_nat_rules'] = (fw['current_nat_rules'] / fw['max_nat_rules'] * 100) if fw['current_nat_rules'] is not None and fw['max_nat_rules'] else 0
-        fw_dict['util_address'] = (fw['current_address_objects'] / fw['max_address_objects'] * 100) if fw['current_address_objects'] is not None and fw['max_address_objects'] else 0
-        fw_dict['util_service'] = (fw['current_service_objects'] / fw['max_service_objects'] * 100) if fw['current_service_objects'] is not None and fw['max_service_objects'] else 0
-        fw_dict['util_ipsec'] = (fw['current_ipsec_tunnels'] / fw['max_ipsec_tunnels'] * 100) if fw['current_ipsec_tunnels'] is not None and fw['max_ipsec_tunnels'] else 0
-        fw_dict['util_routes'] = (fw['current_routes'] / fw['max_routes'] * 100) if fw['current_routes'] is not None and fw['max_routes'] else 0
-        fw_dict['util_mroutes'] = (fw['current_mroutes'] / fw['max_mroutes'] * 100) if fw['current_mroutes'] is not None and fw['max_mroutes'] else 0
-        fw_dict['util_arp'] = (fw['current_arp_entries'] / fw['max_arp_entries'] * 100) if fw['current_arp_entries'] is not None and fw['max_arp_entries'] else 0
-        fw_dict['util_bfd'] = (fw['current_bfd_sessions'] / fw['max_bfd_sessions'] * 100) if fw['current_bfd_sessions'] is not None and fw['max_bfd_sessions'] else 0
-        fw_dict['util_dns_cache'] = (fw['current_dns_cache'] / fw['max_dns_cache'] * 100) if fw['current_dns_cache'] is not None and fw['max_dns_cache'] else 0
-        fw_dict['util_registered_ips'] = (fw['current_registered_ips'] / fw['max_registered_ips'] * 100) if fw['current_registered_ips'] is not None and fw['max_registered_ips'] else 0
-        fw_dict['util_ssl_decrypt_sessions'] = (fw['current_ssl_decrypt_sessions'] / fw['max_ssl_decrypt_sessions'] * 100) if fw['current_ssl_decrypt_sessions'] is not None and fw['max_ssl_decrypt_sessions'] else 0
+        for util_key, current_key, max_key in CAPACITY_UTILIZATION_METRICS:
+            current_val, max_val = fw[current_key], fw[max_key]
+            fw_dict[util_key] = (current_val / max_val * 100) if current_val is not None and max_val else 0
         results.append(fw_dict)
-    
+    return results
+
+@app.route('/capacity')
+@cached_page
+def capacity_dashboard():
+    """Renders the new Capacity Dashboard page."""
+    conn = get_db_connection()
+    results = _fetch_capacity_rows(conn)
+    conn.close()
     return flask.render_template('capacity.html', firewalls=results)
 
+@app.route('/interfaces')
+@cached_page
+def busiest_interfaces():
+    """Busiest interfaces across the fleet, ranked by peak rate over the selected window."""
+    window = flask.request.args.get('window', 'now')
+    metric = flask.request.args.get('metric', 'in_bps')
+    if window not in interface_stats.TOP_INTERFACE_WINDOWS:
+        window = 'now'
+    if metric not in interface_stats.TOP_INTERFACE_METRICS:
+        metric = 'in_bps'
+    # ** FIX: A non-numeric limit falls back to the default; it is capped so one request cannot rank every interface **
+    limit = min(max(flask.request.args.get('limit', 25, type=int), 1), interface_stats.MAX_TOP_LIMIT)
+    conn = get_db_connection()
+    top = interface_stats.top_interfaces(conn, window=window, metric=metric, limit=limit)
+    conn.close()
+    return flask.render_template('interfaces.html', interfaces=top, current_window=window, current_metric=metric,
+                                 windows=interface_stats.TOP_INTERFACE_WINDOWS, metrics=interface_stats.TOP_INTERFACE_METRICS)
+
 @app.route('/alerts')
+@cached_page
 def alerts():
     """Displays active, unacknowledged alerts."""
     conn = get_db_connection()
@@ -914,6 +1370,7 @@ def acknowledge_alerts():
         conn.executemany("UPDATE alerts SET acknowledged = 1 WHERE id = ?", [(id,) for id in alert_ids_to_ack])
         conn.commit()
         conn.close()
+        bump_data_version()
         flask.flash(f"Acknowledged {len(alert_ids_to_ack)} alert(s).", "success")
     return flask.redirect(flask.url_for('alerts'))
 
@@ -927,6 +1384,7 @@ def toggle_theme():
         conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ('THEME', theme))
         conn.commit()
         conn.close()
+        bump_data_version()
         return flask.jsonify({'status': 'success', 'theme': theme})
     return flask.jsonify({'status': 'error', 'message': 'Invalid theme'}), 400
 
@@ -935,9 +1393,10 @@ def add_firewall():
     ip_address = flask.request.form['ip_address']
     if ip_address:
         conn = get_db_connection()
-        try: conn.execute('INSERT INTO firewalls (ip_address) VALUES (?)', (ip_address,)); conn.commit()
+        try: conn.execute("INSERT INTO firewalls (ip_address, source) VALUES (?, 'manual')", (ip_address,)); conn.commit()
         except sqlite3.IntegrityError: pass
         conn.close()
+        bump_data_version()
     return flask.redirect(flask.url_for('manage_firewalls'))
 
 @app.route('/import_firewalls', methods=['POST'])
@@ -949,18 +1408,77 @@ def import_firewalls():
         for ip in content:
             ip = ip.strip()
             if ip and not ip.startswith('#'):
-                try: conn.execute('INSERT INTO firewalls (ip_address) VALUES (?)', (ip,));
+                try: conn.execute("INSERT INTO firewalls (ip_address, source) VALUES (?, 'manual')", (ip,));
                 except sqlite3.IntegrityError: pass
         conn.commit()
         conn.close()
+        bump_data_version()
     return flask.redirect(flask.url_for('manage_firewalls'))
 
-def _import_from_panorama_worker():
+def parse_panorama_devices(xml_content):
+    """
+    Parses Panorama's <show><devices> response into one dict per managed firewall: serial, ip_address,
+    hostname, model, sw_version, ha_state and connected (bool).
+    """
+    devices = []
+    for dev in ET.fromstring(xml_content).findall('.//devices/entry'):
+        devices.append({
+            'serial': dev.findtext('serial') or dev.get('name'),
+            'ip_address': dev.findtext('ip-address'),
+            'hostname': dev.findtext('hostname'),
+            'model': dev.findtext('model'),
+            'sw_version': dev.findtext('sw-version'),
+            'ha_state': dev.findtext('ha/state'),
+            'connected': dev.findtext('connected') == 'yes',
+        })
+    return devices
+
+# Panorama inventory upsert. Panorama's values win, but a missing field never blanks a discovered one;
+# a firewall that was already being monitored is adopted into the sync unless it was added by hand.
+_PANORAMA_UPSERT_SQL = """
+    INSERT INTO firewalls (ip_address, hostname, model, sw_version, serial, ha_state, source)
+    VALUES (?, ?, ?, ?, ?, ?, 'panorama')
+    ON CONFLICT (ip_address) DO UPDATE SET
+        hostname = COALESCE(excluded.hostname, hostname),
+        model = COALESCE(excluded.model, model),
+        sw_version = COALESCE(excluded.sw_version, sw_version),
+        serial = COALESCE(excluded.serial, serial),
+        ha_state = excluded.ha_state,
+        source = COALESCE(source, 'panorama')
+"""
+
+def sync_panorama_inventory(conn, devices, remove_missing=False):
+    """
+    Applies a Panorama device list to the firewalls table in one transaction: adds new firewalls,
+    updates inventory fields (and the IP address of a known serial), and with remove_missing deletes
+    Panorama-sourced firewalls Panorama no longer manages. The caller holds db_lock.
+    Returns (added, updated, removed) counts.
+    """
+    devices = [d for d in devices if d['ip_address']]
+    existing_ips = {row['ip_address'] for row in conn.execute('SELECT ip_address FROM firewalls').fetchall()}
+    ip_by_serial = {row['serial']: row['ip_address'] for row in conn.execute('SELECT serial, ip_address FROM firewalls WHERE serial IS NOT NULL').fetchall()}
+
+    # A firewall re-addressed since the last sync keeps its row (and history) by serial
+    for d in devices:
+        old_ip = ip_by_serial.get(d['serial'])
+        if old_ip and old_ip != d['ip_address'] and d['ip_address'] not in existing_ips:
+            conn.execute('UPDATE firewalls SET ip_address = ? WHERE ip_address = ?', (d['ip_address'], old_ip))
+            existing_ips.discard(old_ip)
+            existing_ips.add(d['ip_address'])
+
+    conn.executemany(_PANORAMA_UPSERT_SQL, [(d['ip_address'], d['hostname'], d['model'], d['sw_version'], d['serial'], d['ha_state']) for d in devices])
+    added = sum(1 for d in devices if d['ip_address'] not in existing_ips)
+
+    removed = 0
+    if remove_missing:
+        current_ips = [(ip,) for ip in existing_ips - {d['ip_address'] for d in devices}]
+        # rowcount, unlike total_changes, leaves out the history rows the delete cascades to
+        removed = conn.executemany("DELETE FROM firewalls WHERE ip_address = ? AND source = 'panorama'", current_ips).rowcount
+    return added, len(devices) - added, removed
+
+def _import_from_panorama_worker(remove_missing=False):
     """Worker function to run the Panorama import in a background thread."""
-    global background_task_message
-    with message_lock:
-        background_task_message = "Importing from Panorama..."
-    background_task_running.set()
+    _set_background_task("Importing from Panorama...")
     try:
         print("Background Panorama import worker started.")
         with app.app_context():
@@ -987,28 +1505,24 @@ def _import_from_panorama_worker():
                 if api_key is None or not api_key.text:
                     raise Exception("Failed to get API key from Panorama. Check credentials.")
 
-                cmd = "<show><devices><connected></connected></devices></show>"
-                response = requests.get(f"https://{pano_host}/api/?type=op&cmd={cmd}&key={api_key.text}", verify=False, timeout=20)
+                # ** NEW: 'all' rather than 'connected', so a briefly disconnected firewall is not treated as removed **
+                cmd = "<show><devices><all></all></devices></show>"
+                response = requests.get(f"https://{pano_host}/api/?type=op&cmd={cmd}&key={api_key.text}", verify=False, timeout=60)
                 response.raise_for_status()
+                devices = parse_panorama_devices(response.content)
 
-                device_tree = ET.fromstring(response.content)
-                ips_to_import = [dev.findtext('ip-address') for dev in device_tree.findall('.//devices/entry')]
-                
                 with db_lock:
-                    for ip in ips_to_import:
-                        if ip:
-                            conn.execute('INSERT OR IGNORE INTO firewalls (ip_address) VALUES (?)', (ip,))
+                    added, updated, removed = sync_panorama_inventory(conn, devices, remove_missing=remove_missing)
                     conn.commit()
-                print(f"Panorama import successful. Processed {len(ips_to_import)} devices.")
+                bump_data_version()
+                print(f"Panorama import successful. {len(devices)} devices: {added} added, {updated} updated, {removed} removed.")
             except Exception as e:
                 print(f"Error during Panorama import: {e}")
             finally:
                 conn.close()
     finally:
         print("Background Panorama import worker finished.")
-        with message_lock:
-            background_task_message = ""
-        background_task_running.clear()
+        _clear_background_task()
 
 @app.route('/import_from_panorama', methods=['POST'])
 def import_from_panorama():
@@ -1016,7 +1530,7 @@ def import_from_panorama():
         flask.flash("A background task is already running. Please wait for it to complete.", "warning")
         return flask.redirect(flask.url_for('manage_firewalls'))
     
-    thread = threading.Thread(target=_import_from_panorama_worker)
+    thread = threading.Thread(target=_import_from_panorama_worker, kwargs={'remove_missing': flask.request.form.get('remove_missing') == 'on'})
     thread.start()
     return flask.redirect(flask.url_for('manage_firewalls'))
 
@@ -1029,11 +1543,57 @@ def delete_firewalls():
         conn.executemany("DELETE FROM firewalls WHERE id = ?", [(id,) for id in fw_ids_to_delete])
         conn.commit()
         conn.close()
+        bump_data_version()
         flask.flash(f"Deleted {len(fw_ids_to_delete)} firewall(s).", "success")
     else:
         flask.flash("No firewalls selected for deletion.", "warning")
     return flask.redirect(flask.url_for('manage_firewalls'))
 
+# --- NEW: Routes for managing remote collectors and the firewalls assigned to them ---
+@app.route('/assign_collector', methods=['POST'])
+def assign_collector():
+    """Assigns the selected firewalls to a remote collector, or back to the local collector."""
+    fw_ids = flask.request.form.getlist('firewall_ids')
+    collector_name = flask.request.form.get('collector') or None
+    if fw_ids:
+        conn = get_db_connection()
+        with db_lock:
+            conn.executemany("UPDATE firewalls SET collector = ? WHERE id = ?", [(collector_name, fw_id) for fw_id in fw_ids])
+            conn.commit()
+        conn.close()
+        bump_data_version()
+        flask.flash(f"Assigned {len(fw_ids)} firewall(s) to {collector_name or 'the local collector'}.", "success")
+    else:
+        flask.flash("No firewalls selected.", "warning")
+    return flask.redirect(flask.url_for('manage_firewalls'))
+
+@app.route('/remote_collectors/add', methods=['POST'])
+def add_remote_collector():
+    name = flask.request.form.get('name', '').strip()
+    if name:
+        conn = get_db_connection()
+        try:
+            token = remote_ingest.register(conn, name)
+            conn.commit()
+            flask.flash(f"Remote collector '{name}' added. Its token (shown only once): {token}", "success")
+        except sqlite3.IntegrityError:
+            flask.flash(f"A remote collector named '{name}' already exists.", "error")
+        conn.close()
+    return flask.redirect(flask.url_for('settings'))
+
+@app.route('/remote_collectors/<name>/delete', methods=['POST'])
+def delete_remote_collector(name):
+    """Removes a remote collector; its firewalls go back to the local collector."""
+    conn = get_db_connection()
+    with db_lock:
+        conn.execute("UPDATE firewalls SET collector = NULL WHERE collector = ?", (name,))
+        conn.execute("DELETE FROM remote_collectors WHERE name = ?", (name,))
+        conn.commit()
+    conn.close()
+    bump_data_version()
+    flask.flash(f"Remote collector '{name}' removed; its firewalls are polled locally again.", "success")
+    return flask.redirect(flask.url_for('settings'))
+
 # --- NEW: Routes for Managing Firewall Models ---
 @app.route('/model_specs')
 def model_specs():
@@ -1051,6 +1611,7 @@ def add_model():
             (flask.request.form['model'], flask.request.form['generation'], flask.request.form['max_sessions'], flask.request.form['max_throughput'], flask.request.form['max_ssl_decrypt_sessions'])
         )
         conn.commit()
+        bump_data_version()
         flask.flash(f"Model '{flask.request.form['model']}' added successfully.", "success")
     except sqlite3.IntegrityError:
         flask.flash(f"Error: Model '{flask.request.form['model']}' already exists.", "error")
@@ -1070,6 +1631,7 @@ def update_model():
             (flask.request.form['generation'], flask.request.form['max_sessions'], flask.request.form['max_throughput'], flask.request.form['max_ssl_decrypt_sessions'], flask.request.form['model'])
         )
         conn.commit()
+        bump_data_version()
         flask.flash(f"Model '{flask.request.form['model']}' updated successfully.", "success")
     except Exception as e:
         flask.flash(f"An error occurred while updating the model: {e}", "error")
@@ -1086,17 +1648,115 @@ def delete_models():
         conn.executemany("DELETE FROM firewall_models WHERE model = ?", [(name,) for name in model_names_to_delete])
         conn.commit()
         conn.close()
+        bump_data_version()
         flask.flash(f"Deleted {len(model_names_to_delete)} model(s).", "success")
     else:
         flask.flash("No models selected for deletion.", "warning")
     return flask.redirect(flask.url_for('model_specs'))
 
+# Interface counter snapshots older than this many seconds are not restored at startup
+COUNTER_STATE_MAX_AGE = 900
+
+# --- Poller health counters (late/skipped polls and scheduling lag) ---
+poller_stats = poll_loop.PollerStats()
+
+# ** NEW: Collector instrumentation (API call latency, parse/keygen/DB write time, queues), see /internal/collector **
+collector = device_collection.collector
+
+# ** NEW: Prometheus exposition, rendered by the poller after each batch of results and served as-is by /metrics **
+fleet_metrics = prometheus_metrics.FleetMetrics()
+
+def _update_fleet_metrics_capacity(conn):
+    """Refreshes the capacity utilization series (resources with both a known usage and a model limit)."""
+    for fw in _fetch_capacity_rows(conn):
+        fleet_metrics.update(fw['id'], capacity={util_key[len('util_'):]: fw[util_key] for util_key, current_key, max_key in CAPACITY_UTILIZATION_METRICS
+                                                 if fw[current_key] is not None and fw[max_key]})
+
+def _publish_fleet_metrics():
+    fleet_metrics.publish(collector.totals(), get_poller_stats())
+
+def get_poller_stats():
+    """Returns a copy of the poller health counters."""
+    return poller_stats.snapshot()
+
+def _collect_concurrently(func, tasks):
+    """Runs network-bound collection tasks on a capped thread pool. Tasks must not touch the database."""
+    if not tasks:
+        return []
+    with ThreadPool(processes=min(len(tasks), poll_loop.COLLECTION_MAX_WORKERS)) as pool:
+        return pool.map(func, tasks)
+
+def _fetch_details_task(args):
+    firewall_id, host, api_key = args
+    return firewall_id, device_collection.fetch_fw_details(host, api_key)
+
+def _open_panorama_connection(settings, key):
+    """
+    Returns a panorama_proxy.PanoramaConnection when the collection mode is 'panorama', else None.
+    Raises if Panorama cannot be reached or rejects the credentials.
+    """
+    if settings.get('COLLECTION_MODE', 'direct') != 'panorama':
+        return None
+    pano_host = settings.get('PANORAMA_HOST')
+    pano_user = settings.get('PANORAMA_USER')
+    encrypted_pass = settings.get('PANORAMA_PASSWORD')
+    if not all([pano_host, pano_user, encrypted_pass]):
+        raise ValueError("Panorama collection mode is enabled but the Panorama settings are incomplete.")
+    max_concurrent = max(1, int(settings.get('PANORAMA_MAX_CONCURRENT', panorama_proxy.DEFAULT_MAX_CONCURRENT)))
+    return panorama_proxy.PanoramaConnection.connect(pano_host, pano_user, decrypt_message(encrypted_pass, key), max_concurrent=max_concurrent)
+
+# ** FIX: One Panorama connection per process, so PANORAMA_MAX_CONCURRENT caps the poller and the
+# capacity and spec refreshes together rather than each of them **
+PANORAMA_SETTINGS = ('COLLECTION_MODE', 'PANORAMA_HOST', 'PANORAMA_USER', 'PANORAMA_PASSWORD', 'PANORAMA_MAX_CONCURRENT')
+_panorama_lock = threading.Lock()
+_panorama_connection = None
+_panorama_config = None
+
+def _shared_panorama_connection(settings, key):
+    """
+    The process-wide Panorama connection for the current settings (None in 'direct' mode), opened on
+    first use and reopened when the Panorama settings change. Raises like _open_panorama_connection.
+    """
+    global _panorama_connection, _panorama_config
+    config = tuple(settings.get(k) for k in PANORAMA_SETTINGS)
+    with _panorama_lock:
+        if _panorama_connection is not None and config == _panorama_config:
+            return _panorama_connection
+        # A replaced connection is not closed: other callers may still have calls in flight on it
+        _panorama_connection, _panorama_config = None, config
+        _panorama_connection = _open_panorama_connection(settings, key)
+        return _panorama_connection
+
+def _device_access(fw, panorama):
+    """
+    Returns (http, api_key) for collecting from one firewall: through Panorama (Panorama's key) when a
+    Panorama connection is open and the firewall's serial is known, otherwise directly (api_key None).
+    """
+    if panorama is not None and fw['serial']:
+        return panorama.for_device(fw['serial']), panorama.api_key
+    return requests, None
+
+def _refresh_details_task(args):
+    firewall_id, host, fw_user, fw_password, http, api_key = args
+    if not api_key:
+        key_res = device_collection.get_api_key((host, fw_user, fw_password))
+        if key_res['status'] != 'success':
+            return firewall_id, None
+        api_key = key_res['api_key']
+    return firewall_id, device_collection.fetch_fw_details(host, api_key, http)
+
+def _refresh_usage_task(args):
+    firewall_id, host, fw_user, fw_password, adv_routing_enabled, sw_version, http, api_key = args
+    if not api_key:
+        key_res = device_collection.get_api_key((host, fw_user, fw_password))
+        if key_res['status'] != 'success':
+            return firewall_id, None
+        api_key = key_res['api_key']
+    return firewall_id, device_collection.poll_current_usage(host, api_key, adv_routing_enabled, sw_version, http)
+
 def _refresh_specs_worker():
     """Worker function to run the spec refresh in a background thread."""
-    global background_task_message
-    with message_lock:
-        background_task_message = "Refreshing specs..."
-    background_task_running.set()
+    _set_background_task("Refreshing specs...")
     try:
         print("Background spec refresh worker started.")
         with app.app_context(): # Need app context to access flask.flash and url_for
@@ -1113,29 +1773,28 @@ def _refresh_specs_worker():
                 return
 
             fw_password = decrypt_message(encrypted_pass, key)
-            firewalls = conn.execute('SELECT id, ip_address FROM firewalls').fetchall()
+            firewalls = conn.execute('SELECT id, ip_address, serial FROM firewalls WHERE collector IS NULL').fetchall()
             
             if not firewalls:
                 conn.close()
                 return
 
-            hosts_to_poll = [fw['ip_address'] for fw in firewalls]
-            init_tasks = [(host, fw_user, fw_password) for host in hosts_to_poll]
-            api_keys = {}
+            # --- Collection phase: keygen + details for every firewall concurrently, no lock held ---
             try:
-                with multiprocessing.Pool(processes=len(init_tasks)) as pool:
-                    for res in pool.map(get_api_key, init_tasks):
-                        if res['status'] == 'success':
-                            api_keys[res['host']] = res['api_key']
+                panorama = _shared_panorama_connection(settings, key)
+                tasks = [(fw['id'], fw['ip_address'], fw_user, fw_password, *_device_access(fw, panorama)) for fw in firewalls]
+                details = _collect_concurrently(_refresh_details_task, tasks)
             except Exception as e:
                 print(f"Spec Refresh Worker Error: {e}")
                 conn.close()
                 return
 
+            # --- Write phase: one short batched transaction ---
             with db_lock:
-                for fw in firewalls:
-                    if fw['ip_address'] in api_keys:
-                        parse_and_store_fw_details(conn, fw['id'], api_keys[fw['ip_address']])
+                existing = _begin_write(conn)
+                for firewall_id, parsed_data in details:
+                    if firewall_id in existing:
+                        store_fw_details(conn, firewall_id, parsed_data)
                 
                 # ** NEW: Re-evaluate alerts since max capacities may have changed **
                 alert_threshold = int(settings.get('ALERT_THRESHOLD', 80))
@@ -1143,11 +1802,10 @@ def _refresh_specs_worker():
 
                 conn.commit()
             conn.close()
+            bump_data_version()
     finally:
         print("Background spec refresh worker finished.")
-        with message_lock:
-            background_task_message = ""
-        background_task_running.clear()
+        _clear_background_task()
 
 @app.route('/refresh_specs', methods=['POST'])
 def refresh_specs():
@@ -1172,10 +1830,7 @@ def refresh_specs():
 
 def _refresh_capacity_worker():
     """Worker function to run the capacity refresh in a background thread."""
-    global background_task_message
-    with message_lock:
-        background_task_message = "Refreshing capacity..."
-    background_task_running.set()
+    _set_background_task("Refreshing capacity...")
     try:
         print("Background capacity refresh worker started.")
         with app.app_context():
@@ -1192,38 +1847,37 @@ def _refresh_capacity_worker():
                 return
 
             fw_password = decrypt_message(encrypted_pass, key)
-            firewalls = conn.execute('SELECT id, ip_address FROM firewalls').fetchall()
+            firewalls = conn.execute('SELECT id, ip_address, sw_version, serial FROM firewalls WHERE collector IS NULL').fetchall()
             
             if not firewalls:
                 conn.close()
                 return
 
-            hosts_to_poll = [fw['ip_address'] for fw in firewalls]
-            init_tasks = [(host, fw_user, fw_password) for host in hosts_to_poll]
-            api_keys = {}
+            adv_routing = {row['firewall_id']: bool(row['advance_routing_enabled']) for row in conn.execute("SELECT firewall_id, advance_routing_enabled FROM firewall_details").fetchall()}
+
+            # --- Collection phase: keygen + ~12 API calls per firewall, concurrently, no lock held ---
             try:
-                with multiprocessing.Pool(processes=len(init_tasks)) as pool:
-                    for res in pool.map(get_api_key, init_tasks):
-                        if res['status'] == 'success':
-                            api_keys[res['host']] = res['api_key']
+                panorama = _shared_panorama_connection(settings, key)
+                tasks = [(fw['id'], fw['ip_address'], fw_user, fw_password, adv_routing.get(fw['id'], False), fw['sw_version'], *_device_access(fw, panorama)) for fw in firewalls]
+                collected = _collect_concurrently(_refresh_usage_task, tasks)
             except Exception as e:
                 print(f"Capacity Refresh Worker Error: {e}")
                 conn.close()
                 return
 
+            # --- Write phase: one short batched transaction ---
+            last_updated = datetime.now().isoformat(sep=' ', timespec='microseconds')
+            usage_rows = [
+                (firewall_id, last_updated, u.get('rules'), u.get('nat-rules'), u.get('address'), u.get('service'), u.get('ipsec'), u.get('routes', 0), u.get('mroutes'), u.get('arp'), u.get('bfd'), u.get('dns_cache'), u.get('registered_ips'), u.get('ssl_decrypt_sessions'))
+                for firewall_id, u in collected if u
+            ]
             with db_lock:
-                # ** FIX: Join with firewall_models to get all max capacity values in one go **
-                details_map = {row['firewall_id']: dict(row) for row in conn.execute("SELECT fd.*, fm.max_ssl_decrypt_sessions FROM firewall_details fd JOIN firewalls f ON f.id = fd.firewall_id LEFT JOIN firewall_models fm ON f.model = fm.model").fetchall()}
-                for fw in firewalls:
-                    if fw['ip_address'] in api_keys:
-                        usage_data = poll_current_usage(conn, fw['id'], fw['ip_address'], api_keys[fw['ip_address']])
-                        if usage_data:
-                            # ** FIX: Use the full, correct INSERT statement **
-                            conn.execute("""
-                                INSERT OR REPLACE INTO firewall_current_usage 
-                                (firewall_id, last_updated, current_rules, current_nat_rules, current_address_objects, current_service_objects, current_ipsec_tunnels, current_routes, current_mroutes, current_arp_entries, current_bfd_sessions, current_dns_cache, current_registered_ips, current_ssl_decrypt_sessions) 
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) 
-                            """, (fw['id'], datetime.now().isoformat(sep=' ', timespec='microseconds'), usage_data.get('rules'), usage_data.get('nat-rules'), usage_data.get('address'), usage_data.get('service'), usage_data.get('ipsec'), usage_data.get('routes', 0), usage_data.get('mroutes'), usage_data.get('arp'), usage_data.get('bfd'), usage_data.get('dns_cache'), usage_data.get('registered_ips'), usage_data.get('ssl_decrypt_sessions')))
+                existing = _begin_write(conn)
+                conn.executemany("""
+                    INSERT OR REPLACE INTO firewall_current_usage 
+                    (firewall_id, last_updated, current_rules, current_nat_rules, current_address_objects, current_service_objects, current_ipsec_tunnels, current_routes, current_mroutes, current_arp_entries, current_bfd_sessions, current_dns_cache, current_registered_ips, current_ssl_decrypt_sessions) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) 
+                """, [row for row in usage_rows if row[0] in existing])
                             
                 # After polling all firewalls, re-evaluate alerts with the latest data
                 alert_threshold = int(settings.get('ALERT_THRESHOLD', 80))
@@ -1231,11 +1885,10 @@ def _refresh_capacity_worker():
 
                 conn.commit()
             conn.close()
+            bump_data_version()
     finally:
         print("Background capacity refresh worker finished.")
-        with message_lock:
-            background_task_message = ""
-        background_task_running.clear()
+        _clear_background_task()
 
 @app.route('/refresh_capacity', methods=['POST'])
 def refresh_capacity():
@@ -1259,494 +1912,590 @@ def refresh_capacity():
     thread.start()
     return flask.redirect(flask.url_for('capacity_dashboard'))
 
+@app.route('/poller_stats')
+def poller_stats_json():
+    """Poller health counters (late/skipped polls, scheduling lag) as JSON."""
+    return flask.jsonify(get_poller_stats())
+
+def _top_devices_arg():
+    """?top=N devices for the collector pages: the default of 20 when not a number, at most 1000."""
+    return min(max(flask.request.args.get('top', 20, type=int), 0), 1000)
+
+@app.route('/internal/collector')
+def collector_internals():
+    """Collector instrumentation: where the poll cycle's time goes, by API command and by firewall."""
+    conn = get_db_connection()
+    firewalls_by_host = {row['ip_address']: row for row in conn.execute('SELECT id, ip_address, hostname FROM firewalls').fetchall()}
+    conn.close()
+    return flask.render_template('collector.html', stats=collector.snapshot(top_devices=_top_devices_arg()),
+                                 poller_stats=get_poller_stats(), firewalls_by_host=firewalls_by_host, group_labels=poll_scheduler.GROUP_LABELS,
+                                 poller_in_process=poller_in_process)
+
+@app.route('/internal/collector.json')
+def collector_internals_json():
+    """Collector instrumentation as JSON (?top=N devices, default 20)."""
+    return flask.jsonify(collector.snapshot(top_devices=_top_devices_arg()))
+
+@app.route('/internal/profiling', methods=['GET', 'POST'])
+def profiling():
+    """Request profiling: enable/disable, slow-query threshold, one-shot cProfile capture, and the results so far."""
+    if flask.request.method == 'POST':
+        action = flask.request.form.get('action')
+        if action == 'enable':
+            try:
+                profiler.slow_query_ms = float(flask.request.form.get('slow_query_ms', profiler.slow_query_ms))
+            except ValueError:
+                flask.flash("Slow query threshold must be a number of milliseconds.", "error")
+                return flask.redirect(flask.url_for('profiling'))
+            profiler.enabled = True
+            flask.flash(f"Request profiling enabled (slow query threshold {profiler.slow_query_ms:g} ms).", "success")
+        elif action == 'disable':
+            profiler.enabled = False
+            flask.flash("Request profiling disabled.", "success")
+        elif action == 'capture':
+            path = flask.request.form.get('path', '').strip()
+            profiler.enabled = True
+            profiler.arm_capture(path)
+            flask.flash(f"The next request to {path or 'any page'} will be run under cProfile.", "success")
+        elif action == 'clear':
+            profiler.clear()
+            flask.flash("Profiling results cleared.", "success")
+        return flask.redirect(flask.url_for('profiling'))
+
+    return flask.render_template('profiling.html', profiler=profiler, **profiler.results())
+
+@app.route('/metrics')
+def prometheus_exposition():
+    """Latest fleet metrics and collector statistics for Prometheus, as last published by the poller (never reads the database)."""
+    return Response(fleet_metrics.body, content_type=prometheus_metrics.CONTENT_TYPE)
+
+# --- NEW: Bulk ingest API for remote collectors (see remote_collector.py and remote_ingest.py) ---
+def _authenticate_remote_collector(conn):
+    return remote_ingest.authenticate(conn, flask.request.headers.get('Authorization'))
+
+@app.route('/api/collector/assignment')
+def remote_collector_assignment():
+    """The firewalls assigned to the calling remote collector and the polling settings it needs."""
+    conn = get_db_connection()
+    name = _authenticate_remote_collector(conn)
+    if name is None:
+        conn.close()
+        return {'error': 'Unknown collector token.'}, 401
+    settings = {row['key']: row['value'] for row in conn.execute("SELECT key, value FROM settings").fetchall()}
+    firewalls = [dict(row) for row in conn.execute('SELECT f.id, f.ip_address, f.hostname, f.model, f.sw_version, d.advance_routing_enabled FROM firewalls f LEFT JOIN firewall_details d ON d.firewall_id = f.id WHERE f.collector = ?', (name,)).fetchall()]
+    overrides = [tuple(row) for row in conn.execute('SELECT o.firewall_id, o.metric_group, o.interval_seconds FROM poll_interval_overrides o JOIN firewalls f ON f.id = o.firewall_id WHERE f.collector = ?', (name,)).fetchall()]
+    with db_lock:
+        remote_ingest.record_contact(conn, name, flask.request.remote_addr, time.time())
+        conn.commit()
+    conn.close()
+    return {'collector': name, 'firewalls': firewalls, 'intervals': poll_scheduler.group_intervals_from_settings(settings), 'overrides': overrides,
+            'throughput_source': settings.get('THROUGHPUT_SOURCE', 'physical'), 'manual_poll_requested_at': float(settings.get('MANUAL_POLL_REQUESTED_AT', 0))}
+
+@app.route('/api/ingest', methods=['POST'])
+def ingest_remote_results():
+    """
+    Accepts a batch of results pushed by a remote collector and queues it for the collector process
+    to write (see write_queued_remote_results), in one transaction. Results for firewalls not assigned
+    to that collector (reassigned or deleted meanwhile) are counted as rejected, results of a batch
+    already accepted (pushed again) as duplicate.
+    """
+    conn = get_db_connection()
+    name = _authenticate_remote_collector(conn)
+    if name is None:
+        conn.close()
+        return {'error': 'Unknown collector token.'}, 401
+    try:
+        batch, position = remote_ingest.decode_batch(flask.request.get_data(), flask.request.headers.get('Content-Encoding'))
+    except ValueError as e:
+        conn.close()
+        return {'error': str(e)}, 400
+    now = time.time()
+    # ** FIX: Only the collector process writes results, so without one they would pile up unwritten; the agent keeps them buffered instead **
+    if not collector_lease.any_alive(conn, now):
+        conn.close()
+        return {'error': 'No collector process is running to write the results (start collector.py, or app.py).'}, 503
+    with db_lock:
+        # Assignment is read inside the write transaction, so a firewall deleted or reassigned meanwhile is rejected
+        _begin_write(conn)
+        # ** FIX: A batch pushed again after its response was lost is only written once **
+        new = remote_ingest.undelivered(conn, name, batch, position)
+        assigned = {row['id'] for row in conn.execute('SELECT id FROM firewalls WHERE collector = ?', (name,)).fetchall()}
+        results = [res for res in new if res['firewall_id'] in assigned]
+        remote_ingest.enqueue(conn, results, now)
+        remote_ingest.record_contact(conn, name, flask.request.remote_addr, now, results=len(results))
+        conn.commit()
+    conn.close()
+    if results:
+        poller_wakeup.set()
+    return {'accepted': len(results), 'rejected': len(new) - len(results), 'duplicate': len(batch) - len(new)}
+
 @app.route('/trigger_poll', methods=['POST'])
 def trigger_poll():
-    """Sets an event to trigger the background poller immediately."""
-    if not background_task_running.is_set():
-        global background_task_message
-        with message_lock:
-            background_task_message = "Polling data..."
-        background_task_running.set()
-        manual_poll_event.set()
+    """Triggers an immediate poll: directly when the poller runs in this process, else through the database."""
+    # Collector processes and remote collectors pick the request up when they next reload their settings
+    conn = get_db_connection()
+    conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('MANUAL_POLL_REQUESTED_AT', ?)", (str(time.time()),))
+    conn.commit()
+    conn.close()
+    if poller_in_process:
+        if not background_task_running.is_set():
+            _set_background_task("Polling data...")
+            manual_poll_event.set()
+            poller_wakeup.set()
+    else:
+        flask.flash(f"Poll requested. The collector will start it within {poll_loop.SCHEDULER_MAX_SLEEP} seconds.", "success")
     return flask.redirect(flask.url_for('index'))
 
-def poll_current_usage(conn, firewall_id, host, api_key):
-    """Polls a single firewall for its current object counts."""
-    commands = {
-        'config': {
-            'rules': "/config/devices/entry[@name='localhost.localdomain']/vsys/entry/rulebase/security/rules",
-            'nat-rules': "/config/devices/entry[@name='localhost.localdomain']/vsys/entry/rulebase/nat/rules",
-            'address': "/config/devices/entry[@name='localhost.localdomain']/vsys/entry/address",
-            'service': "/config/devices/entry[@name='localhost.localdomain']/vsys/entry/service",
-            'ipsec': "/config/devices/entry[@name='localhost.localdomain']/network/tunnel/ipsec"
-        },
-        'op': {
-            'arp': ("<show><arp><entry name='all'/></arp></show>", './/entries/entry'),
-            'dns_cache': ("<show><dns-proxy><cache><all/></cache></dns-proxy></show>", './/entry'),
-            'registered_ips': ("<show><user><ip-user-mapping><all></all></ip-user-mapping></user></show>", './/entry'),
-            'ssl_decrypt_sessions': ("<show><session><all><filter><ssl-decrypt>yes</ssl-decrypt><count>yes</count></filter></all></session></show>", './/result')
-        }
-    }
-    usage_data = {}
-    # Poll config-based stats
-    for key, xpath in commands['config'].items():
-        try:
-            params = {'type': 'config', 'action': 'get', 'key': api_key, 'xpath': xpath}
-            response = requests.get(f"https://{host}/api/", params=params, verify=False, timeout=10)
-            response.raise_for_status()
-            root = ET.fromstring(response.content)
-            entries = root.findall('.//entry')
-            usage_data[key] = len(entries)
-        except Exception as e:
-            print(f"Error polling config stat '{key}' for {host}: {e}")
-            usage_data[key] = None # Mark as None on error
-
-    # ** NEW: Conditional route polling **
-    try:
-        adv_routing_row = conn.execute("SELECT advance_routing_enabled FROM firewall_details WHERE firewall_id = ?", (firewall_id,)).fetchone()
-        adv_routing_enabled = adv_routing_row['advance_routing_enabled'] if adv_routing_row else False
-
-        if adv_routing_enabled:
-            # Use advanced routing command
-            cmd = '<show><advanced-routing><route></route></advanced-routing></show>'
-            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
-            response = requests.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
-            response.raise_for_status()
-            root = ET.fromstring(response.content)
-            json_text = root.findtext('.//result/json')
-            if json_text:
-                import json
-                route_data = json.loads(json_text)
-                total_routes = sum(len(route_list) for vrf in route_data.values() for route_list in vrf.values())
-                usage_data['routes'] = total_routes
-        else:
-            # Use standard routing command
-            cmd = '<show><routing><route></route></routing></show>'
-            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
-            response = requests.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
-            response.raise_for_status()
-            root = ET.fromstring(response.content)
-            usage_data['routes'] = len(root.findall('.//routing-table/ip/entry'))
-    except Exception as e:
-        print(f"Error polling route stat for {host}: {e}")
-        usage_data['routes'] = None
+# --- Background Polling Logic ---
+def store_fw_details(conn, firewall_id, parsed_data):
+    """Writes parsed capacity specs for one firewall. The caller holds db_lock and commits."""
+    if parsed_data:
+        columns, values = zip(*parsed_data.items())
+        conn.execute(f"INSERT OR REPLACE INTO firewall_details (firewall_id, {', '.join(columns)}) VALUES (?, {', '.join(['?'] * len(values))})", (firewall_id, *values))
 
-    # ** NEW: Conditional multicast route polling **
-    try:
-        # We can reuse the adv_routing_enabled flag from the previous check
-        if adv_routing_enabled:
-            # Use advanced routing command for multicast
-            cmd = '<show><advanced-routing><multicast><route></route></multicast></advanced-routing></show>'
-            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
-            response = requests.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
-            response.raise_for_status()
-            root = ET.fromstring(response.content)
-            json_text = root.findtext('.//result/json')
-            if json_text:
-                import json
-                mroute_data = json.loads(json_text)
-                # The structure is likely similar to unicast, so we sum the lengths of the route lists
-                total_mroutes = sum(len(route_list) for vrf in mroute_data.values() for route_list in vrf.values())
-                usage_data['mroutes'] = total_mroutes
-        else:
-            # Use standard multicast routing command
-            cmd = '<show><routing><multicast><route/></multicast></routing></show>'
-            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
-            response = requests.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
-            response.raise_for_status()
-            root = ET.fromstring(response.content)
-            # This command returns a CDATA block, so we count the lines.
-            cdata_text = root.findtext('.//result')
-            # Subtract 1 for the "Flags:" header line.
-            usage_data['mroutes'] = max(0, len(cdata_text.strip().split('\n')) - 1) if cdata_text else 0
-    except Exception as e:
-        print(f"Error polling multicast route stat for {host}: {e}")
-        usage_data['mroutes'] = None
+def _ingest_samples(conn, samples, timestamp_str, alert_engine=None, session_capacity=None, sample_time=None):
+    """
+    Writes one poll cycle of (firewall_id, data) samples to the stats table. When an alert engine is
+    given, each sample is also evaluated against its streaming threshold rules as it is ingested, at
+    `sample_time` (epoch seconds the samples were taken; now by default).
+    """
+    now = time.time() if sample_time is None else sample_time
+    rows = []
+    for firewall_id, s in samples:
+        if s['total_input_bps'] > 0 or s['total_output_bps'] > 0 or s['active_sessions'] > 0:
+            rows.append((firewall_id, timestamp_str, s['active_sessions'], s['ssl_decrypt_sessions'], s['total_input_bps'], s['total_output_bps'], s['cpu_load'], s['dataplane_load'], s['memory_utilization']))
+        if alert_engine is not None:
+            max_sessions = session_capacity.get(firewall_id) if session_capacity else None
+            metrics = dict(s, session_utilization=(s['active_sessions'] * 100 / max_sessions) if max_sessions else None)
+            for rule, value in alert_engine.evaluate(firewall_id, now, metrics):
+                conn.execute("""
+                    INSERT INTO alerts (firewall_id, metric_name, utilization, timestamp) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (firewall_id, metric_name) WHERE acknowledged = 0 DO UPDATE SET utilization = excluded.utilization
+                """, (firewall_id, rule.name, value, datetime.now().isoformat()))
+                print(f"Alert: {rule.name} at {value:.1f}% on firewall {firewall_id} (>= {rule.threshold}% for {rule.duration}s).")
+    conn.executemany(
+        'INSERT INTO stats (firewall_id, timestamp, active_sessions, ssl_decrypt_sessions, total_input_bps, total_output_bps, cpu_load, dataplane_load, memory_utilization) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows
+    )
+    # ** NEW: Fold the samples into their hour's peaks (late samples from remote collectors land in their own hour) **
+    conn.executemany("""
+        INSERT INTO stats_hourly (firewall_id, hour, max_sessions, max_throughput_bps) VALUES (?, ?, ?, ?)
+        ON CONFLICT (firewall_id, hour) DO UPDATE SET max_sessions = MAX(max_sessions, excluded.max_sessions),
+                                                      max_throughput_bps = MAX(max_throughput_bps, excluded.max_throughput_bps)
+    """, [(row[0], timestamp_str[:13] + ':00:00', row[2], max(row[4], row[5])) for row in rows])
+
+# Stats retention and the alert archive are applied this often, rather than with every batch of results
+HISTORY_PRUNE_INTERVAL = 3600
+_last_history_prune = 0.0
+_history_prune_lock = threading.Lock()
+
+def _prune_history_if_due(conn, settings, now):
+    """Deletes stats and hourly peaks past retention and archives old acknowledged alerts, at most once per HISTORY_PRUNE_INTERVAL."""
+    global _last_history_prune
+    with _history_prune_lock:
+        if now - _last_history_prune < HISTORY_PRUNE_INTERVAL:
+            return
+        _last_history_prune = now
+    retention_days = int(settings.get('DATA_RETENTION_DAYS', 90))
+    # --- NEW: Prune old statistics ---
+    prune_query = f"DELETE FROM stats WHERE timestamp < datetime('now', '-{retention_days} days')"
+    cursor = conn.execute(prune_query)
+    if cursor.rowcount > 0: print(f"Pruned {cursor.rowcount} old stat records (older than {retention_days} days).")
+    conn.execute(f"DELETE FROM stats_hourly WHERE hour < datetime('now', '-{retention_days} days')")
+    _archive_acknowledged_alerts(conn, int(settings.get('ALERT_ARCHIVE_DAYS', 30)))
+
+class ResultPublisher:
+    """
+    Rate-limits what follows a write of poll results to once per poll interval, however often results
+    are written: the data-version bump (which discards every cached page, in every process) and the
+    dashboard update for live SSE clients (a fleet-wide query). Shared by the poller and the ingest API.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.published_at = 0.0
+        self.pending = False
+
+    def written(self, now, interval, force=False):
+        """Records a committed write of results, and publishes if the interval has passed (or `force`)."""
+        with self._lock:
+            self.pending = True
+        return self.flush(now, interval, force)
+
+    def flush(self, now, interval, force=False):
+        """Publishes pending changes once `interval` seconds have passed since the last publish (or `force`)."""
+        with self._lock:
+            if not self.pending or (not force and now - self.published_at < interval):
+                return False
+            self.pending = False
+            self.published_at = now
+        bump_data_version()
+        if poller_in_process:
+            # Web workers without the poller publish to their own clients when they see the version change
+            conn = get_db_connection()
+            try:
+                _publish_dashboard_changes(conn)
+            finally:
+                conn.close()
+        return True
 
-    # ** FIX: Re-introduce conditional BFD session polling **
-    try:
-        fw_row = conn.execute("SELECT sw_version FROM firewalls WHERE id = ?", (firewall_id,)).fetchone()
-        sw_version_str = fw_row['sw_version'] if fw_row else '0.0.0'
-        major_version = int(sw_version_str.split('.')[0])
+    def due_at(self, interval):
+        """When pending changes will be published, or None if there are none."""
+        with self._lock:
+            return self.published_at + interval if self.pending else None
 
-        if major_version >= 11:
-            if adv_routing_enabled:
-                bfd_cmd = '<show><advanced-routing><bfd><summary/></bfd></advanced-routing></show>'
-            else:
-                bfd_cmd = '<show><routing><bfd><summary/></bfd></routing></show>'
-            
-            params = {'type': 'op', 'cmd': bfd_cmd, 'key': api_key}
-            response = requests.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
-            response.raise_for_status()
-            root = ET.fromstring(response.content)
-            usage_data['bfd'] = len(root.findall('.//result/entry'))
-        else:
-            # BFD summary command not supported on older versions
-            usage_data['bfd'] = 0
-    except Exception as e:
-        print(f"Error polling BFD stat for {host}: {e}")
-        usage_data['bfd'] = None
-    
-    # Poll op-based stats
-    for key, (cmd, find_path) in commands['op'].items():
-        try:
-            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
-            if key == 'dns_cache':
-                # Special handling for DNS cache command which returns text
-                response = requests.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
-                response.raise_for_status()
-                root = ET.fromstring(response.content)
-                total_dns_entries = 0
-                # The result is a series of <msg> tags, not structured XML entries
-                for msg_tag in root.findall('.//result/msg'):
-                    if msg_tag.text and msg_tag.text.strip().startswith('entries:'):
-                        parts = msg_tag.text.strip().split(':')
-                        if len(parts) > 1 and parts[1].strip().isdigit():
-                            total_dns_entries += int(parts[1].strip())
-                usage_data[key] = total_dns_entries
-            elif key == 'ssl_decrypt_sessions':
-                # Special handling for SSL decrypt count which returns a CDATA block
-                response = requests.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
-                response.raise_for_status()
-                root = ET.fromstring(response.content)
-                cdata_text = root.findtext(find_path)
-                count = 0
-                if cdata_text and 'Number of sessions that match filter:' in cdata_text:
-                    parts = cdata_text.split(':')
-                    if len(parts) > 1 and parts[1].strip().isdigit():
-                        count = int(parts[1].strip())
-                usage_data[key] = count
-            else:
-                response = requests.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
-                response.raise_for_status()
-                root = ET.fromstring(response.content)
-                entries = root.findall(find_path)
-                usage_data[key] = len(entries)
-        except Exception as e:
-            print(f"Error polling op stat '{key}' for {host}: {e}")
-            usage_data[key] = None
-    return usage_data
+result_publisher = ResultPublisher()
 
-# --- Background Polling Logic ---
-def get_api_key(args):
-    host, user, password = args
-    base_url = f"https://{host}/api/"
-    api_params = {'type': 'keygen', 'user': user, 'password': password}
-    try:
-        response = requests.get(base_url, params=api_params, verify=False, timeout=10)
-        response.raise_for_status()
-        tree = ET.fromstring(response.content)
-        key_element = tree.find('.//key')
-        if key_element is not None and key_element.text: return {'status': 'success', 'host': host, 'api_key': key_element.text}
-        else:
-            error_msg = tree.findtext('.//line') or "Authentication failed"
-            return {'status': 'error', 'host': host, 'error_message': error_msg}
-    except requests.exceptions.RequestException as e:
-        return {'status': 'error', 'host': host, 'error_message': str(e)}
-
-def parse_and_store_fw_details(conn, firewall_id, api_key):
-    """Fetches, parses, and stores detailed firewall capacity specs."""
-    host = conn.execute('SELECT ip_address FROM firewalls WHERE id = ?', (firewall_id,)).fetchone()['ip_address']
-    cmd = "<show><system><state><filter>cfg.general.*</filter></state></system></show>"
+class PollResultWriter:
+    """
+    Writes batches of collection results to the database: firewall status and discovery, capacity
+    details and usage, stats samples (evaluated against the streaming alert rules) and interface
+    rates, plus the pruning and rollups that go with them. The poller writes its own results with
+    one, and those remote collectors push (queued by the ingest API) with another. Does not commit.
+    """
+    def __init__(self):
+        self.alert_engine = alert_rules.StreamingAlertEngine()
+        self.interface_dictionary = interface_stats.InterfaceDictionary()
+        self.latest_metrics = {}  # firewall_id -> latest values of every fast-path group, carried into each stats sample
+        self.last_interface_rollup = None
+        self.rollup_since = None  # Oldest interface sample written since the last rollup
+
+    def forget(self, firewall_id):
+        self.alert_engine.forget(firewall_id)
+        self.interface_dictionary.forget(firewall_id)
+        self.latest_metrics.pop(firewall_id, None)
+
+    def write(self, conn, results, settings, now, session_capacity=None):
+        """
+        Writes [{'firewall_id', 'status', 'groups'}] results, status being 'success', 'error' or
+        'unreachable'. Results with a 'timestamp' (remote collectors) are stored at that time, the
+        others at `now`. Returns True when capacity data changed (alerts have been re-evaluated).
+        """
+        retention_days = int(settings.get('DATA_RETENTION_DAYS', 90))
+        capacity_changed = False
+        samples = {}             # (epoch seconds, timestamp string) -> [(firewall_id, data)]
+        interface_samples = {}   # epoch second -> [(firewall_id, rates)]
+        usage_rows = []
+        status_rows = []
+        for res in results:
+            firewall_id = res['firewall_id']
+            ts = res.get('timestamp', now)
+            # Explicitly format the datetime object to a string to avoid DeprecationWarning in Python 3.12+
+            timestamp_str = datetime.fromtimestamp(ts).isoformat(sep=' ', timespec='microseconds')
+            groups = res['groups']
+            status_rows.append((timestamp_str, res['status'], firewall_id))
+
+            info = groups.get('system_info')
+            if info and info['model'] and info['hostname'] and info['sw_version']:
+                conn.execute('UPDATE firewalls SET model = ?, hostname = ?, sw_version = ? WHERE id = ?', (info['model'], info['hostname'], info['sw_version'], firewall_id))
+                if info['advance_routing_enabled'] is not None:
+                    # Capability used by capacity polling; kept current between daily details refreshes
+                    conn.execute("INSERT INTO firewall_details (firewall_id, advance_routing_enabled) VALUES (?, ?) ON CONFLICT (firewall_id) DO UPDATE SET advance_routing_enabled = excluded.advance_routing_enabled", (firewall_id, info['advance_routing_enabled']))
+            if groups.get('details'):
+                store_fw_details(conn, firewall_id, groups['details'])
+                capacity_changed = True
+            u = groups.get('capacity')
+            if u:
+                usage_rows.append((firewall_id, timestamp_str, u.get('rules'), u.get('nat-rules'), u.get('address'), u.get('service'), u.get('ipsec'), u.get('routes', 0), u.get('mroutes'), u.get('arp'), u.get('bfd'), u.get('dns_cache'), u.get('registered_ips'), u.get('ssl_decrypt_sessions')))
+
+            if 'throughput_sessions' in groups:
+                interface_samples.setdefault(int(ts), []).append((firewall_id, groups['throughput_sessions'].pop('interfaces', None)))
+
+            # Slower fast-path groups (CPU, SSL) are carried forward into each throughput sample
+            metrics = self.latest_metrics.setdefault(firewall_id, {'active_sessions': 0, 'ssl_decrypt_sessions': 0, 'total_input_bps': 0.0, 'total_output_bps': 0.0, 'cpu_load': 0.0, 'dataplane_load': 0.0, 'memory_utilization': 0.0})
+            for group in poll_scheduler.FAST_GROUPS:
+                if group in groups:
+                    metrics.update(groups[group])
+            if 'throughput_sessions' in groups:
+                samples.setdefault((ts, timestamp_str), []).append((firewall_id, dict(metrics)))
+
+        conn.executemany('UPDATE firewalls SET last_checked = ?, status = ? WHERE id = ?', status_rows)
+        if usage_rows:
+            conn.executemany("""
+                INSERT OR REPLACE INTO firewall_current_usage 
+                (firewall_id, last_updated, current_rules, current_nat_rules, current_address_objects, current_service_objects, current_ipsec_tunnels, current_routes, current_mroutes, current_arp_entries, current_bfd_sessions, current_dns_cache, current_registered_ips, current_ssl_decrypt_sessions) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) 
+            """, usage_rows)
+            capacity_changed = True
+        if capacity_changed:
+            _re_evaluate_alerts(conn, int(settings.get('ALERT_THRESHOLD', 80)))
+
+        if samples:
+            # ** FIX: Rules see samples in the order, and at the time, they were taken (remote batches arrive late and all at once) **
+            for (ts, timestamp_str), batch in sorted(samples.items(), key=lambda item: item[0][0]):
+                _ingest_samples(conn, batch, timestamp_str, alert_engine=self.alert_engine, session_capacity=session_capacity, sample_time=ts)
+
+            _prune_history_if_due(conn, settings, now)
+
+        # ** NEW: Per-interface rates, their rollups (every 5 minutes) and retention **
+        if sum([interface_stats.ingest(conn, self.interface_dictionary, batch, ts) for ts, batch in interface_samples.items()]):
+            # ** FIX: Remote collectors' samples keep their collection time; buckets already rolled up are re-rolled for them **
+            oldest = min(interface_samples)
+            self.rollup_since = oldest if self.rollup_since is None else min(self.rollup_since, oldest)
+            rollup_bucket = int(now) // interface_stats.ROLLUP_SECONDS
+            if rollup_bucket != self.last_interface_rollup:
+                self.last_interface_rollup = rollup_bucket
+                interface_stats.rollup(conn, now, since=self.rollup_since)
+                self.rollup_since = None
+                interface_stats.prune(conn, int(settings.get('INTERFACE_RAW_RETENTION_DAYS', 1)), retention_days, now)
+        return capacity_changed
+
+# Writes the results remote collectors push to /api/ingest, in the collector process
+remote_result_writer = PollResultWriter()
+
+def write_queued_remote_results(settings, now, shards, held):
+    """
+    Writes the results queued by /api/ingest for the firewalls of the `held` shards, oldest first,
+    with remote_result_writer. Results of firewalls no longer assigned to a remote collector are
+    dropped. Returns (results written, whether more are queued).
+    """
+    conn = get_db_connection()
     try:
-        response = requests.get(f"https://{host}/api/?type=op&cmd={cmd}&key={api_key}", verify=False, timeout=15)
-        response.raise_for_status()
-        root = ET.fromstring(response.content)
-        cdata = root.find('.//result').text
-
-        if not cdata: return
-
-        # Map raw config names to database column names
-        spec_map = {
-            'cfg.general.max-session': 'max_sessions',
-            'cfg.general.max-policy-rule': 'max_rules',
-            'cfg.general.max-nat-policy-rule': 'max_nat_rules',
-            'cfg.general.max-ssl-policy-rule': 'max_ssl_decrypt_rules',
-            'cfg.general.max-qos-policy-rule': 'max_qos_rules',
-            'cfg.general.max-pbf-policy-rule': 'max_pbf_rules',
-            'cfg.general.max-dos-policy-rule': 'max_dos_rules',
-            'cfg.general.max-zone': 'max_zones',
-            'cfg.general.max-vsys': 'max_vsys',
-            'cfg.general.max-vrouter': 'max_virtual_routers',
-            'cfg.general.max-vlan': 'max_vlans',
-            'cfg.general.max-ike-peers': 'max_ike_peers',
-            'cfg.general.max-tunnel': 'max_ipsec_tunnels',
-            'cfg.general.advance-routing-enabled': 'advance_routing_enabled',
-            'cfg.general.max-ssl-tunnel': 'max_ssl_tunnels',
-            'cfg.general.max-address-per-group': 'max_addr_per_group',
-            'cfg.general.max-cert-cache-entries': 'max_cert_cache',
-            'cfg.general.max-dns-cache': 'max_dns_cache',
-            'cfg.general.max-ip6addrtbl': 'max_ipv6_addrs',
-            'cfg.general.max-mac': 'max_mac_addrs',
-            'cfg.general.max-profile': 'max_security_profiles',
-            'cfg.general.max-url-pattern': 'max_url_patterns',
-            'cfg.general.max-vwire': 'max_vwires',
-            'cfg.general.max-hip': 'max_hip_objects',
-            'cfg.general.max-blacklist': 'max_custom_signatures',
-            'cfg.general.max-ifnet': 'max_interfaces',
-            'cfg.general.max-bfd-session': 'max_bfd_sessions',
-            'cfg.general.max-sdwan-policy-rule': 'max_sdwan_rules',
-            'cfg.general.max-mroute': 'max_mroutes',
-            'cfg.general.max-schedule': 'max_schedules',
-            'cfg.general.max-edl-objs': 'max_edl_objects',
-            'cfg.general.max-registered-ip-address': 'max_registered_ips',
-            'cfg.general.max-tsagents': 'max_ts_agents',
-            'cfg.general.max-proxy-session': 'max_proxy_sessions',
-            'cfg.general.max-auth-policy-rule': 'max_auth_rules',
-            'cfg.general.max-address': 'max_address_objects',
-            'cfg.general.max-address-group': 'max_address_groups',
-            'cfg.general.max-service': 'max_service_objects',
-            'cfg.general.max-service-group': 'max_service_groups',
-            'cfg.general.max-route': 'max_routes',
-            'cfg.general.max-arp': 'max_arp_entries'
-        }
-        
-        parsed_data = {}
-        for line in cdata.strip().split('\n'):
-            key, value = line.split(':', 1)
-            key = key.strip()
-            if key in spec_map:
-                db_column = spec_map[key]
-                val_str = value.strip()
-                try:
-                    if val_str.lower() == 'true':
-                        parsed_data[db_column] = 1
-                    elif val_str.lower() == 'false':
-                        parsed_data[db_column] = 0
-                    else:
-                        parsed_data[db_column] = int(val_str, 16) if val_str.startswith('0x') else int(val_str)
-                except (ValueError, TypeError):
-                    pass # Ignore values that can't be converted to an integer (like 'True' or lists)
-
-        if parsed_data:
-            columns, values = zip(*parsed_data.items())
-            conn.execute(f"INSERT OR REPLACE INTO firewall_details (firewall_id, {', '.join(columns)}) VALUES (?, {', '.join(['?'] * len(values))})", (firewall_id, *values))
-    except Exception as e:
-        print(f"Could not fetch/parse details for {host}: {e}")
+        if not held or not remote_ingest.has_queued(conn):
+            return 0, False
+        specs_map = load_specs_from_db(conn)
+        write_start = time.perf_counter()
+        with db_lock:
+            _begin_write(conn)
+            queued, more = remote_ingest.take_queued(conn, shards, held)
+            assigned = {row['id']: row['model'] for row in conn.execute('SELECT id, model FROM firewalls WHERE collector IS NOT NULL').fetchall()}
+            results = [res for res in queued if res['firewall_id'] in assigned]
+            session_capacity = {fw_id: specs_map[model]['max_sessions'] for fw_id, model in assigned.items() if model in specs_map}
+            try:
+                remote_result_writer.write(conn, results, settings, now, session_capacity=session_capacity)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                # One malformed result must not hold up the queue: the batch is written again one result at a time without it
+                conn.rollback()
+                print(f"Worker: Malformed result pushed by a remote collector ({e!r}); writing the batch one result at a time.")
+                _begin_write(conn)
+                queued, more = remote_ingest.take_queued(conn, shards, held)
+                results = []
+                for res in queued:
+                    if res['firewall_id'] not in assigned:
+                        continue
+                    conn.execute('SAVEPOINT remote_result')
+                    try:
+                        remote_result_writer.write(conn, [res], settings, now, session_capacity=session_capacity)
+                        results.append(res)
+                    except (KeyError, TypeError, ValueError, AttributeError) as e:
+                        conn.execute('ROLLBACK TO remote_result')
+                        print(f"Worker: Dropped a malformed result for firewall {res['firewall_id']}: {e!r}")
+                    conn.execute('RELEASE remote_result')
+            conn.commit()
+        collector.record_db_write(time.perf_counter() - write_start, len(results))
+        return len(results), more
+    finally:
+        conn.close()
+
+def save_counter_states(conn, states):
+    """Persists [(firewall_id, {'counters': ..., 'timestamp': ...})] counter snapshots, one compact JSON row per firewall."""
+    conn.executemany('INSERT OR REPLACE INTO counter_state (firewall_id, timestamp, counters) VALUES (?, ?, ?)',
+                     [(firewall_id, state['timestamp'], json.dumps(state['counters'], separators=(',', ':'))) for firewall_id, state in states])
+
+def load_counter_states(conn, max_age=None):
+    """
+    Returns {firewall_id: {'counters': ..., 'timestamp': ...}} for monitored firewalls, skipping
+    snapshots older than max_age seconds (rates across a long outage would just be an average of it).
+    """
+    max_age = COUNTER_STATE_MAX_AGE if max_age is None else max_age
+    rows = conn.execute('SELECT c.firewall_id, c.timestamp, c.counters FROM counter_state c JOIN firewalls f ON f.id = c.firewall_id WHERE c.timestamp >= ?',
+                        (time.time() - max_age,)).fetchall()
+    return {row[0]: {'counters': {name: tuple(values) for name, values in json.loads(row[2]).items()}, 'timestamp': row[1]} for row in rows}
 
-def poll_single_firewall(args):
-    """Worker function to poll metrics from a single firewall."""
-    host, api_key, previous_state = args
+def release_collector_leases():
+    """Hands this process's collector leases over at once on shutdown, instead of letting them expire."""
+    conn = get_db_connection()
     try:
-        # API Calls
-        session_xml = requests.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><session><info/></session></show>", verify=False, timeout=15).content
-        if_counter_xml = requests.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><counter><interface>all</interface></counter></show>", verify=False, timeout=15).content
-        mem_xml = requests.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><system><resources/></system></show>", verify=False, timeout=15).content
-        # ** NEW: Use the 'minute last 1' command for Dataplane CPU **
-        cpu_dp_xml = requests.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><running><resource-monitor><minute><last>1</last></minute></resource-monitor></running></show>", verify=False, timeout=15).content
-        ssl_decrypt_xml = requests.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><session><all><filter><ssl-decrypt>yes</ssl-decrypt></filter></all></session></show>", verify=False, timeout=15).content
-        
-        # Process Session info
-        session_tree = ET.fromstring(session_xml)
-        active_sessions = int(session_tree.find('.//num-active').text or 0)
-        
-        # Process SSL Decrypt Session info by counting entries
-        ssl_decrypt_tree = ET.fromstring(ssl_decrypt_xml)
-        ssl_decrypt_sessions = len(ssl_decrypt_tree.findall('.//result/entry'))
-
-        # --- NEW: Initialize variables ---
-        memory_utilization = 0.0
-        cpu_load = 0.0
-        dataplane_load = 0.0
-
-        # --- NEW: Get Management CPU from 'show system resources' ---
-        cdata = ET.fromstring(mem_xml).findtext('.//result')
-        if cdata:
-            # ** NEW: Use regex to reliably parse the 'us' value for Management CPU **
-            # This regex is designed to be flexible with spacing and capture the user space CPU percentage.
-            match = re.search(r"%Cpu\(s\):\s+([\d\.]+) us", cdata)
-            if match:
-                try:
-                    cpu_load = float(match.group(1))
-                except (ValueError, IndexError):
-                    pass # Could not parse CPU value
-
-        cdata = ET.fromstring(mem_xml).findtext('.//result')
-
-        # --- NEW: Parse memory from 'show system resources' (top) output ---
-        if cdata:
-            # Find the memory line, which can start with "KiB Mem" or "MiB Mem"
-            mem_line = next((line for line in cdata.split('\n') if 'KiB Mem' in line or 'MiB Mem' in line), None)
-            if mem_line:
-                parts = mem_line.split()
-                try:
-                    # Find 'total' and 'used' values by index
-                    total_mem_index = parts.index('total,') - 1
-                    used_mem_index = parts.index('used,') - 1
-                    total_mem = float(parts[total_mem_index])
-                    used_mem = float(parts[used_mem_index])
-                    if total_mem > 0:
-                        memory_utilization = (used_mem / total_mem) * 100
-                except (ValueError, IndexError):
-                    pass # Could not parse memory line
-
-        # --- NEW: Get Dataplane CPU from 'show running resource-monitor' ---
-        core_loads = []
-        data_processors_node = ET.fromstring(cpu_dp_xml).find('.//data-processors')
-        if data_processors_node is not None:
-            for dp_node in data_processors_node:
-                # The command gives us the <minute> block directly.
-                # We parse the cpu-load-average from it.
-                cpu_avg_node = dp_node.find('.//minute/cpu-load-average')
-                if cpu_avg_node is not None:
-                    for core_entry in cpu_avg_node.findall('entry'):
-                        value_str = core_entry.findtext('value')
-                        if value_str:
-                            # The value should be a single integer representing the average.
-                            core_loads.append(int(value_str))
-
-        if core_loads:
-            # DP load is the average across all cores
-            dataplane_load = sum(core_loads) / len(core_loads)
-
-        # Process Throughput info
-        current_timestamp = time.time()
-        current_counters = {entry.find('name').text: {'ibytes': int(entry.find('ibytes').text), 'obytes': int(entry.find('obytes').text)} for entry in ET.fromstring(if_counter_xml).findall('.//entry')}
-        total_in_bps, total_out_bps = 0.0, 0.0
-        if previous_state and previous_state['counters']:
-            time_delta = current_timestamp - previous_state['timestamp']
-            for if_name, counters in current_counters.items():
-                if if_name in previous_state['counters'] and time_delta > 0:
-                    prev = previous_state['counters'][if_name]
-                    total_in_bps += ((counters['ibytes'] - prev['ibytes']) * 8) / time_delta
-                    total_out_bps += ((counters['obytes'] - prev['obytes']) * 8) / time_delta
-        
-        return {
-            "status": "success", "host": host,
-            "data": { 
-                "active_sessions": active_sessions, 
-                "ssl_decrypt_sessions": ssl_decrypt_sessions,
-                "total_input_bps": total_in_bps, 
-                "total_output_bps": total_out_bps,
-                "cpu_load": cpu_load,
-                "dataplane_load": dataplane_load,
-                "memory_utilization": memory_utilization
-            },
-            "new_state": {'counters': current_counters, 'timestamp': current_timestamp}
-        }
-    except Exception as e:
-        print(f"Polling error for {host}: {e}")
-        return {"status": "error", "host": host, "new_state": previous_state}
+        collector_leases.release(conn)
+    finally:
+        conn.close()
 
 def background_worker_loop():
+    """
+    Scheduler loop: polls the firewalls of the shards this collector holds through a poll_loop.PollLoop
+    and writes the finished polls to the database in batches.
+    """
+    global poller_in_process
+    poller_in_process = True
     print("🚀 Background worker started.")
-    firewall_states = {} 
+    loop = poll_loop.PollLoop(stats=poller_stats, wakeup=poller_wakeup)
+    # ** NEW: Restore the last counter snapshots so the first cycle after a restart has valid rates **
+    conn = get_db_connection()
+    loop.firewall_states = load_counter_states(conn)
+    conn.close()
+    if loop.firewall_states:
+        print(f"Restored interface counter state for {len(loop.firewall_states)} firewall(s).")
+    result_writer = PollResultWriter()
+    manual_poll_pending = set()
+    settings = {}
+    config_loaded_at = 0.0
+    last_flush = 0.0
+    poll_interval = 30   # Dashboard changes are published at most this often
+    panorama = None          # Shared Panorama connection in 'panorama' collection mode
+    panorama_unavailable = False  # 'panorama' mode but no connection: firewalls collected through it are not polled
     key = load_key()
-    while True:
-        # --- SETUP FOR POLLING CYCLE ---
-        conn = get_db_connection()
-        settings_rows = conn.execute("SELECT key, value FROM settings").fetchall()
-        settings = {row['key']: row['value'] for row in settings_rows}
-        fw_user = settings.get('FW_USER')
-        encrypted_pass = settings.get('FW_PASSWORD')
-        poll_interval = int(settings.get('POLL_INTERVAL', 30))
-        retention_days = int(settings.get('DATA_RETENTION_DAYS', 90))
+    # Manual polls requested through the database by web workers in other processes (see trigger_poll)
+    manual_poll_handled_at = time.time()
+    announced_shards = None  # Shards this collector last reported holding
+    remote_written_at = 0.0
+    remote_backlog = False   # More queued remote results than one write takes
+    loop.access = lambda fw: _device_access(fw, panorama)
 
-        if not fw_user or not encrypted_pass:
-            print("Worker: Credentials not set in database. Waiting...")
-            conn.close()
-            time.sleep(poll_interval)
-            continue
-            
-        fw_password = decrypt_message(encrypted_pass, key)
-        firewalls = conn.execute('SELECT id, ip_address, hostname, model, sw_version FROM firewalls').fetchall()
-        hosts_to_poll = [fw['ip_address'] for fw in firewalls]
+    def skip_panorama_firewall(firewall_id):
+        return panorama_unavailable and bool(loop.firewalls[firewall_id]['serial'])
 
-        if not hosts_to_poll:
-            print("Worker: No firewalls in DB to poll. Waiting...")
+    while True:
+        now = time.time()
+        manual_poll = manual_poll_event.is_set()
+        if manual_poll:
+            manual_poll_event.clear()
+
+        # --- RELOAD SETTINGS AND FIREWALLS (every SCHEDULER_MAX_SLEEP seconds) ---
+        if manual_poll or now - config_loaded_at >= poll_loop.SCHEDULER_MAX_SLEEP:
+            config_loaded_at = now
+            conn = get_db_connection()
+            settings = {row['key']: row['value'] for row in conn.execute("SELECT key, value FROM settings").fetchall()}
+            if float(settings.get('MANUAL_POLL_REQUESTED_AT', 0)) > manual_poll_handled_at:
+                manual_poll = True
+            poll_interval = int(settings.get('POLL_INTERVAL', 30))
+            fw_user = settings.get('FW_USER')
+            encrypted_pass = settings.get('FW_PASSWORD')
+            previous_firewalls = loop.firewalls
+            # Firewalls assigned to a remote collector are polled by it, not here
+            firewalls = {fw['id']: fw for fw in conn.execute('SELECT f.id, f.ip_address, f.hostname, f.model, f.sw_version, f.serial, d.advance_routing_enabled FROM firewalls f LEFT JOIN firewall_details d ON d.firewall_id = f.id WHERE f.collector IS NULL').fetchall()}
+            overrides = {(row['firewall_id'], row['metric_group']): row['interval_seconds'] for row in conn.execute("SELECT firewall_id, metric_group, interval_seconds FROM poll_interval_overrides").fetchall()}
+            # ** NEW: Only the firewalls of the shards this collector holds a lease on are polled **
+            try:
+                collector_leases.heartbeat(conn, int(settings.get('COLLECTOR_SHARDS', 1)), now)
+            except sqlite3.Error as e:
+                # Leases are not renewed; they lapse locally (and polling stops) before another collector can take them
+                conn.rollback()
+                print(f"Worker: Could not renew collector leases: {e}")
+            if collector_leases.held != announced_shards:
+                announced_shards = collector_leases.held
+                if collector_leases.held:
+                    print(f"Worker: Collecting shard(s) {', '.join(map(str, sorted(collector_leases.held)))} of {collector_leases.shards}.")
+                else:
+                    print("Worker: Standing by; other collectors hold all shards.")
+            firewalls = {fw_id: fw for fw_id, fw in firewalls.items() if collector_leases.owns(fw_id, now)}
+            # Counter snapshots of firewalls taken over from another collector, so their rates continue
+            taken_over = [fw_id for fw_id in firewalls if fw_id not in previous_firewalls and fw_id not in loop.firewall_states]
+            if taken_over:
+                saved_states = load_counter_states(conn)
+                loop.firewall_states.update((fw_id, saved_states[fw_id]) for fw_id in taken_over if fw_id in saved_states)
+            # Capacity usage is also written by the manual refresh and limits by model spec edits, outside this loop
+            _update_fleet_metrics_capacity(conn)
+            # ** FIX: State of remote collectors' firewalls whose results are no longer written here is dropped **
+            remote_firewalls = {row[0] for row in conn.execute('SELECT id FROM firewalls WHERE collector IS NOT NULL').fetchall() if collector_leases.owns(row[0], now)}
+            for firewall_id in [fw_id for fw_id in remote_result_writer.latest_metrics if fw_id not in remote_firewalls]:
+                remote_result_writer.forget(firewall_id)
             conn.close()
-            time.sleep(poll_interval)
-            continue
+            # Instrumentation of deleted (or re-addressed) firewalls is dropped
+            gone = {fw_id: fw['ip_address'] for fw_id, fw in previous_firewalls.items() if fw_id not in firewalls or firewalls[fw_id]['ip_address'] != fw['ip_address']}
+            if gone:
+                collector.forget(hosts=gone.values(), firewall_ids=gone.keys())
 
-        # --- GET API KEYS & DISCOVER MODELS ---
-        init_tasks = [(host, fw_user, fw_password) for host in hosts_to_poll]
-        api_keys = {}
-        try:
-            with multiprocessing.Pool(processes=len(init_tasks)) as pool:
-                for res in pool.map(get_api_key, init_tasks):
-                    if res['status'] == 'success':
-                        api_keys[res['host']] = res['api_key']
-        except Exception as e:
-            print(f"Worker Error during API key generation: {e}")
-            conn.close()
-            time.sleep(poll_interval)
-            continue
-        
-        # ** NEW, ROBUST MODEL DISCOVERY LOGIC **
-        # For any firewall that has an API key but no model, hostname, or sw_version, get the info.
-        firewalls_to_update = [fw for fw in firewalls if fw['ip_address'] in api_keys and (not fw['model'] or not fw['hostname'] or not fw['sw_version'])]
-        if firewalls_to_update:
-            print(f"Found {len(firewalls_to_update)} firewalls with missing details. Discovering...")
-            for fw in firewalls_to_update:
-                try:
-                    api_key = api_keys[fw['ip_address']]
-                    sys_info_xml = requests.get(f"https://{fw['ip_address']}/api/?type=op&cmd=<show><system><info/></system></show>&key={api_key}", verify=False, timeout=10).content
-                    root = ET.fromstring(sys_info_xml)
-                    model = root.findtext('.//model')
-                    hostname = root.findtext('.//hostname')
-                    sw_version = root.findtext('.//sw-version')
-                    if model and hostname and sw_version:
-                        conn.execute('UPDATE firewalls SET model = ?, hostname = ?, sw_version = ? WHERE id = ?', (model, hostname, sw_version, fw['id']))
-                        print(f"Discovered and saved model '{model}', hostname '{hostname}', and version '{sw_version}' for {fw['ip_address']}.")
-                except Exception as e:
-                    print(f"Could not discover model/hostname for {fw['ip_address']}: {e}")
-            conn.commit()
+            if not fw_user or not encrypted_pass:
+                print("Worker: Credentials not set in database. Waiting...")
+                firewalls = {}
+            elif not firewalls and collector_leases.held:
+                print("Worker: No firewalls in DB to poll. Waiting...")
+            loop.fw_user = fw_user
+            loop.fw_password = decrypt_message(encrypted_pass, key) if encrypted_pass else None
+            loop.throughput_source = settings.get('THROUGHPUT_SOURCE', 'physical')
+
+            # ** NEW: (Re)connect to Panorama when proxied collection is enabled or its settings change **
+            try:
+                connection = _shared_panorama_connection(settings, key)
+            except Exception as e:
+                connection = None
+                print(f"Worker: Could not connect to Panorama for proxied collection: {e}")
+            if connection is not None and connection is not panorama:
+                print(f"Worker: Collecting through Panorama {connection.host} (up to {connection.max_concurrent} concurrent calls).")
+            panorama = connection
+            # ** FIX: Without Panorama, its firewalls are not polled directly instead (that would only trip their breakers) **
+            panorama_unavailable = panorama is None and settings.get('COLLECTION_MODE') == 'panorama'
+            # ** FIX: Rule, interface and carried-forward state of firewalls no longer polled here is dropped **
+            for firewall_id in loop.set_firewalls(firewalls, poll_scheduler.group_intervals_from_settings(settings), overrides, now):
+                result_writer.forget(firewall_id)
+            manual_poll_pending &= set(firewalls)
+            fleet_metrics.retain(firewalls)
+            for firewall_id, fw in firewalls.items():
+                fleet_metrics.update(firewall_id, info={'host': fw['ip_address'], 'hostname': fw['hostname'], 'model': fw['model'], 'sw_version': fw['sw_version'], 'serial': fw['serial']},
+                                     reachable=not loop.health.is_open(firewall_id))
+            _publish_fleet_metrics()
+
+        if manual_poll:
+            manual_poll_handled_at = now
+            loop.expedite(now)
+            # ** FIX: Backed-off firewalls are not polled, so the manual poll does not wait for them **
+            manual_poll_pending = {fw_id for fw_id in loop.firewalls if not loop.health.is_open(fw_id) and not skip_panorama_firewall(fw_id)}
+            if not manual_poll_pending and background_task_running.is_set():
+                _clear_background_task()
+
+        # --- DISPATCH DUE JOBS ---
+        loop.dispatch_due(now, skip=skip_panorama_firewall)
+
+        # --- SAVE RESULTS (batched every RESULT_FLUSH_INTERVAL seconds) ---
+        if loop.has_results() and (now - last_flush >= poll_loop.RESULT_FLUSH_INTERVAL or manual_poll_pending):
+            last_flush = now
+            # Devices deleted while their poll was running are dropped, as are those whose lease lapsed meanwhile
+            results = loop.collect(now, keep=lambda fw_id: collector_leases.owns(fw_id, now))
 
-        # ** CHANGE: Only fetch detailed specs for firewalls that are missing them. **
-        details_query = "SELECT firewall_id FROM firewall_details"
-        fws_with_details = {row['firewall_id'] for row in conn.execute(details_query).fetchall()}
-        firewalls_needing_details = [fw for fw in firewalls if fw['ip_address'] in api_keys and fw['id'] not in fws_with_details]
-        if firewalls_needing_details:
-            print(f"Found {len(firewalls_needing_details)} firewalls missing detailed specs. Fetching...")
+            conn = get_db_connection()
+            specs_map = load_specs_from_db(conn)
+            session_capacity = {fw['id']: specs_map[fw['model']]['max_sessions'] for fw in loop.firewalls.values() if fw['model'] in specs_map}
+            write_start = time.perf_counter()
             with db_lock:
-                for fw in firewalls_needing_details:
-                    parse_and_store_fw_details(conn, fw['id'], api_keys[fw['ip_address']])
+                existing = _begin_write(conn)
+                results = [res for res in results if res['firewall_id'] in existing]
+                if result_writer.write(conn, results, settings, now, session_capacity=session_capacity):
+                    _update_fleet_metrics_capacity(conn)
+                save_counter_states(conn, [(res['firewall_id'], res['new_state']) for res in results if res['state_changed']])
                 conn.commit()
-        
-        # --- POLLING ---
-        if not api_keys:
-            print("Worker: Could not get API key for any firewalls. Check credentials in Settings. Waiting...")
-            conn.close()
-            time.sleep(poll_interval)
-            continue
-            
-        poll_tasks = [(host, key, firewall_states.get(host, {})) for host, key in api_keys.items()]
-        with multiprocessing.Pool(processes=len(poll_tasks)) as pool:
-            results = pool.map(poll_single_firewall, poll_tasks)
-        
-        # --- SAVE RESULTS ---
-        # Explicitly format the datetime object to a string to avoid DeprecationWarning in Python 3.12+
-        timestamp_now_str = datetime.now().isoformat(sep=' ', timespec='microseconds')
-        with db_lock:
             for res in results:
-                host = res['host']
-                firewall_id = next((fw['id'] for fw in firewalls if fw['ip_address'] == host), None)
-                if not firewall_id: continue
-                
-                conn.execute('UPDATE firewalls SET last_checked = ?, status = ? WHERE id = ?', (timestamp_now_str, res['status'], firewall_id))
-                if res['status'] == 'success':
-                    firewall_states[host] = res['new_state']
-                    s = res['data']
-                    if s['total_input_bps'] > 0 or s['total_output_bps'] > 0 or s['active_sessions'] > 0:
-                        conn.execute(
-                            'INSERT INTO stats (firewall_id, timestamp, active_sessions, ssl_decrypt_sessions, total_input_bps, total_output_bps, cpu_load, dataplane_load, memory_utilization) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                            (firewall_id, timestamp_now_str, s['active_sessions'], s['ssl_decrypt_sessions'], s['total_input_bps'], s['total_output_bps'], s['cpu_load'], s['dataplane_load'], s['memory_utilization'])
-                        )
-            
-            # --- NEW: Prune old statistics ---
-            prune_query = f"DELETE FROM stats WHERE timestamp < datetime('now', '-{retention_days} days')"
-            cursor = conn.execute(prune_query)
-            if cursor.rowcount > 0: print(f"Pruned {cursor.rowcount} old stat records (older than {retention_days} days).")
-
-            conn.commit()
-
-        conn.close()
-        if background_task_running.is_set():
-            background_task_running.clear()
-        print(f"Polling cycle finished. Sleeping for {poll_interval} seconds.")
-        # Wait for the poll_interval, or until the manual_poll_event is set
-        manual_poll_event.wait(timeout=poll_interval)
-        manual_poll_event.clear() # Reset the event after waking up
+                groups = res['groups']
+                fleet_metrics.update(res['firewall_id'], values={key: value for group in poll_scheduler.FAST_GROUPS if group in groups for key, value in groups[group].items()},
+                                     sample_time=now if 'throughput_sessions' in groups else None, reachable=not loop.health.is_open(res['firewall_id']))
+            collector.record_db_write(time.perf_counter() - write_start, len(results))
+            conn.close()
+            _publish_fleet_metrics()
+
+            manual_poll_done = False
+            if manual_poll_pending:
+                manual_poll_pending.difference_update(res['firewall_id'] for res in results)
+                manual_poll_done = not manual_poll_pending
+            # --- NEW: Bump the data version and push changed dashboard rows to live SSE clients, once per poll interval
+            # (or as soon as a manual poll completes) ---
+            result_publisher.written(now, poll_interval, force=manual_poll_done)
+            if manual_poll_done and background_task_running.is_set():
+                _clear_background_task()
+
+            # Groups that fell due while their device was busy go out now
+            loop.dispatch_waiting(now)
+
+        # --- NEW: WRITE RESULTS PUSHED BY REMOTE COLLECTORS (queued by /api/ingest) ---
+        if remote_backlog or now - remote_written_at >= poll_loop.RESULT_FLUSH_INTERVAL:
+            remote_written_at = now
+            written, remote_backlog = 0, False
+            if collector_leases.valid(now):
+                try:
+                    written, remote_backlog = write_queued_remote_results(settings, now, collector_leases.shards, collector_leases.held)
+                except sqlite3.Error as e:
+                    print(f"Worker: Could not write remote collector results: {e}")
+            if written:
+                result_publisher.written(now, poll_interval)
+
+        # Results written since the last publish go out once the poll interval has passed, even if no more arrive
+        result_publisher.flush(now, poll_interval)
+        loop.record_gauges()
+
+        # Sleep until the next job is due, a poll finishes (or the next batch of finished polls should
+        # be written), the next publish is due, or a manual poll is requested
+        wake_at = now if remote_backlog else loop.next_wake(now, last_flush)
+        publish_at = result_publisher.due_at(poll_interval)
+        if publish_at is not None:
+            wake_at = min(wake_at, publish_at)
+        loop.sleep_until(wake_at)
 
 def get_firewall_stats_for_timespan(conn, fw_id, timespan=None, start_date=None, end_date=None):
     """
@@ -1826,4 +2575,7 @@ if __name__ == '__main__':
     worker_thread = threading.Thread(target=background_worker_loop, daemon=True)
     worker_thread.start()
     log = logging.getLogger('werkzeug')
-    app.run(host='0.0.0.0', port=4000, debug=False)
\ No newline at end of file
+    try:
+        app.run(host='0.0.0.0', port=4000, debug=False)
+    finally:
+        release_collector_leases()
\ No newline at end of file
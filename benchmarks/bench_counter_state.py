@@ -0,0 +1,64 @@
+"""
+Measures saving and restoring the poller's per-firewall interface counter state.
+
+    python benchmarks/bench_counter_state.py --devices 1000 --interfaces-per-device 24
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app
+
+
+def make_states(devices, per_device, seed=1):
+    rng = random.Random(seed)
+    now = time.time()
+    names = [f"ethernet1/{n}" for n in range(1, per_device - 1)] + ['ae1', 'ae2']
+    return [(fw_id, {'counters': {name: (rng.getrandbits(48), rng.getrandbits(48), rng.getrandbits(40), rng.getrandbits(40)) for name in names},
+                     'timestamp': now - rng.random() * 30})
+            for fw_id in range(1, devices + 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--interfaces-per-device', type=int, default=24)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.DB_FILE = os.path.join(tmp, 'bench.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.init_db()
+        conn = app.get_db_connection()
+        conn.executemany('INSERT INTO firewalls (id, ip_address) VALUES (?, ?)',
+                         [(i, f"10.{i // 65536}.{(i // 256) % 256}.{i % 256}") for i in range(1, args.devices + 1)])
+        states = make_states(args.devices, args.interfaces_per_device)
+
+        start = time.perf_counter()
+        app.save_counter_states(conn, states)
+        conn.commit()
+        save = time.perf_counter() - start
+        size = conn.execute('SELECT SUM(LENGTH(counters)) FROM counter_state').fetchone()[0]
+        conn.close()
+
+        # A fresh connection, as after a restart
+        start = time.perf_counter()
+        conn = app.get_db_connection()
+        restored = app.load_counter_states(conn)
+        load = time.perf_counter() - start
+        conn.close()
+
+    assert restored == dict(states), "restored state differs from saved state"
+    print(f"Devices: {args.devices:,}  interfaces per device: {args.interfaces_per_device}  stored: {size / 1024:,.0f} KiB ({size / args.devices:,.0f} bytes/device)")
+    print(f"Save    : {save * 1000:8.1f} ms")
+    print(f"Restore : {load * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures per-interface ingest, rollup and busiest-interface (top-N) query time on a large synthetic fleet.
+
+Raw samples are ingested for the last --raw-hours at the poll interval and rolled up; older hourly
+and daily rollups are generated directly to cover --history-days.
+
+    python benchmarks/bench_interface_topn.py --devices 1000 --interfaces-per-device 10 --history-days 30
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app
+import interface_stats
+
+
+def make_rates(rng, devices, per_device):
+    return [(fw_id, {f"ethernet1/{n}": (rng.random() * 1e9, rng.random() * 1e9, rng.random() * 1e5, rng.random() * 1e5)
+                     for n in range(1, per_device + 1)})
+            for fw_id in range(1, devices + 1)]
+
+
+def rollup_rows(rng, bucket_ts, interfaces):
+    return [(bucket_ts, interface_id, 120, rng.random() * 1e9, rng.random() * 1e9, rng.random() * 1e9, rng.random() * 1e9, rng.random() * 1e5, rng.random() * 1e5)
+            for interface_id in range(1, interfaces + 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--interfaces-per-device', type=int, default=10)
+    parser.add_argument('--poll-interval', type=int, default=30)
+    parser.add_argument('--raw-hours', type=int, default=1)
+    parser.add_argument('--history-days', type=int, default=30)
+    parser.add_argument('--limit', type=int, default=25)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    rng = random.Random(1)
+    interfaces = args.devices * args.interfaces_per_device
+    now = int(time.time())
+    raw_start = (now - args.raw_hours * 3600) // 3600 * 3600
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.DB_FILE = os.path.join(tmp, 'bench.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.init_db()
+        conn = app.get_db_connection()
+        conn.executemany('INSERT INTO firewalls (id, ip_address) VALUES (?, ?)',
+                         [(i, f"10.{i // 65536}.{(i // 256) % 256}.{i % 256}") for i in range(1, args.devices + 1)])
+        dictionary = interface_stats.InterfaceDictionary()
+        for fw_id, rates in make_rates(rng, args.devices, args.interfaces_per_device):
+            dictionary.ids_for(conn, fw_id, list(rates))
+
+        # Older history straight into the hourly and daily tiers (rolling it up from raw would take far longer)
+        for hour_ts in range(raw_start - 24 * 3600, raw_start, 3600):
+            conn.executemany('INSERT INTO interface_stats_hourly VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rollup_rows(rng, hour_ts, interfaces))
+        for day_ts in range((raw_start - args.history_days * 86400) // 86400 * 86400, raw_start // 86400 * 86400, 86400):
+            conn.executemany('INSERT INTO interface_stats_daily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rollup_rows(rng, day_ts, interfaces))
+        conn.commit()
+
+        # Raw samples, one poll cycle at a time as the poller writes them, then rolled up
+        cycles = (now - raw_start) // args.poll_interval
+        rates = make_rates(rng, args.devices, args.interfaces_per_device)
+        start = time.perf_counter()
+        for cycle in range(cycles):
+            interface_stats.ingest(conn, dictionary, rates, raw_start + cycle * args.poll_interval)
+            conn.commit()
+        ingest = time.perf_counter() - start
+        start = time.perf_counter()
+        rolled = interface_stats.rollup(conn, now)
+        conn.commit()
+        rollup = time.perf_counter() - start
+
+        print(f"Interfaces: {interfaces:,} ({args.devices:,} devices x {args.interfaces_per_device})  raw samples: {cycles * interfaces:,}")
+        print(f"Ingest        : {ingest:8.3f}s  {cycles * interfaces / ingest:12,.0f} samples/s  ({ingest / cycles * 1000:.1f} ms per poll cycle)")
+        print(f"Rollup        : {rollup:8.3f}s  ({rolled:,} rollup rows written)")
+        for window in interface_stats.TOP_INTERFACE_WINDOWS:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                top = interface_stats.top_interfaces(conn, window=window, limit=args.limit, now=now)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print(f"Top {args.limit} {window:>4}   : {elapsed * 1000:8.1f} ms  ({len(top)} rows)")
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Measures Panorama-proxied collection throughput against the simulated Panorama of panos_simulator.
+
+Every proxied (target=<serial>) call is answered after a simulated Panorama-to-firewall round trip,
+and the simulator records how many calls were in flight at once so the concurrency cap can be checked.
+
+    python benchmarks/bench_panorama_proxy.py --devices 1000 --latency-ms 20 --max-concurrent 8
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import device_collection
+import panorama_proxy
+import panos_simulator
+import poll_loop
+import poll_scheduler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=20, help="simulated Panorama-to-firewall round trip per call")
+    parser.add_argument('--max-concurrent', type=int, default=panorama_proxy.DEFAULT_MAX_CONCURRENT, help="Panorama concurrency cap")
+    parser.add_argument('--groups', default=','.join(poll_scheduler.FAST_GROUPS), help="comma-separated metric groups to collect")
+    args = parser.parse_args()
+    groups = [g for g in poll_scheduler.METRIC_GROUPS if g in args.groups.split(',')]
+
+    simulator = panos_simulator.Simulator(args.devices, latency=args.latency_ms / 1000.0)
+    panorama = panorama_proxy.PanoramaConnection.connect(simulator.panorama_host, 'admin', 'admin', max_concurrent=args.max_concurrent)
+    tasks = [(i, device.serial, groups, panorama.api_key, None, None, {}, False, device.sw_version, panorama.for_device(device.serial), 'physical')
+             for i, device in enumerate(simulator.devices, start=1)]
+
+    calls_before = simulator.calls
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPool(poll_loop.COLLECTION_MAX_WORKERS) as pool:
+        results = pool.map(device_collection.run_device_jobs, tasks)
+    elapsed = time.perf_counter() - start
+    calls = simulator.calls - calls_before
+    panorama.close()
+    simulator.close()
+
+    failed = sum(1 for r in results if r['status'] != 'success')
+    print(f"Proxied devices: {args.devices:,}  groups: {', '.join(groups)}  failed: {failed}")
+    print(f"Panorama calls : {calls:,}  ({args.latency_ms:g} ms each, cap {args.max_concurrent}, peak in flight {simulator.peak_in_flight})")
+    print(f"Elapsed        : {elapsed:8.3f}s  {args.devices / elapsed:10,.1f} devices/s  {calls / elapsed:10,.1f} calls/s")
+
+
+if __name__ == '__main__':
+    main()
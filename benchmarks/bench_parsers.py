@@ -0,0 +1,143 @@
+"""
+Microbenchmarks for the PAN-OS response parsers (panos_parsers.py) over the response corpus in
+benchmarks/corpus: the best parse time per response for each recorded device, and the parse CPU
+one poll cycle over a fleet costs, for every available XML backend (ElementTree, and lxml when
+installed).
+
+Before timing, every parser's output is checked against the device's expected.json, so the
+benchmark also fails on a parser change that reads a response differently.
+
+    python benchmarks/bench_parsers.py --fleet 2000 --json parsers.json
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+import panos_parsers
+from record_responses import CORPUS_DIR, expected_values
+
+# Poll group -> (parser name, corpus file, parser) for the responses it parses, as poll_single_firewall does
+POLL_GROUPS = {
+    'throughput_sessions': [
+        ('session_info', 'session_info.xml', panos_parsers.parse_session_info),
+        ('interface_counters', 'interface_counters.xml', panos_parsers.parse_interface_counters),
+    ],
+    'cpu_memory': [
+        ('system_resources', 'system_resources.xml', panos_parsers.parse_system_resources),
+        ('dataplane_load', 'resource_monitor.xml', panos_parsers.parse_dataplane_load),
+    ],
+    'ssl_decrypt': [
+        ('ssl_decrypt_sessions', 'ssl_decrypt_sessions.xml', panos_parsers.count_ssl_decrypt_sessions),
+    ],
+    # Once per firewall at discovery and on a capacity refresh, not every cycle
+    'discovery': [
+        ('system_info', 'system_info.xml', panos_parsers.parse_system_info),
+        ('system_state', 'system_state.xml', panos_parsers.parse_system_state),
+    ],
+}
+CYCLE_GROUPS = ['throughput_sessions', 'cpu_memory', 'ssl_decrypt']
+
+
+def load_corpus(corpus_dir):
+    """{device label: ({file: bytes}, expected)} for every recorded device."""
+    corpus = {}
+    for label in sorted(os.listdir(corpus_dir)):
+        directory = os.path.join(corpus_dir, label)
+        if not os.path.isfile(os.path.join(directory, 'expected.json')):
+            continue
+        responses = {}
+        for name in os.listdir(directory):
+            if name.endswith('.xml'):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    responses[name] = f.read()
+        with open(os.path.join(directory, 'expected.json')) as f:
+            corpus[label] = (responses, json.load(f))
+    return corpus
+
+
+def _same(actual, expected):
+    if isinstance(expected, float) or isinstance(actual, float):
+        return math.isclose(actual, expected, rel_tol=1e-9, abs_tol=1e-9)
+    if isinstance(expected, list):
+        return len(actual) == len(expected) and all(_same(a, e) for a, e in zip(actual, expected))
+    if isinstance(expected, dict):
+        return actual.keys() == expected.keys() and all(_same(actual[k], v) for k, v in expected.items())
+    return actual == expected
+
+
+def check(corpus):
+    """Names of (device, parser) whose output differs from expected.json with the current backend."""
+    failures = []
+    for label, (responses, expected) in corpus.items():
+        # Round-tripped through JSON, as expected.json was written
+        actual = json.loads(json.dumps(expected_values(responses)))
+        failures += [f"{label}: {name}" for name in expected if not _same(actual.get(name), expected[name])]
+    return failures
+
+
+def time_backends(func, arg, min_seconds, rounds=10):
+    """
+    {backend: best seconds per call}. Backends take turns round by round, so a noisy spell on the
+    machine does not land on one of them only.
+    """
+    timer = timeit.Timer(lambda: func(arg))
+    number = max(1, int(min_seconds / rounds / max(timer.timeit(1), 1e-6) / len(panos_parsers.BACKENDS)))
+    best = {}
+    for _ in range(rounds):
+        for backend in panos_parsers.BACKENDS:
+            panos_parsers.backend = backend
+            best[backend] = min(best.get(backend, float('inf')), timer.timeit(number) / number)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=CORPUS_DIR)
+    parser.add_argument('--fleet', type=int, default=1000, help="fleet size for the per-cycle cost (corpus devices in equal shares)")
+    parser.add_argument('--min-seconds', type=float, default=0.5, help="measuring time per parser and response, over all backends")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        sys.exit(f"No recorded devices in {args.corpus}")
+    print(f"Corpus: {', '.join(corpus)}")
+    for backend in panos_parsers.BACKENDS:
+        panos_parsers.backend = backend
+        failures = check(corpus)
+        if failures:
+            sys.exit(f"{backend}: parser output differs from expected.json for " + ', '.join(failures))
+
+    # {backend: {parser: {device: seconds}}}
+    timings = {backend: {} for backend in panos_parsers.BACKENDS}
+    for parsers in POLL_GROUPS.values():
+        for name, filename, func in parsers:
+            for label, (responses, _) in corpus.items():
+                for backend, seconds in time_backends(func, responses[filename], args.min_seconds).items():
+                    timings[backend].setdefault(name, {})[label] = seconds
+
+    results = {}
+    for backend, parser_timings in timings.items():
+        print(f"\n{backend}")
+        print(f"{'Parser':<22}" + ''.join(f"{label:>17}" for label in corpus) + "   (us per response)")
+        for name, by_device in parser_timings.items():
+            print(f"{name:<22}" + ''.join(f"{by_device[label] * 1e6:>17,.1f}" for label in corpus))
+        # Each corpus device stands for an equal share of the fleet
+        cycle = {group: sum(parser_timings[name][label] for name, _, _ in POLL_GROUPS[group] for label in corpus) * args.fleet / len(corpus)
+                 for group in CYCLE_GROUPS}
+        print(f"Parse CPU per poll cycle of {args.fleet:,} firewalls: " + ', '.join(f"{group} {seconds * 1000:,.0f} ms" for group, seconds in cycle.items())
+              + f", total {sum(cycle.values()) * 1000:,.0f} ms")
+        results[backend] = {'per_response_seconds': parser_timings, 'cycle_seconds': cycle}
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'fleet': args.fleet, 'devices': list(corpus), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Measures the background poller against a simulated fleet of growing size: how long one throughput
+cycle over the whole fleet takes, whether the poller keeps up with the poll interval, and the CPU
+and memory it uses while doing it.
+
+Each fleet size runs the real background_worker_loop in its own process, against a fresh database,
+polling firewalls served by panos_simulator. Firewalls are added with their model and version known
+(as a Panorama import would), so the first minute only adds the one-off capacity and spec polls;
+--warmup should cover it. Measurements are taken over the following --duration seconds.
+
+    python benchmarks/bench_poller_fleet.py --fleet-sizes 250,500,1000,2000 --interval 10 --latency-ms 30
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import panos_simulator
+
+
+def _rss_mb():
+    """Current resident set size (peak, where /proc is not available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_poller(devices, interval, warmup, duration, results):
+    """Child process: runs the poller over `devices` [(host, hostname, model, sw_version)] and reports."""
+    import app
+
+    os.chdir(tempfile.mkdtemp())
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        app.init_db()
+        conn = app.get_db_connection()
+        conn.executemany("INSERT INTO firewalls (ip_address, hostname, model, sw_version, source) VALUES (?, ?, ?, ?, 'manual')", devices)
+        settings = {'FW_USER': 'admin', 'FW_PASSWORD': app.encrypt_message('admin', app.load_key()),
+                    'POLL_INTERVAL': str(interval), 'POLL_INTERVAL_CPU_MEMORY': str(interval), 'POLL_INTERVAL_SSL_DECRYPT': str(interval * 2)}
+        conn.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', settings.items())
+        conn.commit()
+
+        threading.Thread(target=app.background_worker_loop, daemon=True).start()
+        time.sleep(warmup)
+        before, cpu_before, rows_before = app.get_poller_stats(), _cpu_seconds(), conn.execute('SELECT COUNT(*) FROM stats').fetchone()[0]
+        start = time.perf_counter()
+        time.sleep(duration)
+        elapsed = time.perf_counter() - start
+        after, cpu_after, rows_after = app.get_poller_stats(), _cpu_seconds(), conn.execute('SELECT COUNT(*) FROM stats').fetchone()[0]
+
+    group = lambda stats, key: stats['groups']['throughput_sessions'][key]
+    polls = group(after, 'dispatched') - group(before, 'dispatched')
+    results.put({
+        'devices': len(devices),
+        'throughput_polls': polls,
+        'cycle_seconds': len(devices) * elapsed / polls if polls else None,
+        'late': after['late'] - before['late'],
+        'skipped': after['skipped'] - before['skipped'],
+        'avg_lag_seconds': after['avg_lag_seconds'],
+        'max_lag_seconds': after['max_lag_seconds'],
+        'unreachable': after['unreachable'],
+        'stats_rows_per_second': (rows_after - rows_before) / elapsed,
+        'cpu_percent': (cpu_after - cpu_before) / elapsed * 100,
+        'rss_mb': _rss_mb(),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fleet-sizes', default='250,500,1000,2000')
+    parser.add_argument('--interval', type=int, default=10, help="throughput and CPU/memory poll interval (seconds)")
+    parser.add_argument('--warmup', type=float, default=65, help="seconds to let first polls and discovery settle")
+    parser.add_argument('--duration', type=float, default=30, help="measurement window (seconds)")
+    parser.add_argument('--json', help="also write the results to this file")
+    panos_simulator.add_arguments(parser)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.fleet_sizes.split(',')]
+
+    simulator = panos_simulator.from_arguments(args, max(sizes))
+    fleet = [(host, d.hostname, d.model, d.sw_version) for host, d in zip(simulator.hosts(), simulator.devices)]
+    # Spawned, not forked: the simulator's threads live in this process
+    context = multiprocessing.get_context('spawn')
+    print(f"Interval {args.interval}s, simulated API latency {args.latency_ms:g} ms (+{args.jitter_ms:g} ms mean jitter), "
+          f"error rate {args.error_rate:g}, {args.down_fraction:.0%} down")
+    print(f"{'Devices':>8} {'Cycle (s)':>10} {'Keeps up':>9} {'Late':>7} {'Skipped':>8} {'Avg lag':>8} {'Rows/s':>8} {'CPU %':>7} {'RSS (MB)':>9}")
+    results = []
+    for size in sizes:
+        queue = context.Queue()
+        child = context.Process(target=run_poller, args=(fleet[:size], args.interval, args.warmup, args.duration, queue))
+        child.start()
+        result = queue.get()
+        child.join(timeout=5)
+        if child.is_alive():
+            child.terminate()
+        results.append(result)
+        cycle = result['cycle_seconds']
+        keeps_up = cycle is not None and cycle <= args.interval * 1.1
+        print(f"{size:>8,} {cycle or float('inf'):>10.1f} {'yes' if keeps_up else 'NO':>9} {result['late']:>7,} {result['skipped']:>8,} "
+              f"{result['avg_lag_seconds']:>8.2f} {result['stats_rows_per_second']:>8.1f} {result['cpu_percent']:>7.1f} {result['rss_mb']:>9.1f}")
+    print(f"Simulator: {simulator.calls:,} API calls, {simulator.errors:,} errors")
+    simulator.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Times the data-heavy pages, exports and PDF reports on a database of synthetic history.
+
+Pages are requested through Flask's test client with the response cache cleared before every run,
+so each timing covers the queries and the template render. Results (min/median/max per benchmark,
+plus the dataset and environment) are written as JSON so runs can be compared:
+
+    python benchmarks/bench_queries.py --firewalls 50 --days 30 --output before.json
+    python benchmarks/bench_queries.py --firewalls 50 --days 30 --output after.json --compare before.json
+
+Pass --db to reuse an existing database (e.g. one made by synthetic_history.py) instead of
+generating a new one in a temporary directory.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import app
+import report_generator
+import synthetic_history
+
+DETAIL_TIMESPANS = ['5m', '1h', '6h', '24h', '7d', '30d']
+CSV_TIMESPANS = ['1h', '24h', '7d']
+ADVISOR_TIMESPANS = ['7d', '30d']
+REPORT_TYPES = ['table_only', 'capacity', 'graphs_only', 'combined']
+
+
+def benchmarks(fw_id, report_timespan):
+    """(name, callable) for every benchmark. Each callable raises if the request did not succeed."""
+    client = app.app.test_client()
+
+    def get(url, method='get', **kwargs):
+        def run():
+            app.bump_data_version()
+            response = getattr(client, method)(url, **kwargs)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code}")
+        return run
+
+    def report(report_type):
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                pdf = report_generator.generate_report_pdf(app.DB_FILE, report_type, timespan=report_timespan)
+            if not pdf:
+                raise RuntimeError(f"{report_type} report was empty")
+        return run
+
+    cases = [('index', get('/')), ('capacity_dashboard', get('/capacity'))]
+    cases += [(f"firewall_detail[{t}]", get(f"/firewall/{fw_id}?timespan={t}")) for t in DETAIL_TIMESPANS]
+    cases += [(f"advisor[{t}]", get('/advisor', method='post', data={'timespan': t, 'statistic': 'peak'})) for t in ADVISOR_TIMESPANS]
+    # P95 reads the hourly peaks, so its cost depends on firewalls x hours, not on --interval
+    cases += [(f"advisor_p95[{t}]", get('/advisor', method='post', data={'timespan': t, 'statistic': 'p95'})) for t in ADVISOR_TIMESPANS]
+    cases += [(f"export_csv[{t}]", get(f"/export/csv/{fw_id}?timespan={t}")) for t in CSV_TIMESPANS]
+    cases += [(f"report_pdf[{r},{report_timespan}]", report(r)) for r in REPORT_TYPES]
+    return cases
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help="existing database to benchmark (default: generate one)")
+    parser.add_argument('--firewalls', type=int, default=50)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--interval', type=int, default=30)
+    parser.add_argument('--runs', type=int, default=3, help="runs per page benchmark")
+    parser.add_argument('--report-runs', type=int, default=1, help="runs per PDF report benchmark")
+    parser.add_argument('--report-timespan', default='24h')
+    parser.add_argument('--only', help="comma-separated substrings; run only benchmarks whose name contains one")
+    parser.add_argument('--output', default='bench_queries.json')
+    parser.add_argument('--compare', help="earlier results file to compare medians against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The app's key file and any report output stay in the temporary directory
+        os.chdir(tmp)
+        if args.db:
+            app.DB_FILE = os.path.abspath(args.db)
+        else:
+            print(f"Generating {args.firewalls:,} firewalls x {args.days} days of history...")
+            synthetic_history.generate(os.path.join(tmp, 'bench.db'), args.firewalls, args.days, args.interval, progress=None)
+        conn = app.get_db_connection()
+        dataset = {
+            'firewalls': conn.execute('SELECT COUNT(*) FROM firewalls').fetchone()[0],
+            'stats_rows': conn.execute('SELECT COUNT(*) FROM stats').fetchone()[0],
+            'alerts': conn.execute('SELECT COUNT(*) FROM alerts').fetchone()[0],
+            'db_bytes': os.path.getsize(app.DB_FILE),
+        }
+        fw_id = conn.execute('SELECT id FROM firewalls ORDER BY id LIMIT 1 OFFSET ?', (dataset['firewalls'] // 2,)).fetchone()[0]
+        conn.close()
+        print(f"Dataset: {dataset['firewalls']:,} firewalls, {dataset['stats_rows']:,} stats rows, {dataset['db_bytes'] / 2 ** 20:,.0f} MiB")
+
+        only = args.only.split(',') if args.only else None
+        results = {}
+        for name, run in benchmarks(fw_id, args.report_timespan):
+            if only and not any(part in name for part in only):
+                continue
+            timings = []
+            for _ in range(args.report_runs if name.startswith('report_pdf') else args.runs):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+            results[name] = {'runs': len(timings), 'min': min(timings), 'median': statistics.median(timings), 'max': max(timings)}
+            print(f"{name:<32} {results[name]['median'] * 1000:10.1f} ms (min {results[name]['min'] * 1000:.1f}, max {results[name]['max'] * 1000:.1f})")
+
+    output = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'dataset': dataset,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+        print(f"\nMedian change vs {args.compare}:")
+        for name, result in results.items():
+            if name in previous:
+                before = previous[name]['median']
+                print(f"{name:<32} {before * 1000:10.1f} -> {result['median'] * 1000:10.1f} ms  ({(result['median'] - before) / before:+.0%})")
+
+
+if __name__ == '__main__':
+    main()
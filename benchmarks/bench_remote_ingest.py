@@ -0,0 +1,162 @@
+"""
+Measures the bulk ingest API (/api/ingest) with several remote collectors pushing at once: results
+accepted per second, request latency, bytes per batch on the wire, and how long the collector takes
+to write what was still queued once the agents stop.
+
+The web app runs in its own process (threaded werkzeug server plus the poller thread, as under
+`python app.py`) against a fresh database whose --firewalls firewalls are split evenly across
+--agents remote collectors. Each agent is a process pushing synthetic results (sessions, CPU, memory
+and per-interface rates, as a throughput poll produces) through remote_ingest.IngestClient, one batch
+after another, for --duration seconds.
+
+    python benchmarks/bench_remote_ingest.py --agents 1,2,4,8 --firewalls 2000 --duration 20
+"""
+import argparse
+import contextlib
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+
+def run_server(directory, firewalls, agents, port, tokens):
+    """Child process: sets up the database and serves the web app, with the poller writing the queued results."""
+    import app
+    import remote_ingest
+    from werkzeug.serving import make_server
+
+    os.chdir(directory)
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        app.init_db()
+        conn = app.get_db_connection()
+        names = [f'agent-{i}' for i in range(agents)]
+        for name in names:
+            tokens.put((name, remote_ingest.register(conn, name)))
+        conn.executemany("INSERT INTO firewalls (ip_address, hostname, model, sw_version, source, collector) VALUES (?, ?, 'PA-3430', '11.1.2', 'manual', ?)",
+                         [(f'10.{i // 65536}.{i // 256 % 256}.{i % 256}', f'fw-{i}', names[i % agents]) for i in range(firewalls)])
+        conn.commit()
+        conn.close()
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        threading.Thread(target=app.background_worker_loop, daemon=True).start()
+        server = make_server('127.0.0.1', port, app.app, threaded=True)
+        server.serve_forever()
+
+
+def synthetic_result(firewall_id, now, interfaces):
+    data = {
+        'active_sessions': random.randint(1000, 500000), 'ssl_decrypt_sessions': random.randint(0, 5000),
+        'total_input_bps': random.uniform(1e6, 5e9), 'total_output_bps': random.uniform(1e6, 5e9),
+        'cpu_load': random.uniform(1, 60), 'dataplane_load': random.uniform(1, 80), 'memory_utilization': random.uniform(20, 80),
+        'interfaces': {f'ethernet1/{i + 1}': [random.uniform(0, 1e9), random.uniform(0, 1e9), random.uniform(0, 1e5), random.uniform(0, 1e5)] for i in range(interfaces)},
+    }
+    return {'firewall_id': firewall_id, 'status': 'success', 'timestamp': now, 'groups': {'throughput_sessions': data}}
+
+
+def run_agent(server, token, firewall_ids, batch_size, interfaces, compress, duration, start_at, results):
+    """Child process: pushes batches of synthetic results for its firewalls until the deadline."""
+    import remote_ingest
+
+    client = remote_ingest.IngestClient(server, token, batch_size=batch_size, compress=compress)
+    latencies, pushed, batch_bytes = [], 0, []
+    position = 0
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = start_at + duration
+    while time.time() < deadline:
+        now = time.time()
+        batch = [synthetic_result(firewall_ids[(position + i) % len(firewall_ids)], now, interfaces) for i in range(batch_size)]
+        position += batch_size
+        if len(batch_bytes) < 5:
+            batch_bytes.append(len(remote_ingest.encode_batch(batch, compress)[0]))
+        client.add(batch)
+        start = time.perf_counter()
+        pushed += client.push_once()
+        latencies.append(time.perf_counter() - start)
+    results.put({'pushed': pushed, 'rejected': client.rejected, 'latencies': latencies, 'batch_bytes': statistics.mean(batch_bytes)})
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port), timeout=1):
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def run(agents, args):
+    directory = tempfile.mkdtemp()
+    tokens = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server, args=(directory, args.firewalls, agents, args.port, tokens), daemon=True)
+    server.start()
+    try:
+        wait_for_port(args.port)
+        names = dict(tokens.get(timeout=30) for _ in range(agents))
+        results = multiprocessing.Queue()
+        start_at = time.time() + 1
+        workers = []
+        for i in range(agents):
+            firewall_ids = [fw_id for fw_id in range(1, args.firewalls + 1) if (fw_id - 1) % agents == i]
+            workers.append(multiprocessing.Process(target=run_agent, args=(f'http://127.0.0.1:{args.port}', names[f'agent-{i}'], firewall_ids, args.batch_size,
+                                                                          args.interfaces, not args.no_gzip, args.duration, start_at, results)))
+        for worker in workers:
+            worker.start()
+        reports = [results.get(timeout=args.duration + 120) for _ in workers]
+        for worker in workers:
+            worker.join()
+        db = sqlite3.connect(os.path.join(directory, 'monitoring.db'))
+        drain_start = time.time()
+        while db.execute('SELECT COUNT(*) FROM remote_results').fetchone()[0] and time.time() - drain_start < 600:
+            time.sleep(0.2)
+        drain_seconds = time.time() - drain_start
+        rows = db.execute('SELECT COUNT(*) FROM stats').fetchone()[0]
+        db.close()
+    finally:
+        server.terminate()
+        server.join()
+
+    latencies = sorted(latency for report in reports for latency in report['latencies'])
+    pushed = sum(report['pushed'] for report in reports)
+    return {
+        'agents': agents,
+        'results_per_second': pushed / args.duration,
+        'batches_per_second': len(latencies) / args.duration,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+        'stats_rows': rows,
+        'drain_seconds': drain_seconds,
+        'rejected': sum(report['rejected'] for report in reports),
+        'kib_per_batch': statistics.mean(report['batch_bytes'] for report in reports) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--agents', default='1,2,4,8', help="comma-separated agent counts to run")
+    parser.add_argument('--firewalls', type=int, default=2000)
+    parser.add_argument('--interfaces', type=int, default=8, help="interfaces per firewall in each result")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--port', type=int, default=14500)
+    parser.add_argument('--no-gzip', action='store_true')
+    args = parser.parse_args()
+
+    print(f"{args.firewalls} firewalls, {args.interfaces} interfaces each, batches of {args.batch_size}{'' if args.no_gzip else ' (gzip)'}, {args.duration:g}s per run")
+    print(f"{'agents':>6} {'results/s':>10} {'batches/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'stats rows':>11} {'drain s':>8} {'KiB/batch':>10}")
+    for agents in [int(n) for n in args.agents.split(',')]:
+        r = run(agents, args)
+        print(f"{r['agents']:>6} {r['results_per_second']:>10.0f} {r['batches_per_second']:>10.1f} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['stats_rows']:>11} {r['drain_seconds']:>8.1f} {r['kib_per_batch']:>10.1f}"
+              + (f"  ({r['rejected']} rejected)" if r['rejected'] else ''))
+
+
+if __name__ == '__main__':
+    main()
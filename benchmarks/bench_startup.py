@@ -0,0 +1,68 @@
+"""
+Measures application startup, each run in a fresh Python process as a web worker or collector
+would start: importing app (and which heavy libraries that loads), init_db on a new database, on a
+database that needs its migrations (as after an upgrade or a restored backup), and on one already at
+SCHEMA_VERSION, and the first request to the dashboard.
+
+    python benchmarks/bench_startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, '..')
+
+HEAVY_MODULES = ('matplotlib', 'fpdf', 'numpy')
+
+# Runs in the child process, in a directory holding the database; prints one JSON line
+CHILD = """
+import contextlib, json, os, sqlite3, sys, time
+sys.path.insert(0, {repo!r})
+mode = {mode!r}
+if mode == 'migrate':
+    sqlite3.connect('monitoring.db').execute('PRAGMA user_version = 0').connection.close()
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+with contextlib.redirect_stdout(open(os.devnull, 'w')):
+    app.init_db()
+initialized = time.perf_counter()
+app.load_key()
+response = app.app.test_client().get('/')
+first_request = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'init_db': initialized - imported, 'first_request': first_request - initialized,
+                  'status': response.status_code, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def run_child(directory, mode):
+    code = CHILD.format(repo=os.path.abspath(REPO_DIR), mode=mode, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], cwd=directory, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="processes started per scenario (the median is reported)")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<22} {'import ms':>10} {'init_db ms':>11} {'1st req ms':>11} {'total ms':>9}  heavy modules loaded")
+    for scenario in ('new database', 'migrate', 'up to date'):
+        runs = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as directory:
+                if scenario != 'new database':
+                    run_child(directory, 'new')
+                runs.append(run_child(directory, 'migrate' if scenario == 'migrate' else 'new'))
+        median = {key: statistics.median(run[key] for run in runs) * 1000 for key in ('import', 'init_db', 'first_request')}
+        print(f"{scenario:<22} {median['import']:>10.1f} {median['init_db']:>11.1f} {median['first_request']:>11.1f} {sum(median.values()):>9.1f}  "
+              f"{', '.join(runs[-1]['heavy']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
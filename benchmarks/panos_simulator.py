@@ -0,0 +1,353 @@
+"""
+Local stand-in for the PAN-OS XML API of a whole fleet, for load-testing the poller.
+
+One process simulates thousands of firewalls. Firewall N answers on 127.1.x.y (every 127/8 address
+is loopback on Linux), and 127.0.0.1 answers as a Panorama that manages them all, including
+proxied calls with target=<serial>. Every op/config/keygen command the monitor sends is answered in
+the shape the monitor's parsers expect. Interface counters grow with a per-interface rate and a
+daily cycle, so polled throughput looks like real traffic.
+
+Latency, error rate, unreachable devices and response sizes are configurable:
+
+    python benchmarks/panos_simulator.py --devices 2000 --port 8443 --latency-ms 30 --hosts-file fleet.txt
+
+then import fleet.txt on the Manage Firewalls page (firewall credentials can be anything), or point
+the Panorama settings at 127.0.0.1:8443.
+"""
+import argparse
+import datetime
+import ipaddress
+import json
+import math
+import os
+import random
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+PANORAMA_ADDRESS = '127.0.0.1'
+PANORAMA_KEY = 'SIM-PANORAMA-KEY'
+FIRST_DEVICE_ADDRESS = ipaddress.ip_address('127.1.0.1')
+
+# (model, interfaces, dataplane cores, max sessions, object scale)
+MODELS = [
+    ('PA-440', 8, 2, 64000, 1),
+    ('PA-460', 8, 4, 128000, 1),
+    ('PA-3220', 12, 6, 1000000, 4),
+    ('PA-3430', 16, 12, 1500000, 6),
+    ('PA-5250', 20, 24, 8000000, 12),
+    ('PA-VM', 6, 4, 250000, 2),
+]
+SW_VERSIONS = ['10.1.11', '10.2.9', '11.0.4', '11.1.3', '11.2.2']
+SECONDS_PER_DAY = 86400
+
+
+class SimulatedDevice:
+    """One firewall: identity, object counts and interface counters that grow over time."""
+    def __init__(self, index, rng, scale=1.0):
+        self.index = index
+        self.address = str(FIRST_DEVICE_ADDRESS + index)
+        self.serial = f"0079{index:08d}"
+        self.hostname = f"sim-fw-{index:05d}"
+        self.model, interfaces, self.cores, self.max_sessions, objects = rng.choice(MODELS)
+        self.sw_version = rng.choice(SW_VERSIONS)
+        self.advanced_routing = self.sw_version >= '10.2' and rng.random() < 0.3
+        self.api_key = f"SIM-KEY-{self.serial}"
+        self.phase = rng.random() * 2 * math.pi
+        self.counter_base = rng.getrandbits(40)
+        # Physical ports with their own average rate (bytes/s) and packet size, then logical interfaces
+        self.ports = [(f"ethernet1/{n}", rng.lognormvariate(14, 1.5), rng.uniform(400, 1200)) for n in range(1, interfaces + 1)]
+        sized = lambda base: int(base * objects * scale * rng.uniform(0.5, 1.5))
+        self.counts = {
+            'rules': sized(200), 'nat-rules': sized(40), 'address': sized(800), 'service': sized(120), 'ipsec': sized(10),
+            'routes': sized(150), 'mroutes': sized(5), 'bfd': sized(4), 'arp': sized(60), 'dns_cache': sized(300),
+            'registered_ips': sized(500), 'ssl_decrypt': sized(20),
+        }
+
+    def counters(self, now):
+        """{name: (ibytes, obytes, ipackets, opackets)} at time `now`: each port's average rate, 40% higher at peak hour."""
+        result = {}
+        for n, (name, rate, packet_size) in enumerate(self.ports):
+            # Integral of rate * (1 + 0.4 * sin(2*pi*t/day + phase)), so counters only ever grow
+            angle = 2 * math.pi * now / SECONDS_PER_DAY + self.phase
+            total = self.counter_base + rate * (now - 0.4 * SECONDS_PER_DAY / (2 * math.pi) * math.cos(angle))
+            ibytes, obytes = int(total), int(total * (0.6 + 0.05 * (n % 8)))
+            result[name] = (ibytes, obytes, int(ibytes / packet_size), int(obytes / packet_size))
+        first, second = result[self.ports[0][0]], result[self.ports[1 % len(self.ports)][0]]
+        result['ae1'] = tuple(a + b for a, b in zip(first, second))
+        result['ethernet1/1.10'] = tuple(v // 3 for v in first)
+        result['tunnel.1'] = tuple(v // 10 for v in second)
+        result['loopback.1'] = (0, 0, 0, 0)
+        result['vlan'] = (0, 0, 0, 0)
+        return result
+
+    def throughput_kbps(self, now):
+        angle = 2 * math.pi * now / SECONDS_PER_DAY + self.phase
+        return int(sum(rate for _, rate, _ in self.ports) * 8 / 1000 * (1 + 0.4 * math.sin(angle)))
+
+
+def _ok(result):
+    return f'<response status="success"><result>{result}</result></response>'
+
+
+def _entries(count, fields):
+    return ''.join(f'<entry name="e{n}">{fields}</entry>' for n in range(count))
+
+
+class Simulator:
+    """
+    Threaded HTTPS (or plain HTTP) server answering for every simulated device and for Panorama.
+
+    latency and jitter are seconds per call; error_rate is the fraction of calls answered with HTTP
+    503; down_fraction of the devices drop every connection; scale multiplies list response sizes.
+    It listens on all addresses, so run it on a test machine only.
+    """
+    def __init__(self, devices, port=0, latency=0.0, jitter=0.0, error_rate=0.0, down_fraction=0.0, scale=1.0, tls=True, seed=1):
+        rng = random.Random(seed)
+        self.devices = [SimulatedDevice(i, rng, scale) for i in range(devices)]
+        self.by_address = {d.address: d for d in self.devices}
+        self.by_serial = {d.serial: d for d in self.devices}
+        self.down = {d.address for d in rng.sample(self.devices, int(devices * down_fraction))}
+        self.latency, self.jitter, self.error_rate = latency, jitter, error_rate
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed + 1)
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                simulator._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self.port = self.server.server_address[1]
+        if tls:
+            # The handshake runs on the request's own thread, not on the accept loop
+            self.server.socket = _tls_context().wrap_socket(self.server.socket, server_side=True, do_handshake_on_connect=False)
+        self.scheme = 'https' if tls else 'http'
+        self.panorama_host = f"{PANORAMA_ADDRESS}:{self.port}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def hosts(self, count=None):
+        """'address:port' host strings for the first `count` devices, as the monitor stores them."""
+        return [f"{d.address}:{self.port}" for d in self.devices[:count]]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, handler):
+        address = handler.headers.get('Host', '').rsplit(':', 1)[0]
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            fail = self._rng.random() < self.error_rate
+            delay = self.latency + (self._rng.expovariate(1 / self.jitter) if self.jitter else 0)
+        try:
+            if address in self.down:
+                handler.close_connection = True
+                return
+            if delay:
+                time.sleep(delay)
+            params = {k: v[0] for k, v in parse_qs(urlsplit(handler.path).query).items()}
+            if fail:
+                with self._lock:
+                    self.errors += 1
+                status, body = 503, '<response status="error"><msg><line>Simulated management plane error</line></msg></response>'
+            else:
+                status, body = 200, self.respond(address, params)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        payload = body.encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/xml; charset=UTF-8')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def respond(self, address, params):
+        """The XML body for one API call to the device (or Panorama) at `address`."""
+        request_type = params.get('type')
+        if address == PANORAMA_ADDRESS:
+            if request_type == 'keygen':
+                return _ok(f'<key>{PANORAMA_KEY}</key>')
+            if params.get('key') != PANORAMA_KEY:
+                return '<response status="error" code="403"><result><msg>Invalid credential</msg></result></response>'
+            if 'target' in params:
+                device = self.by_serial.get(params['target'])
+                if device is None or device.address in self.down:
+                    return '<response status="error"><msg><line>Device not connected</line></msg></response>'
+                return self._device_response(device, params)
+            if '<devices>' in params.get('cmd', ''):
+                return self._panorama_devices()
+            return _ok('')
+        device = self.by_address.get(address)
+        if device is None:
+            return '<response status="error"><msg><line>Unknown device</line></msg></response>'
+        if request_type == 'keygen':
+            return _ok(f'<key>{device.api_key}</key>')
+        if params.get('key') != device.api_key:
+            return '<response status="error" code="403"><result><msg>Invalid credential</msg></result></response>'
+        return self._device_response(device, params)
+
+    def _panorama_devices(self):
+        entries = ''.join(
+            f'<entry name="{d.serial}"><serial>{d.serial}</serial><connected>{"no" if d.address in self.down else "yes"}</connected>'
+            f'<hostname>{d.hostname}</hostname><ip-address>{d.address}:{self.port}</ip-address><model>{d.model}</model>'
+            f'<sw-version>{d.sw_version}</sw-version><ha><state>{"active" if d.index % 2 == 0 else "passive"}</state></ha></entry>'
+            for d in self.devices)
+        return _ok(f'<devices>{entries}</devices>')
+
+    def _device_response(self, device, params):
+        now = time.time()
+        counts = device.counts
+        if params.get('type') == 'config':
+            key = params.get('xpath', '').rsplit('/', 1)[-1]
+            key = {'rules': 'nat-rules' if '/nat/' in params.get('xpath', '') else 'rules'}.get(key, key)
+            return _ok(f'<{key}>{_entries(counts.get(key, 0), "<description>simulated</description>")}</{key}>')
+
+        cmd = params.get('cmd', '')
+        if '<system><info/>' in cmd:
+            return _ok(f'<system><hostname>{device.hostname}</hostname><ip-address>{device.address}</ip-address><model>{device.model}</model>'
+                       f'<serial>{device.serial}</serial><sw-version>{device.sw_version}</sw-version>'
+                       f'<advanced-routing>{"on" if device.advanced_routing else "off"}</advanced-routing></system>')
+        if '<session><info/>' in cmd:
+            active = int(device.max_sessions * (0.2 + 0.15 * math.sin(2 * math.pi * now / SECONDS_PER_DAY + device.phase)))
+            return _ok(f'<num-max>{device.max_sessions}</num-max><num-active>{active}</num-active><num-tcp>{active * 3 // 4}</num-tcp>'
+                       f'<num-udp>{active // 4}</num-udp><kbps>{device.throughput_kbps(now)}</kbps><pps>{device.throughput_kbps(now) // 5}</pps>')
+        if '<counter><interface>' in cmd:
+            counters = device.counters(now)
+            ifnet = ''.join(f'<entry><name>{name}</name><ibytes>{c[0]}</ibytes><obytes>{c[1]}</obytes><ipackets>{c[2]}</ipackets><opackets>{c[3]}</opackets>'
+                            f'<ierrors>0</ierrors><idrops>0</idrops><flowstate>0</flowstate><macspoof>0</macspoof></entry>' for name, c in counters.items())
+            hw = ''.join(f'<entry><name>{name}</name><ibytes>{c[0]}</ibytes><obytes>{c[1]}</obytes><ipackets>{c[2]}</ipackets><opackets>{c[3]}</opackets>'
+                         f'<ierrors>0</ierrors><idrops>0</idrops><port><rx-bytes>{c[0]}</rx-bytes><tx-bytes>{c[1]}</tx-bytes></port></entry>'
+                         for name, c in counters.items() if name.startswith('ethernet') and '.' not in name)
+            return _ok(f'<ifnet><entry-count>{len(counters)}</entry-count><ifnet>{ifnet}</ifnet></ifnet><hw>{hw}</hw>')
+        if '<system><resources/>' in cmd:
+            cpu = 3 + 10 * random.random()
+            processes = '\n'.join(f' {1000 + n:5d} root      20   0  {random.randint(10000, 900000)}  {random.randint(1000, 90000)}   8000 S   0.{n % 10}   0.{n % 7}   1:{n:02d}.00 proc{n}'
+                                  for n in range(60))
+            return _ok(f'<![CDATA[top - {datetime.datetime.now():%H:%M:%S} up 42 days,  3:12,  0 users,  load average: 1.02, 0.98, 0.95\n'
+                       f'Tasks: 180 total,   1 running, 179 sleeping,   0 stopped,   0 zombie\n'
+                       f'%Cpu(s):  {cpu:.1f} us,  2.1 sy,  0.3 ni, {95 - cpu:.1f} id,  0.1 wa,  0.0 hi,  0.1 si,  0.0 st\n'
+                       f'MiB Mem :  16000.0 total,   1800.0 free,  {9000 + 2000 * random.random():.1f} used,   5200.0 buff/cache\n'
+                       f'MiB Swap:   4000.0 total,   3990.0 free,     10.0 used.   5900.0 avail Mem\n\n'
+                       f'  PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM     TIME+ COMMAND\n{processes}\n]]>')
+        if 'resource-monitor' in cmd:
+            load = lambda core: int(15 + 30 * (0.5 + 0.5 * math.sin(2 * math.pi * now / SECONDS_PER_DAY + device.phase + core)))
+            cores = ''.join(f'<entry><coreid>{core}</coreid><value>{load(core)}</value></entry>' for core in range(device.cores))
+            sessions = ''.join(f'<entry><coreid>{core}</coreid><value>{load(core) // 2}</value></entry>' for core in range(device.cores))
+            return _ok(f'<resource-monitor><data-processors><dp0><minute><cpu-load-average>{cores}</cpu-load-average>'
+                       f'<cpu-load-maximum>{cores}</cpu-load-maximum><session>{sessions}</session></minute></dp0></data-processors></resource-monitor>')
+        if '<ssl-decrypt>yes</ssl-decrypt><count>yes</count>' in cmd:
+            return _ok(f'Number of sessions that match filter: {counts["ssl_decrypt"]}')
+        if '<ssl-decrypt>yes</ssl-decrypt>' in cmd:
+            return _ok(_entries(counts['ssl_decrypt'], '<vsys>vsys1</vsys><proto>6</proto><decrypt-mirror>False</decrypt-mirror><application>ssl</application>'))
+        if '<state><filter>cfg.general.*' in cmd:
+            lines = [f"cfg.general.max-session: {device.max_sessions}", f"cfg.general.max-policy-rule: {counts['rules'] * 5}",
+                     f"cfg.general.max-nat-policy-rule: {counts['nat-rules'] * 5}", f"cfg.general.max-address: {hex(counts['address'] * 4)}",
+                     f"cfg.general.max-service: {counts['service'] * 4}", f"cfg.general.max-tunnel: {counts['ipsec'] * 10}",
+                     f"cfg.general.max-route: {counts['routes'] * 20}", f"cfg.general.max-arp: {counts['arp'] * 20}",
+                     f"cfg.general.max-dns-cache: {counts['dns_cache'] * 10}", f"cfg.general.max-registered-ip-address: {counts['registered_ips'] * 10}",
+                     f"cfg.general.max-bfd-session: {max(counts['bfd'], 1) * 32}", f"cfg.general.max-mroute: {max(counts['mroutes'], 1) * 50}",
+                     f"cfg.general.advance-routing-enabled: {device.advanced_routing}", "cfg.general.max-vsys: 1",
+                     "cfg.general.max-zone: [ 0x80, 0x200 ]"]
+            return _ok('<![CDATA[' + '\n'.join(lines) + ']]>')
+        if '<advanced-routing>' in cmd and '<route>' in cmd:
+            key = 'mroutes' if '<multicast>' in cmd else 'routes'
+            routes = {f"10.{n // 256}.{n % 256}.0/24": [{'nexthop': '192.0.2.1', 'protocol': 'static'}] for n in range(counts[key])}
+            return _ok(f'<json>{json.dumps({"default": routes})}</json>')
+        if '<routing><multicast>' in cmd:
+            lines = ['Flags: S=static, D=dynamic'] + [f"239.1.{n // 256}.{n % 256}  10.0.0.1  ethernet1/1" for n in range(counts['mroutes'])]
+            return _ok('<![CDATA[' + '\n'.join(lines) + ']]>')
+        if '<routing><route>' in cmd:
+            return _ok(f'<routing-table><ip>{_entries(counts["routes"], "<nexthop>192.0.2.1</nexthop><flags>A S</flags>")}</ip></routing-table>')
+        if '<bfd><summary/>' in cmd:
+            return _ok(_entries(counts['bfd'], '<state>up</state>'))
+        if '<arp>' in cmd:
+            return _ok(f'<max>{counts["arp"] * 20}</max><total>{counts["arp"]}</total><entries>{_entries(counts["arp"], "<status>c</status><interface>ethernet1/1</interface>")}</entries>')
+        if '<dns-proxy><cache>' in cmd:
+            return _ok(f'<msg>Cache: default</msg><msg>entries: {counts["dns_cache"]}</msg>')
+        if '<ip-user-mapping>' in cmd:
+            return _ok(_entries(counts['registered_ips'], '<vsys>vsys1</vsys><type>UIA</type><user>corp\\user</user>'))
+        if '<clock>' in cmd:
+            return _ok(f'{datetime.datetime.now():%a %b %d %H:%M:%S} UTC {datetime.datetime.now():%Y}\n')
+        return '<response status="error"><msg><line>Unsupported command</line></msg></response>'
+
+
+def _tls_context():
+    """Server TLS context with a throwaway self-signed certificate (the monitor does not verify certificates)."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'panos-simulator')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number()).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=30))
+            .sign(key, hashes.SHA256()))
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    with tempfile.TemporaryDirectory() as tmp:
+        cert_file, key_file = os.path.join(tmp, 'cert.pem'), os.path.join(tmp, 'key.pem')
+        with open(cert_file, 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with open(key_file, 'wb') as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+        context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+def add_arguments(parser):
+    """Simulator options, shared with the benchmarks that start one."""
+    parser.add_argument('--latency-ms', type=float, default=20, help="base response time per API call")
+    parser.add_argument('--jitter-ms', type=float, default=10, help="mean of the exponential extra delay per call")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls answered with HTTP 503")
+    parser.add_argument('--down-fraction', type=float, default=0.0, help="fraction of devices that drop every connection")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplier for list sizes (rules, routes, ARP, sessions, ...)")
+
+
+def from_arguments(args, devices, port=0):
+    return Simulator(devices, port=port, latency=args.latency_ms / 1000.0, jitter=args.jitter_ms / 1000.0,
+                     error_rate=args.error_rate, down_fraction=args.down_fraction, scale=args.scale)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--hosts-file', help="write the device hosts here, one per line, for the firewall import")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = from_arguments(args, args.devices, args.port)
+    if args.hosts_file:
+        with open(args.hosts_file, 'w') as f:
+            f.write('\n'.join(simulator.hosts()) + '\n')
+    print(f"Simulating {args.devices:,} firewalls on 127.1.0.1-{simulator.devices[-1].address} and Panorama on {simulator.panorama_host} (port {simulator.port})")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"{simulator.calls:,} calls, {simulator.errors:,} errors")
+    except KeyboardInterrupt:
+        simulator.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Records a firewall's responses to the API calls the poller parses, for the parser corpus used by
+bench_parsers.py.
+
+    python benchmarks/record_responses.py --host 192.0.2.10 --user admin
+
+Responses are written to benchmarks/corpus/<model>_<version>/ (or --label) with IPv4 addresses,
+the hostname, serial and MAC addresses replaced, together with an expected.json holding what the
+current parsers read from them. Check expected.json against the firewall's CLI output before
+committing a new recording: it is what every later parser change is checked against.
+"""
+import argparse
+import getpass
+import json
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+
+import requests
+from urllib3.exceptions import InsecureRequestWarning
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+import panos_parsers
+
+CORPUS_DIR = os.path.join(BENCH_DIR, 'corpus')
+
+# Corpus file -> op command, as the poller sends them
+COMMANDS = {
+    'session_info.xml': '<show><session><info/></session></show>',
+    'interface_counters.xml': '<show><counter><interface>all</interface></counter></show>',
+    'system_resources.xml': '<show><system><resources/></system></show>',
+    'resource_monitor.xml': '<show><running><resource-monitor><minute><last>1</last></minute></resource-monitor></running></show>',
+    'ssl_decrypt_sessions.xml': '<show><session><all><filter><ssl-decrypt>yes</ssl-decrypt></filter></all></session></show>',
+    'system_info.xml': '<show><system><info/></system></show>',
+    'system_state.xml': '<show><system><state><filter>cfg.general.*</filter></state></system></show>',
+}
+
+_IPV4_RE = re.compile(rb'\b(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})\b')
+_MAC_RE = re.compile(rb'\b[0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5}\b')
+
+
+def expected_values(responses):
+    """What the parsers read from one device's responses, in expected.json form."""
+    return {
+        'session_info': list(panos_parsers.parse_session_info(responses['session_info.xml'])),
+        'interface_counters': {name: list(c) for name, c in panos_parsers.parse_interface_counters(responses['interface_counters.xml']).items()},
+        'interface_counters_all': len(panos_parsers.parse_interface_counters(responses['interface_counters.xml'], all_interfaces=True)),
+        'system_resources': list(panos_parsers.parse_system_resources(responses['system_resources.xml'])),
+        'dataplane_load': panos_parsers.parse_dataplane_load(responses['resource_monitor.xml']),
+        'ssl_decrypt_sessions': panos_parsers.count_ssl_decrypt_sessions(responses['ssl_decrypt_sessions.xml']),
+        'system_info': panos_parsers.parse_system_info(responses['system_info.xml']),
+        'system_state': panos_parsers.parse_system_state(responses['system_state.xml']),
+    }
+
+
+def _redact(responses):
+    info = ET.fromstring(responses['system_info.xml'])
+    replacements = {info.findtext('.//hostname'): 'recorded-fw', info.findtext('.//devicename'): 'recorded-fw', info.findtext('.//serial'): '000000000000'}
+    addresses = {}
+
+    def address(match):
+        # Every distinct address maps to its own address in 10.0.0.0/8, so counts and grouping survive
+        n = addresses.setdefault(match.group(0), len(addresses) + 1)
+        return b'10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+
+    for name, body in responses.items():
+        for secret, placeholder in replacements.items():
+            if secret:
+                body = body.replace(secret.encode(), placeholder.encode())
+        # Version strings such as 10.2.9 have three parts, so only dotted quads are touched
+        body = _IPV4_RE.sub(lambda m: address(m) if all(int(part) < 256 for part in m.groups()) else m.group(0), body)
+        responses[name] = _MAC_RE.sub(b'00:00:00:00:00:00', body)
+    return responses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', required=True)
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', help="prompted for when not given")
+    parser.add_argument('--label', help="corpus directory name (default: <model>_<version>)")
+    parser.add_argument('--corpus', default=CORPUS_DIR)
+    args = parser.parse_args()
+    password = args.password or getpass.getpass(f"Password for {args.user}@{args.host}: ")
+
+    requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
+    response = requests.post(f"https://{args.host}/api/?type=keygen", data={'user': args.user, 'password': password}, verify=False, timeout=15)
+    response.raise_for_status()
+    api_key = ET.fromstring(response.content).findtext('.//key')
+    if not api_key:
+        sys.exit(f"Could not get an API key from {args.host}")
+
+    responses = {}
+    for name, cmd in COMMANDS.items():
+        response = requests.get(f"https://{args.host}/api/", params={'type': 'op', 'cmd': cmd, 'key': api_key}, verify=False, timeout=60)
+        response.raise_for_status()
+        responses[name] = response.content
+        print(f"{name:<26} {len(response.content):>10,} bytes")
+
+    info = panos_parsers.parse_system_info(responses['system_info.xml'])
+    label = args.label or f"{info['model']}_{info['sw_version']}".lower()
+    directory = os.path.join(args.corpus, label)
+    os.makedirs(directory, exist_ok=True)
+    responses = _redact(responses)
+    for name, body in responses.items():
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(body)
+    with open(os.path.join(directory, 'expected.json'), 'w') as f:
+        json.dump(expected_values(responses), f, indent=1, sort_keys=True)
+        f.write('\n')
+    print(f"Recorded to {directory}; review expected.json before committing it.")
+
+
+if __name__ == '__main__':
+    main()
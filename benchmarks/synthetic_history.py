@@ -0,0 +1,140 @@
+"""
+Fills a monitoring database with a synthetic fleet and its history, for load and query benchmarks.
+
+Creates N firewalls (models from the seeded model specs) with D days of stats samples at the poll
+interval, following a daily traffic cycle with noise and occasional bursts, plus capacity specs,
+current capacity usage and a history of capacity alerts (open, acknowledged and archived).
+
+    python benchmarks/synthetic_history.py --db monitoring.db --firewalls 200 --days 30
+
+Never point --db at a production database: existing rows are kept, but a large history is added.
+"""
+import argparse
+import contextlib
+import io
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app
+
+SW_VERSIONS = ['10.1.11', '10.2.9', '11.0.4', '11.1.3', '11.2.2']
+# Per-model capacity limits derived from max sessions: (firewall_details column, current usage column, divisor)
+CAPACITY_SCALE = [
+    ('max_rules', 'current_rules', 50), ('max_nat_rules', 'current_nat_rules', 200), ('max_address_objects', 'current_address_objects', 10),
+    ('max_service_objects', 'current_service_objects', 50), ('max_ipsec_tunnels', 'current_ipsec_tunnels', 500),
+    ('max_routes', 'current_routes', 20), ('max_mroutes', 'current_mroutes', 100), ('max_arp_entries', 'current_arp_entries', 20),
+    ('max_bfd_sessions', 'current_bfd_sessions', 1000), ('max_dns_cache', 'current_dns_cache', 10),
+    ('max_registered_ips', 'current_registered_ips', 5),
+]
+BATCH_ROWS = 200000
+
+
+def generate(db_file, firewalls=50, days=30, interval=30, seed=1, end=None, progress=print):
+    """
+    Adds `firewalls` firewalls with `days` of history ending at `end` (default now) to db_file,
+    creating the schema if needed. Returns the number of stats rows written.
+    """
+    rng = random.Random(seed)
+    end = end or datetime.now()
+    app.DB_FILE = db_file
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.init_db()
+    conn = app.get_db_connection()
+    # Bulk load: no fsync per batch; the file is only consistent once generate() returns
+    conn.execute('PRAGMA synchronous = OFF')
+
+    models = [dict(row) for row in conn.execute('SELECT * FROM firewall_models WHERE max_sessions > 0 AND max_throughput_mbps > 0').fetchall()]
+    first_id = (conn.execute('SELECT MAX(id) FROM firewalls').fetchone()[0] or 0) + 1
+    fleet = []
+    for fw_id in range(first_id, first_id + firewalls):
+        model = rng.choice(models)
+        fleet.append({
+            'id': fw_id, 'model': model,
+            # Typical load as a share of the model's capacity; a few firewalls run hot
+            'load': min(0.95, rng.betavariate(2, 5) * (1.6 if rng.random() < 0.1 else 1.0)),
+            'phase': rng.uniform(-1, 1),
+            'ssl_share': rng.uniform(0.0, 0.3),
+        })
+        conn.execute("INSERT INTO firewalls (id, ip_address, hostname, model, sw_version, serial, status, last_checked, source) VALUES (?, ?, ?, ?, ?, ?, 'success', ?, 'manual')",
+                     (fw_id, f"10.{fw_id // 65536}.{(fw_id // 256) % 256}.{fw_id % 256}", f"synthetic-fw-{fw_id:05d}", model['model'],
+                      rng.choice(SW_VERSIONS), f"0099{fw_id:08d}", end.isoformat(sep=' ')))
+
+    # Capacity specs and current usage, a few firewalls close to their limits
+    for fw in fleet:
+        max_sessions = fw['model']['max_sessions']
+        limits = {column: max(1, max_sessions // divisor) for column, _, divisor in CAPACITY_SCALE}
+        usage = {current: int(limits[column] * min(1.0, rng.betavariate(2, 4) * (1.8 if rng.random() < 0.05 else 1.0))) for column, current, _ in CAPACITY_SCALE}
+        usage['current_ssl_decrypt_sessions'] = int((fw['model']['max_ssl_decrypt_sessions'] or 0) * fw['ssl_share'] * fw['load'])
+        conn.execute(f"INSERT OR REPLACE INTO firewall_details (firewall_id, max_sessions, {', '.join(limits)}) VALUES (?, ?, {', '.join('?' * len(limits))})",
+                     (fw['id'], max_sessions, *limits.values()))
+        conn.execute(f"INSERT OR REPLACE INTO firewall_current_usage (firewall_id, last_updated, {', '.join(usage)}) VALUES (?, ?, {', '.join('?' * len(usage))})",
+                     (fw['id'], end.isoformat(sep=' '), *usage.values()))
+    with contextlib.redirect_stdout(io.StringIO()):
+        app._re_evaluate_alerts(conn, 80)
+
+    # Acknowledged alerts spread over the history; those past the archive age go to the archive
+    labels = [label for label, _, _ in app.ALERT_METRICS]
+    archive_cutoff = end - timedelta(days=30)
+    for fw in rng.sample(fleet, max(1, firewalls // 4)):
+        for _ in range(rng.randint(1, max(1, days // 3))):
+            when = end - timedelta(seconds=rng.uniform(0, days * 86400))
+            table = 'alerts_archive' if when < archive_cutoff else 'alerts'
+            conn.execute(f"INSERT INTO {table} (firewall_id, metric_name, utilization, timestamp, acknowledged) VALUES (?, ?, ?, ?, 1)",
+                         (fw['id'], rng.choice(labels), rng.uniform(80, 100), when.isoformat()))
+    conn.commit()
+
+    # Stats samples in time order, interleaved across the fleet as the poller writes them
+    samples = int(days * 86400 // interval)
+    start = end - timedelta(seconds=samples * interval)
+    written = 0
+    rows = []
+    started = time.perf_counter()
+    for n in range(samples):
+        when = start + timedelta(seconds=n * interval)
+        timestamp = when.isoformat(sep=' ', timespec='microseconds')
+        day_fraction = (when.hour * 3600 + when.minute * 60 + when.second) / 86400
+        for fw in fleet:
+            model = fw['model']
+            # Daily cycle peaking mid-afternoon (shifted per firewall), with noise and rare bursts
+            cycle = 0.55 + 0.45 * math.sin(2 * math.pi * (day_fraction - 0.375) + fw['phase'])
+            level = fw['load'] * cycle * rng.uniform(0.9, 1.1) * (1.5 if rng.random() < 0.002 else 1.0)
+            throughput_bps = model['max_throughput_mbps'] * 1e6 * level
+            sessions = int(model['max_sessions'] * min(1.0, level * 1.1))
+            rows.append((fw['id'], timestamp, sessions, int(sessions * fw['ssl_share'] * 0.1), throughput_bps, throughput_bps * rng.uniform(0.3, 0.9),
+                         min(100.0, 5 + 40 * level + rng.uniform(0, 5)), min(100.0, 100 * level * rng.uniform(0.8, 1.2)), 40 + 30 * level + rng.uniform(0, 5)))
+        if len(rows) >= BATCH_ROWS or n == samples - 1:
+            conn.executemany('INSERT INTO stats (firewall_id, timestamp, active_sessions, ssl_decrypt_sessions, total_input_bps, total_output_bps, cpu_load, dataplane_load, memory_utilization) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.commit()
+            written += len(rows)
+            rows = []
+            if progress:
+                rate = written / (time.perf_counter() - started)
+                progress(f"  {written:,} / {samples * firewalls:,} stats rows ({rate:,.0f} rows/s)")
+    app.rebuild_hourly_peaks(conn)
+    conn.commit()
+    conn.close()
+    app.bump_data_version()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=app.DB_FILE)
+    parser.add_argument('--firewalls', type=int, default=50)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--interval', type=int, default=30, help="seconds between samples")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    written = generate(args.db, args.firewalls, args.days, args.interval, args.seed)
+    print(f"Wrote {written:,} stats rows for {args.firewalls:,} firewalls x {args.days} days to {args.db} in {time.perf_counter() - start:.1f}s "
+          f"({os.path.getsize(args.db) / 2 ** 20:,.0f} MiB)")
+
+
+if __name__ == '__main__':
+    main()
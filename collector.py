@@ -0,0 +1,63 @@
+"""
+Standalone collector: runs the poller in a process of its own, sharing monitoring.db and secret.key
+(run it from the same directory as the web app), so the web UI can run under a multi-worker WSGI
+server without polling being lost or duplicated:
+
+    python collector.py
+    gunicorn -k gthread -w 4 --threads 32 -b 0.0.0.0:4000 app:app
+
+(threaded workers: every open page holds a /stream connection for live updates, which would tie up
+a sync worker for good.)
+
+Several collectors can run against one database: they share the fleet through leases held in it
+(see collector_lease.py), so each firewall is polled by one collector and the others stand by to
+take over (or, with COLLECTOR_SHARDS above 1, each polls a share of the fleet). Each collector's
+live statistics (/metrics, /poller_stats and /internal/collector) are only known in its own
+process, so it serves them itself on --metrics-port, on localhost unless --metrics-host says
+otherwise (only those pages are served there; give each collector a port of its own).
+"""
+import argparse
+import signal
+import sys
+import threading
+
+from werkzeug.exceptions import NotFound
+from werkzeug.serving import make_server
+
+import app
+
+# The only pages served on the metrics port; the rest of the web app (settings, firewalls, reports)
+# stays behind the web server
+METRICS_PATHS = {'/metrics', '/poller_stats', '/internal/collector', '/internal/collector.json'}
+
+
+def metrics_app(environ, start_response):
+    """WSGI app serving the collector's statistics pages (and the static files they use) from the web app."""
+    path = environ.get('PATH_INFO', '')
+    if path in METRICS_PATHS or path.startswith('/static/'):
+        return app.app(environ, start_response)
+    return NotFound()(environ, start_response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--metrics-host', default='127.0.0.1', help="address for the metrics port (0.0.0.0 for a Prometheus on another host)")
+    parser.add_argument('--metrics-port', type=int, default=4001, help="port for /metrics and the collector pages (0 to disable)")
+    args = parser.parse_args()
+
+    app.load_key()
+    app.init_db()
+    if args.metrics_port:
+        server = make_server(args.metrics_host, args.metrics_port, metrics_app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Collector metrics on http://{args.metrics_host}:{args.metrics_port}/metrics")
+    # Stopping (Ctrl-C or SIGTERM) hands the leases over at once rather than after they expire
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        app.background_worker_loop()
+    finally:
+        app.release_collector_leases()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import math
+import os
+import socket
+import time
+import uuid
+
+# Leases that decide which collector polls which firewalls when several collector processes (or
+# several app instances) share one database. The fleet is split into COLLECTOR_SHARDS shards by
+# firewall id (firewall_id % shards; a single shard by default, i.e. one active collector and any
+# others on standby). Each shard is leased to one collector at a time; every collector renews its
+# leases on each heartbeat and takes up free or expired shards up to a fair share of the collectors
+# currently alive, so a standby takes over within LEASE_SECONDS plus one heartbeat of a collector
+# stopping, and shards rebalance when collectors join or leave.
+#
+# A collector only polls, and only writes results for, firewalls whose shard lease it renewed less
+# than LEASE_SECONDS - SAFETY_MARGIN_SECONDS ago, so a collector that cannot reach the database (or
+# stalls) stops before another one can take its shards over.
+
+LEASE_SECONDS = 30
+SAFETY_MARGIN_SECONDS = 5
+
+
+def create_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS collector_members (
+            holder TEXT PRIMARY KEY,
+            host TEXT,
+            pid INTEGER,
+            started_at REAL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS collector_leases (
+            shard INTEGER PRIMARY KEY,
+            holder TEXT NOT NULL,
+            acquired_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+
+def shard_of(firewall_id, shards):
+    return firewall_id % shards
+
+
+class CollectorLease:
+    """This collector's membership and shard leases. Used from the poller thread only."""
+    def __init__(self, holder=None, lease_seconds=LEASE_SECONDS, safety_margin=SAFETY_MARGIN_SECONDS):
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.holder = holder or f"{self.host}:{self.pid}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.safety_margin = safety_margin
+        self.started = time.time()
+        self.shards = 1
+        self.held = set()        # Shards leased at the last successful heartbeat
+        self.renewed_at = None   # Time of that heartbeat
+
+    def heartbeat(self, conn, shards, now):
+        """
+        Renews this collector's membership and shard leases, releases shards above its fair share,
+        and acquires free or expired shards up to it. Commits. Returns the shards now held.
+        """
+        shards = max(1, shards)
+        expires_at = now + self.lease_seconds
+        conn.execute("""
+            INSERT INTO collector_members (holder, host, pid, started_at, expires_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (holder) DO UPDATE SET expires_at = excluded.expires_at
+        """, (self.holder, self.host, self.pid, self.started, expires_at))
+        conn.execute("DELETE FROM collector_members WHERE expires_at < ?", (now,))
+        # Shards beyond the configured count (it was lowered) are dropped by whoever sees them first
+        conn.execute("DELETE FROM collector_leases WHERE shard >= ?", (shards,))
+        members = conn.execute("SELECT COUNT(*) FROM collector_members").fetchone()[0]
+        fair_share = math.ceil(shards / max(1, members))
+
+        conn.execute("UPDATE collector_leases SET expires_at = ? WHERE holder = ?", (expires_at, self.holder))
+        held = sorted(row[0] for row in conn.execute("SELECT shard FROM collector_leases WHERE holder = ?", (self.holder,)))
+        for shard in held[fair_share:]:
+            conn.execute("DELETE FROM collector_leases WHERE shard = ? AND holder = ?", (shard, self.holder))
+        held = held[:fair_share]
+        for shard in range(shards):
+            if len(held) >= fair_share:
+                break
+            if shard in held:
+                continue
+            conn.execute("""
+                INSERT INTO collector_leases (shard, holder, acquired_at, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (shard) DO UPDATE SET holder = excluded.holder, acquired_at = excluded.acquired_at, expires_at = excluded.expires_at
+                WHERE collector_leases.expires_at < ?
+            """, (shard, self.holder, now, expires_at, now))
+            if conn.execute("SELECT holder FROM collector_leases WHERE shard = ?", (shard,)).fetchone()[0] == self.holder:
+                held.append(shard)
+        conn.commit()
+
+        self.shards = shards
+        self.held = set(held)
+        self.renewed_at = now
+        return self.held
+
+    def valid(self, now):
+        """True while the leases of the last heartbeat can be relied on."""
+        return self.renewed_at is not None and now < self.renewed_at + self.lease_seconds - self.safety_margin
+
+    def owns(self, firewall_id, now):
+        return self.valid(now) and shard_of(firewall_id, self.shards) in self.held
+
+    def release(self, conn):
+        """Gives up this collector's leases and membership at once (on shutdown), so others take over without waiting for expiry."""
+        conn.execute("DELETE FROM collector_leases WHERE holder = ?", (self.holder,))
+        conn.execute("DELETE FROM collector_members WHERE holder = ?", (self.holder,))
+        conn.commit()
+        self.held = set()
+        self.renewed_at = None
+
+
+def any_alive(conn, now=None):
+    """True if a collector process has sent a heartbeat within its lease."""
+    now = time.time() if now is None else now
+    return conn.execute("SELECT 1 FROM collector_members WHERE expires_at >= ? LIMIT 1", (now,)).fetchone() is not None
+
+
+def describe(conn, now=None):
+    """Live collectors with the shards they hold: [{'holder', 'host', 'pid', 'started', 'shards', 'expires_in'}]."""
+    now = time.time() if now is None else now
+    shards = {}
+    for row in conn.execute("SELECT shard, holder FROM collector_leases WHERE expires_at >= ? ORDER BY shard", (now,)).fetchall():
+        shards.setdefault(row[1], []).append(row[0])
+    return [{'holder': row[0], 'host': row[1], 'pid': row[2], 'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row[3])),
+             'shards': shards.get(row[0], []), 'expires_in': row[4] - now}
+            for row in conn.execute("SELECT holder, host, pid, started_at, expires_at FROM collector_members WHERE expires_at >= ? ORDER BY started_at", (now,)).fetchall()]
@@ -0,0 +1,324 @@
+import bisect
+import collections
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+# Latency histogram bucket upper bounds (seconds); the last bucket takes everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Recent values kept per ring buffer (scheduling lag, job durations, database writes, queue depths)
+RING_SIZE = 1000
+
+# Op command substring -> short name, checked in order (more specific first)
+COMMAND_NAMES = [
+    ('<session><info/>', 'session_info'),
+    ('<counter><interface>', 'interface_counters'),
+    ('<system><resources/>', 'system_resources'),
+    ('<resource-monitor>', 'resource_monitor'),
+    ('<ssl-decrypt>yes</ssl-decrypt><count>', 'ssl_decrypt_count'),
+    ('<ssl-decrypt>yes</ssl-decrypt>', 'ssl_decrypt_sessions'),
+    ('<system><info/>', 'system_info'),
+    ('<state><filter>cfg.general', 'system_state'),
+    ('<advanced-routing><multicast>', 'mroutes'),
+    ('<routing><multicast>', 'mroutes'),
+    ('<advanced-routing><route>', 'routes'),
+    ('<routing><route>', 'routes'),
+    ('<bfd>', 'bfd_sessions'),
+    ('<arp>', 'arp_entries'),
+    ('<dns-proxy>', 'dns_cache'),
+    ('<ip-user-mapping>', 'registered_ips'),
+    ('<clock>', 'clock'),
+]
+
+
+def command_name(url, params=None):
+    """Short name of the API call in a request: an op command's name, 'config:<element>' or 'keygen'."""
+    query = {key: values[0] for key, values in parse_qs(urlsplit(url).query).items()}
+    query.update(params or {})
+    call_type = query.get('type', '')
+    if call_type == 'config':
+        return 'config:' + query.get('xpath', '').rstrip('/').rsplit('/', 1)[-1].split('[', 1)[0]
+    if call_type != 'op':
+        return call_type or 'other'
+    cmd = query.get('cmd', '')
+    for fragment, name in COMMAND_NAMES:
+        if fragment in cmd:
+            return name
+    return 'op'
+
+
+class LatencyHistogram:
+    """Fixed-bucket histogram of durations, with count, sum and maximum."""
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (the maximum for the overflow bucket)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(LATENCY_BUCKETS[i], self.max) if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count, 'total_seconds': self.total, 'mean_seconds': self.total / self.count if self.count else 0.0,
+                'p50_seconds': self.quantile(0.5), 'p95_seconds': self.quantile(0.95), 'max_seconds': self.max,
+                'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], self.buckets))}
+
+
+class _CallStats:
+    __slots__ = ('latency', 'response_bytes', 'errors', 'parse_seconds', 'parses')
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.response_bytes = 0
+        self.errors = 0
+        self.parse_seconds = 0.0
+        self.parses = 0
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.response_bytes += other.response_bytes
+        self.errors += other.errors
+        self.parse_seconds += other.parse_seconds
+        self.parses += other.parses
+
+    def as_dict(self):
+        calls = self.latency.count
+        return {**self.latency.as_dict(), 'errors': self.errors, 'response_bytes': self.response_bytes,
+                'mean_response_bytes': self.response_bytes / calls if calls else 0, 'parse_seconds': self.parse_seconds,
+                'mean_parse_seconds': self.parse_seconds / self.parses if self.parses else 0.0}
+
+
+class _TimedHttp:
+    """Stands in for `requests` (or a Panorama device handle): times every GET and records it for one host."""
+    def __init__(self, http, stats, host):
+        self._http = http
+        self._stats = stats
+        self._host = host
+
+    def get(self, url, params=None, **kwargs):
+        command = command_name(url, params)
+        start = time.perf_counter()
+        try:
+            response = self._http.get(url, params=params, **kwargs)
+        except Exception:
+            self._stats.record_call(self._host, command, time.perf_counter() - start, 0, error=True)
+            raise
+        self._stats.record_call(self._host, command, time.perf_counter() - start, len(response.content), error=not response.ok)
+        return response
+
+
+class CollectorStats:
+    """
+    In-memory instrumentation of the collector: per-host, per-command API latency histograms with
+    response sizes, errors and parse time; keygen time; per-device job duration; scheduling lag and
+    achieved poll intervals per metric group; database write time; and queue depths. Everything
+    is a fixed-size histogram or ring buffer, so memory only grows with the number of firewalls.
+    Safe to call from the collector threads and the scheduler loop at once.
+    """
+    def __init__(self, ring_size=RING_SIZE):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._calls = {}                                 # (host, command) -> _CallStats
+        # Fleet-wide totals since startup; unlike the per-host tables they are never reduced, so they
+        # can be exported as counters (see prometheus_metrics.py)
+        self._command_totals = collections.defaultdict(_CallStats)  # command -> _CallStats
+        self._keygen_total = LatencyHistogram()
+        self._job_total = LatencyHistogram()
+        self._db_write_total = LatencyHistogram()
+        self._keygen = {}                                # host -> LatencyHistogram
+        self._jobs = {}                                  # host -> LatencyHistogram of whole device jobs
+        self._last_dispatch = {}                         # (firewall_id, group) -> time of the last dispatch
+        self._not_started = 0                            # device jobs queued for a collector thread
+        self._ring_size = ring_size
+        self._lag = collections.defaultdict(lambda: collections.deque(maxlen=ring_size))       # group -> lags
+        self._intervals = collections.defaultdict(lambda: collections.deque(maxlen=ring_size)) # group -> seconds between polls
+        self._job_durations = collections.deque(maxlen=ring_size)   # (end time, host, seconds)
+        self._db_writes = collections.deque(maxlen=ring_size)       # (end time, seconds, results written)
+        self._queues = collections.deque(maxlen=ring_size)          # (time, completed, in flight, waiting, not started)
+
+    # --- Recording ---
+
+    def http(self, http, host):
+        """Wraps an http object (requests or a Panorama device handle) so its calls are recorded under host."""
+        return _TimedHttp(http, self, host)
+
+    def record_call(self, host, command, seconds, response_bytes, error=False):
+        with self._lock:
+            stats = self._calls.get((host, command))
+            if stats is None:
+                stats = self._calls[(host, command)] = _CallStats()
+            for target in (stats, self._command_totals[command]):
+                target.latency.add(seconds)
+                target.response_bytes += response_bytes
+                target.errors += error
+
+    def parse(self, host, command, parser, *args, **kwargs):
+        """Calls parser(*args, **kwargs), recording its duration as parse time of host's command."""
+        start = time.perf_counter()
+        try:
+            return parser(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                stats = self._calls.get((host, command))
+                if stats is None:
+                    stats = self._calls[(host, command)] = _CallStats()
+                for target in (stats, self._command_totals[command]):
+                    target.parse_seconds += seconds
+                    target.parses += 1
+
+    def record_keygen(self, host, seconds):
+        with self._lock:
+            self._keygen.setdefault(host, LatencyHistogram()).add(seconds)
+            self._keygen_total.add(seconds)
+
+    def job_queued(self):
+        with self._lock:
+            self._not_started += 1
+
+    def job_started(self):
+        with self._lock:
+            self._not_started -= 1
+
+    def record_job(self, host, seconds):
+        with self._lock:
+            self._jobs.setdefault(host, LatencyHistogram()).add(seconds)
+            self._job_total.add(seconds)
+            self._job_durations.append((time.time(), host, seconds))
+
+    def record_dispatch(self, firewall_id, group, lag, now):
+        """A poll of group dispatched lag seconds late; also records the time since its previous dispatch."""
+        with self._lock:
+            self._lag[group].append(lag)
+            previous = self._last_dispatch.get((firewall_id, group))
+            if previous is not None:
+                self._intervals[group].append(now - previous)
+            self._last_dispatch[(firewall_id, group)] = now
+
+    def record_db_write(self, seconds, results):
+        with self._lock:
+            self._db_writes.append((time.time(), seconds, results))
+            self._db_write_total.add(seconds)
+
+    def record_queues(self, completed, in_flight, waiting):
+        """Samples the scheduler's queues: finished polls not yet written, polls running, groups waiting for their device."""
+        with self._lock:
+            self._queues.append((time.time(), completed, in_flight, waiting, self._not_started))
+
+    def forget(self, hosts=(), firewall_ids=()):
+        """Drops the statistics of removed firewalls."""
+        hosts, firewall_ids = set(hosts), set(firewall_ids)
+        with self._lock:
+            for key in [key for key in self._calls if key[0] in hosts]:
+                del self._calls[key]
+            for table in (self._keygen, self._jobs):
+                for host in hosts & table.keys():
+                    del table[host]
+            for key in [key for key in self._last_dispatch if key[0] in firewall_ids]:
+                del self._last_dispatch[key]
+
+    # --- Reporting ---
+
+    def totals(self):
+        """
+        Fleet-wide totals since startup (per-command call stats, and keygen, device job and database
+        write histograms) and the latest queue depths. Its cost does not depend on the fleet size.
+        """
+        with self._lock:
+            latest_queue = self._queues[-1] if self._queues else (None, 0, 0, 0, self._not_started)
+            return {
+                'started': self.started,
+                'commands': {command: stats.as_dict() for command, stats in self._command_totals.items()},
+                'keygen': self._keygen_total.as_dict(),
+                'jobs': self._job_total.as_dict(),
+                'db_writes': self._db_write_total.as_dict(),
+                'queues': {'completed': latest_queue[1], 'in_flight': latest_queue[2], 'waiting': latest_queue[3], 'not_started': latest_queue[4]},
+            }
+
+    @staticmethod
+    def _summary(values):
+        values = sorted(values)
+        if not values:
+            return {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+        return {'count': len(values), 'mean': sum(values) / len(values), 'p50': values[len(values) // 2],
+                'p95': values[min(len(values) - 1, int(len(values) * 0.95))], 'max': values[-1]}
+
+    def snapshot(self, top_devices=20):
+        """JSON-ready summary: per-command totals, the devices that take the most collection time, and the recent rings."""
+        with self._lock:
+            calls = {key: stats for key, stats in self._calls.items()}
+            by_command, by_host = {}, {}
+            for (host, command), stats in calls.items():
+                by_command.setdefault(command, _CallStats()).merge(stats)
+                by_host.setdefault(host, {})[command] = stats
+            keygen = LatencyHistogram()
+            for histogram in self._keygen.values():
+                keygen.merge(histogram)
+            jobs = {host: histogram.as_dict() for host, histogram in self._jobs.items()}
+            keygen_by_host = {host: histogram.as_dict() for host, histogram in self._keygen.items()}
+            commands = {command: stats.as_dict() for command, stats in by_command.items()}
+            hosts = {host: {command: stats.as_dict() for command, stats in host_calls.items()} for host, host_calls in by_host.items()}
+            lag = {group: self._summary(values) for group, values in self._lag.items()}
+            intervals = {group: self._summary(values) for group, values in self._intervals.items()}
+            db_writes = list(self._db_writes)
+            queues = list(self._queues)
+            job_durations = list(self._job_durations)
+
+        # Time spent on each device: API calls plus parsing, with its costliest command
+        devices = []
+        for host, host_calls in hosts.items():
+            total = sum(c['total_seconds'] + c['parse_seconds'] for c in host_calls.values())
+            slowest = max(host_calls, key=lambda command: host_calls[command]['total_seconds'] + host_calls[command]['parse_seconds'])
+            devices.append({'host': host, 'total_seconds': total, 'calls': sum(c['count'] for c in host_calls.values()),
+                            'errors': sum(c['errors'] for c in host_calls.values()), 'response_bytes': sum(c['response_bytes'] for c in host_calls.values()),
+                            'parse_seconds': sum(c['parse_seconds'] for c in host_calls.values()), 'slowest_command': slowest,
+                            'keygen': keygen_by_host.get(host), 'job': jobs.get(host), 'commands': host_calls})
+        devices.sort(key=lambda device: device['total_seconds'], reverse=True)
+        total_seconds = sum(c['total_seconds'] + c['parse_seconds'] for c in commands.values())
+
+        latest_queue = queues[-1] if queues else (None, 0, 0, 0, 0)
+        return {
+            'started': self.started,
+            'uptime_seconds': time.time() - self.started,
+            'ring_size': self._ring_size,
+            'commands': dict(sorted(commands.items(), key=lambda item: item[1]['total_seconds'] + item[1]['parse_seconds'], reverse=True)),
+            'total_call_seconds': total_seconds,
+            'devices': devices[:top_devices],
+            'device_count': len(devices),
+            'keygen': keygen.as_dict(),
+            'job_seconds': self._summary([seconds for _, _, seconds in job_durations]),
+            'lag_seconds': lag,
+            'poll_interval_seconds': intervals,
+            'db_write_seconds': self._summary([seconds for _, seconds, _ in db_writes]),
+            'db_write_results': sum(results for _, _, results in db_writes),
+            'queues': {
+                'completed': latest_queue[1], 'in_flight': latest_queue[2], 'waiting': latest_queue[3], 'not_started': latest_queue[4],
+                'max_completed': max((q[1] for q in queues), default=0), 'max_in_flight': max((q[2] for q in queues), default=0),
+                'max_waiting': max((q[3] for q in queues), default=0), 'max_not_started': max((q[4] for q in queues), default=0),
+            },
+        }
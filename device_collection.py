@@ -0,0 +1,393 @@
+import time
+import xml.etree.ElementTree as ET
+
+import requests
+from urllib3.exceptions import InsecureRequestWarning
+
+import collector_stats
+import device_health
+import panos_parsers
+import poll_scheduler
+
+# Network-only collection of metric groups from one firewall, on a collector thread: keygen, the API
+# calls of each group and their parsing. Shared by the local poller (app.py) and the remote collector
+# agent (remote_collector.py); neither the database nor the web app is touched here. `http` is the
+# requests module, or a panorama_proxy device handle for Panorama-proxied collection.
+
+# Firewalls (and Panorama) usually present self-signed certificates
+requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
+
+# Instrumentation of the collection (API call latency, parse and keygen time), see /internal/collector
+collector = collector_stats.CollectorStats()
+
+
+def get_api_key(args):
+    host, user, password = args
+    base_url = f"https://{host}/api/"
+    api_params = {'type': 'keygen', 'user': user, 'password': password}
+    try:
+        response = requests.get(base_url, params=api_params, verify=False, timeout=10)
+        response.raise_for_status()
+        tree = ET.fromstring(response.content)
+        key_element = tree.find('.//key')
+        if key_element is not None and key_element.text: return {'status': 'success', 'host': host, 'api_key': key_element.text}
+        else:
+            error_msg = tree.findtext('.//line') or "Authentication failed"
+            return {'status': 'error', 'host': host, 'error_message': error_msg}
+    except requests.exceptions.RequestException as e:
+        return {'status': 'error', 'host': host, 'error_message': str(e)}
+
+
+def fetch_fw_details(host, api_key, http=requests):
+    """Fetches and parses detailed firewall capacity specs. Returns {column: value}, or None on failure."""
+    cmd = "<show><system><state><filter>cfg.general.*</filter></state></system></show>"
+    try:
+        response = http.get(f"https://{host}/api/?type=op&cmd={cmd}&key={api_key}", verify=False, timeout=15)
+        response.raise_for_status()
+        return collector.parse(host, 'system_state', panos_parsers.parse_system_state, response.content)
+    except Exception as e:
+        print(f"Could not fetch/parse details for {host}: {e}")
+        return None
+
+
+def collect_system_info(host, api_key, http=requests):
+    """
+    Returns the firewall's model, hostname and PAN-OS version from <show><system><info/>, plus
+    'advance_routing_enabled' (1/0) when the firewall reports it (PAN-OS 10.2+), else None.
+    """
+    sys_info_xml = http.get(f"https://{host}/api/?type=op&cmd=<show><system><info/></system></show>&key={api_key}", verify=False, timeout=10).content
+    return collector.parse(host, 'system_info', panos_parsers.parse_system_info, sys_info_xml)
+
+
+def poll_current_usage(host, api_key, adv_routing_enabled=False, sw_version=None, http=requests):
+    """
+    Polls a single firewall for its current object counts. Network only; the caller supplies the
+    device capabilities (advanced routing, PAN-OS version) so no database access is needed here.
+    `http` is the requests module, or a panorama_proxy device handle for Panorama-proxied collection.
+    """
+    commands = {
+        'config': {
+            'rules': "/config/devices/entry[@name='localhost.localdomain']/vsys/entry/rulebase/security/rules",
+            'nat-rules': "/config/devices/entry[@name='localhost.localdomain']/vsys/entry/rulebase/nat/rules",
+            'address': "/config/devices/entry[@name='localhost.localdomain']/vsys/entry/address",
+            'service': "/config/devices/entry[@name='localhost.localdomain']/vsys/entry/service",
+            'ipsec': "/config/devices/entry[@name='localhost.localdomain']/network/tunnel/ipsec"
+        },
+        'op': {
+            'arp': ("<show><arp><entry name='all'/></arp></show>", './/entries/entry'),
+            'dns_cache': ("<show><dns-proxy><cache><all/></cache></dns-proxy></show>", './/entry'),
+            'registered_ips': ("<show><user><ip-user-mapping><all></all></ip-user-mapping></user></show>", './/entry'),
+            'ssl_decrypt_sessions': ("<show><session><all><filter><ssl-decrypt>yes</ssl-decrypt><count>yes</count></filter></all></session></show>", './/result')
+        }
+    }
+    usage_data = {}
+    # Poll config-based stats
+    for key, xpath in commands['config'].items():
+        try:
+            params = {'type': 'config', 'action': 'get', 'key': api_key, 'xpath': xpath}
+            response = http.get(f"https://{host}/api/", params=params, verify=False, timeout=10)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            entries = root.findall('.//entry')
+            usage_data[key] = len(entries)
+        except Exception as e:
+            print(f"Error polling config stat '{key}' for {host}: {e}")
+            usage_data[key] = None # Mark as None on error
+
+    # ** NEW: Conditional route polling **
+    try:
+        if adv_routing_enabled:
+            # Use advanced routing command
+            cmd = '<show><advanced-routing><route></route></advanced-routing></show>'
+            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
+            response = http.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            json_text = root.findtext('.//result/json')
+            if json_text:
+                import json
+                route_data = json.loads(json_text)
+                total_routes = sum(len(route_list) for vrf in route_data.values() for route_list in vrf.values())
+                usage_data['routes'] = total_routes
+        else:
+            # Use standard routing command
+            cmd = '<show><routing><route></route></routing></show>'
+            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
+            response = http.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            usage_data['routes'] = len(root.findall('.//routing-table/ip/entry'))
+    except Exception as e:
+        print(f"Error polling route stat for {host}: {e}")
+        usage_data['routes'] = None
+
+    # ** NEW: Conditional multicast route polling **
+    try:
+        if adv_routing_enabled:
+            # Use advanced routing command for multicast
+            cmd = '<show><advanced-routing><multicast><route></route></multicast></advanced-routing></show>'
+            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
+            response = http.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            json_text = root.findtext('.//result/json')
+            if json_text:
+                import json
+                mroute_data = json.loads(json_text)
+                # The structure is likely similar to unicast, so we sum the lengths of the route lists
+                total_mroutes = sum(len(route_list) for vrf in mroute_data.values() for route_list in vrf.values())
+                usage_data['mroutes'] = total_mroutes
+        else:
+            # Use standard multicast routing command
+            cmd = '<show><routing><multicast><route/></multicast></routing></show>'
+            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
+            response = http.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            # This command returns a CDATA block, so we count the lines.
+            cdata_text = root.findtext('.//result')
+            # Subtract 1 for the "Flags:" header line.
+            usage_data['mroutes'] = max(0, len(cdata_text.strip().split('\n')) - 1) if cdata_text else 0
+    except Exception as e:
+        print(f"Error polling multicast route stat for {host}: {e}")
+        usage_data['mroutes'] = None
+
+    # ** FIX: Re-introduce conditional BFD session polling **
+    try:
+        major_version = int(sw_version.split('.')[0])
+
+        if major_version >= 11:
+            if adv_routing_enabled:
+                bfd_cmd = '<show><advanced-routing><bfd><summary/></bfd></advanced-routing></show>'
+            else:
+                bfd_cmd = '<show><routing><bfd><summary/></bfd></routing></show>'
+            
+            params = {'type': 'op', 'cmd': bfd_cmd, 'key': api_key}
+            response = http.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            usage_data['bfd'] = len(root.findall('.//result/entry'))
+        else:
+            # BFD summary command not supported on older versions
+            usage_data['bfd'] = 0
+    except Exception as e:
+        print(f"Error polling BFD stat for {host}: {e}")
+        usage_data['bfd'] = None
+    
+    # Poll op-based stats
+    for key, (cmd, find_path) in commands['op'].items():
+        try:
+            params = {'type': 'op', 'cmd': cmd, 'key': api_key}
+            if key == 'dns_cache':
+                # Special handling for DNS cache command which returns text
+                response = http.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
+                response.raise_for_status()
+                root = ET.fromstring(response.content)
+                total_dns_entries = 0
+                # The result is a series of <msg> tags, not structured XML entries
+                for msg_tag in root.findall('.//result/msg'):
+                    if msg_tag.text and msg_tag.text.strip().startswith('entries:'):
+                        parts = msg_tag.text.strip().split(':')
+                        if len(parts) > 1 and parts[1].strip().isdigit():
+                            total_dns_entries += int(parts[1].strip())
+                usage_data[key] = total_dns_entries
+            elif key == 'ssl_decrypt_sessions':
+                # Special handling for SSL decrypt count which returns a CDATA block
+                response = http.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
+                response.raise_for_status()
+                root = ET.fromstring(response.content)
+                cdata_text = root.findtext(find_path)
+                count = 0
+                if cdata_text and 'Number of sessions that match filter:' in cdata_text:
+                    parts = cdata_text.split(':')
+                    if len(parts) > 1 and parts[1].strip().isdigit():
+                        count = int(parts[1].strip())
+                usage_data[key] = count
+            else:
+                response = http.get(f"https://{host}/api/", params=params, verify=False, timeout=15)
+                response.raise_for_status()
+                root = ET.fromstring(response.content)
+                entries = root.findall(find_path)
+                usage_data[key] = len(entries)
+        except Exception as e:
+            print(f"Error polling op stat '{key}' for {host}: {e}")
+            usage_data[key] = None
+    return usage_data
+
+
+# Where total throughput comes from (THROUGHPUT_SOURCE setting):
+#   'physical'     - interface counters of physical ports only (no subinterfaces, tunnels, loopbacks, VLANs
+#                    or AE bundles, whose traffic is already counted on their member ports)
+#   'all'          - every interface counter, summed (the original behaviour; double counts logical interfaces)
+#   'session_info' - the dataplane throughput (kbps) <show><session><info/> already reports; no counter call
+THROUGHPUT_SOURCES = {'physical': 'Physical Ports', 'all': 'All Interfaces', 'session_info': 'Session Info (kbps)'}
+
+
+def interface_rates(previous_state, counters, timestamp):
+    """
+    Per-interface (in_bps, out_bps, in_pps, out_pps) between two counter snapshots. Interfaces missing
+    from the previous snapshot are left out; counters that went backwards (reboot, clear) count as 0.
+    """
+    rates = {}
+    if previous_state and previous_state.get('counters'):
+        time_delta = timestamp - previous_state['timestamp']
+        if time_delta > 0:
+            previous = previous_state['counters']
+            for if_name, current in counters.items():
+                prev = previous.get(if_name)
+                if prev and len(prev) == len(current):
+                    rates[if_name] = (max(0, current[0] - prev[0]) * 8 / time_delta, max(0, current[1] - prev[1]) * 8 / time_delta,
+                                      max(0, current[2] - prev[2]) / time_delta, max(0, current[3] - prev[3]) / time_delta)
+    return rates
+
+
+def poll_single_firewall(args):
+    """Worker function to poll the fast-path metric groups (see poll_scheduler.FAST_GROUPS) from a single firewall."""
+    host, api_key, previous_state, groups, http, throughput_source = args
+    data = {}
+    new_state = previous_state
+    try:
+        if 'throughput_sessions' in groups:
+            session_xml = http.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><session><info/></session></show>", verify=False, timeout=15).content
+
+            # Process Session info
+            data['active_sessions'], throughput_kbps = collector.parse(host, 'session_info', panos_parsers.parse_session_info, session_xml)
+
+            # Process Throughput info
+            if throughput_source == 'session_info':
+                # Dataplane throughput as the firewall reports it; forwarded traffic is counted once, in = out
+                throughput_bps = throughput_kbps * 1000
+                data['total_input_bps'] = data['total_output_bps'] = throughput_bps
+            else:
+                if_counter_xml = http.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><counter><interface>all</interface></counter></show>", verify=False, timeout=15).content
+                current_timestamp = time.time()
+                # Compact state: {interface: (ibytes, obytes, ipackets, opackets)}, physical ports and AE bundles only unless 'all' is configured
+                current_counters = collector.parse(host, 'interface_counters', panos_parsers.parse_interface_counters, if_counter_xml, all_interfaces=throughput_source == 'all')
+                rates = interface_rates(previous_state, current_counters, current_timestamp)
+                summed = rates.values() if throughput_source == 'all' else [r for name, r in rates.items() if panos_parsers.is_physical_interface(name)]
+                data['total_input_bps'] = sum(r[0] for r in summed)
+                data['total_output_bps'] = sum(r[1] for r in summed)
+                # Kept per interface for the interface time series
+                data['interfaces'] = rates
+                new_state = {'counters': current_counters, 'timestamp': current_timestamp}
+
+        if 'cpu_memory' in groups:
+            mem_xml = http.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><system><resources/></system></show>", verify=False, timeout=15).content
+            # ** NEW: Use the 'minute last 1' command for Dataplane CPU **
+            cpu_dp_xml = http.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><running><resource-monitor><minute><last>1</last></minute></resource-monitor></running></show>", verify=False, timeout=15).content
+
+            # Management CPU and memory from 'show system resources', dataplane CPU from 'show running resource-monitor'
+            cpu_load, memory_utilization = collector.parse(host, 'system_resources', panos_parsers.parse_system_resources, mem_xml)
+            dataplane_load = collector.parse(host, 'resource_monitor', panos_parsers.parse_dataplane_load, cpu_dp_xml)
+
+            data.update(cpu_load=cpu_load, dataplane_load=dataplane_load, memory_utilization=memory_utilization)
+
+        if 'ssl_decrypt' in groups:
+            ssl_decrypt_xml = http.get(f"https://{host}/api/?type=op&key={api_key}&cmd=<show><session><all><filter><ssl-decrypt>yes</ssl-decrypt></filter></all></session></show>", verify=False, timeout=15).content
+            # Process SSL Decrypt Session info by counting entries
+            data['ssl_decrypt_sessions'] = collector.parse(host, 'ssl_decrypt_sessions', panos_parsers.count_ssl_decrypt_sessions, ssl_decrypt_xml)
+
+        return {"status": "success", "host": host, "data": data, "new_state": new_state}
+    except Exception as e:
+        print(f"Polling error for {host}: {e}")
+        return {"status": "error", "host": host, "new_state": previous_state}
+
+
+def probe_firewall(host, api_key, http=requests):
+    """One cheap API call to check a firewall is reachable and the API key still works. Raises on failure."""
+    response = http.get(f"https://{host}/api/?type=op&cmd=<show><clock></clock></show>&key={api_key}", verify=False, timeout=5)
+    response.raise_for_status()
+    if ET.fromstring(response.content).get('status') == 'error':
+        raise ValueError("API returned an error")
+
+
+def run_device_jobs(args):
+    """Collector thread entry point for one firewall's due metric groups; records the job's duration."""
+    collector.job_started()
+    start = time.perf_counter()
+    try:
+        return _collect_device_jobs(args)
+    finally:
+        collector.record_job(args[1], time.perf_counter() - start)
+
+
+def _collect_device_jobs(args):
+    """
+    Runs every metric group due for one firewall, in poll_scheduler.METRIC_GROUPS order, on a collector
+    thread. Reuses the cached API key when there is one. Network only; results are written by the loop.
+
+    Stops at the first group that shows the firewall is unreachable, so a dead device costs one
+    timeout rather than one per API call. The 'probe' group (circuit breaker recovery) makes a single
+    cheap call and nothing else. Proxied firewalls come with Panorama's API key and a
+    panorama_proxy handle as `http`, so no keygen is done for them.
+    """
+    firewall_id, host, groups, api_key, fw_user, fw_password, previous_state, adv_routing_enabled, sw_version, http, throughput_source = args
+    # Panorama's key is never cached as the firewall's own
+    result = {'firewall_id': firewall_id, 'host': host, 'status': 'success', 'api_key': api_key if http is requests else None, 'groups': {}, 'new_state': previous_state}
+    http = collector.http(http, host)
+
+    def failed():
+        result['status'] = 'error'
+        # Force a fresh keygen next time in case the key was invalidated (reboot, password change, ...)
+        result['api_key'] = None
+        return result
+
+    contacted = False
+    if not api_key:
+        keygen_start = time.perf_counter()
+        key_res = get_api_key((host, fw_user, fw_password))
+        collector.record_keygen(host, time.perf_counter() - keygen_start)
+        if key_res['status'] != 'success':
+            print(f"Could not get API key for {host}: {key_res['error_message']}")
+            return failed()
+        api_key = result['api_key'] = key_res['api_key']
+        contacted = True
+
+    if groups == [device_health.PROBE_GROUP]:
+        if not contacted:
+            try:
+                probe_firewall(host, api_key, http)
+            except Exception as e:
+                print(f"Recovery probe failed for {host}: {e}")
+                return failed()
+        return result
+
+    if 'system_info' in groups:
+        try:
+            info = collect_system_info(host, api_key, http)
+            result['groups']['system_info'] = info
+            sw_version = info['sw_version'] or sw_version
+            if info['advance_routing_enabled'] is not None:
+                adv_routing_enabled = bool(info['advance_routing_enabled'])
+            contacted = True
+        except requests.exceptions.RequestException as e:
+            print(f"Could not discover model/hostname for {host}: {e}")
+            return failed()
+        except Exception as e:
+            print(f"Could not discover model/hostname for {host}: {e}")
+    if 'details' in groups:
+        details = fetch_fw_details(host, api_key, http)
+        result['groups']['details'] = details
+        if details and 'advance_routing_enabled' in details:
+            adv_routing_enabled = bool(details['advance_routing_enabled'])
+
+    fast_groups = [g for g in groups if g in poll_scheduler.FAST_GROUPS]
+    if fast_groups:
+        res = poll_single_firewall((host, api_key, previous_state, fast_groups, http, throughput_source))
+        result['new_state'] = res['new_state']
+        if res['status'] != 'success':
+            return failed()
+        for group in fast_groups:
+            result['groups'][group] = res['data']
+        contacted = True
+
+    if 'capacity' in groups:
+        # Capacity polling makes a dozen calls that each tolerate errors; check the device answers first
+        if not contacted:
+            try:
+                probe_firewall(host, api_key, http)
+            except Exception as e:
+                print(f"Skipping capacity poll for unreachable firewall {host}: {e}")
+                return failed()
+        result['groups']['capacity'] = poll_current_usage(host, api_key, adv_routing_enabled, sw_version, http)
+    return result
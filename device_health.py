@@ -0,0 +1,71 @@
+import random
+
+# Consecutive failed polls after which a firewall's circuit opens and normal polling stops
+FAILURE_THRESHOLD = 3
+
+# Wait before the first recovery probe; doubles with every failed probe up to MAX_BACKOFF_SECONDS
+BASE_BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 1800
+
+# Pseudo metric group the poller dispatches to probe an unreachable firewall
+PROBE_GROUP = 'probe'
+
+
+class _DeviceState:
+    __slots__ = ('failures', 'open', 'retry_at')
+
+    def __init__(self):
+        self.failures = 0
+        self.open = False
+        self.retry_at = 0.0
+
+
+class DeviceHealth:
+    """
+    Per-device circuit breaker for the poller.
+
+    After `failure_threshold` consecutive failed polls a device's circuit opens: its scheduled polls
+    are dropped and it is only probed with a single cheap API call, backing off exponentially (with
+    jitter, so a site outage does not make every device retry in lockstep) until a probe succeeds.
+    """
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, base_backoff=BASE_BACKOFF_SECONDS, max_backoff=MAX_BACKOFF_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._state = {}
+
+    def _backoff(self, failures):
+        exponent = max(0, failures - self.failure_threshold)
+        return min(self.max_backoff, self.base_backoff * 2 ** exponent) * random.uniform(0.9, 1.1)
+
+    def record_failure(self, device_id, now):
+        """Counts a failed poll or probe. Returns True if this failure opened the circuit."""
+        state = self._state.setdefault(device_id, _DeviceState())
+        state.failures += 1
+        if state.failures < self.failure_threshold:
+            return False
+        opened = not state.open
+        state.open = True
+        state.retry_at = now + self._backoff(state.failures)
+        return opened
+
+    def record_success(self, device_id):
+        """Resets the device. Returns True if its circuit was open (the device has recovered)."""
+        state = self._state.pop(device_id, None)
+        return state is not None and state.open
+
+    def is_open(self, device_id):
+        state = self._state.get(device_id)
+        return state is not None and state.open
+
+    def probe_due(self, device_id, now):
+        """True if the device's circuit is open and its backoff has expired."""
+        state = self._state.get(device_id)
+        return state is not None and state.open and now >= state.retry_at
+
+    def open_devices(self):
+        return [device_id for device_id, state in self._state.items() if state.open]
+
+    def forget(self, device_id):
+        """Drops all state for a device (e.g. after it is removed from monitoring)."""
+        self._state.pop(device_id, None)
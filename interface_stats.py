@@ -0,0 +1,223 @@
+import time
+
+# Rollup tiers, finest first: (table, bucket seconds). Each tier is built from the one before it (the
+# first from raw samples), so a rollup pass only ever reads a few buckets' worth of rows.
+ROLLUP_TIERS = [
+    ('interface_stats_5m', 300),
+    ('interface_stats_hourly', 3600),
+    ('interface_stats_daily', 86400),
+]
+ROLLUP_SECONDS = ROLLUP_TIERS[0][1]
+
+# Time windows for the busiest-interfaces view. 'now' reads each interface's latest rates; other
+# windows read the finest tier that covers them in at most MAX_WINDOW_BUCKETS buckets, which bounds a
+# top-N query to that many rows per interface however long the window is. The part of the window that
+# tier has not rolled up yet is read from the finer tiers, and the last few minutes from raw samples.
+TOP_INTERFACE_WINDOWS = {'now': 0, '1h': 3600, '24h': 24 * 3600, '7d': 7 * 24 * 3600, '30d': 30 * 24 * 3600}
+MAX_WINDOW_BUCKETS = 30
+# Interfaces without a sample for this long (firewall down, interface removed) drop out of 'now'
+NOW_MAX_AGE_SECONDS = 300
+# Most rows the busiest-interfaces view returns
+MAX_TOP_LIMIT = 500
+
+# Ranking metrics for the busiest-interfaces view -> rollup column
+TOP_INTERFACE_METRICS = {
+    'in_bps': 'max_in_bps',
+    'out_bps': 'max_out_bps',
+    'in_pps': 'max_in_pps',
+    'out_pps': 'max_out_pps',
+}
+
+
+def create_tables(conn):
+    """
+    Interface dictionary plus compact sample tables. Samples reference interfaces by integer id and
+    store epoch-second timestamps, keyed (ts, interface_id) WITHOUT ROWID so inserts append and
+    time-window scans are a single range read.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS interfaces (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            firewall_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            last_ts INTEGER,
+            in_bps REAL, out_bps REAL, in_pps REAL, out_pps REAL,
+            UNIQUE (firewall_id, name),
+            FOREIGN KEY (firewall_id) REFERENCES firewalls (id) ON DELETE CASCADE
+        );
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS interface_stats (
+            ts INTEGER NOT NULL,
+            interface_id INTEGER NOT NULL,
+            in_bps REAL, out_bps REAL, in_pps REAL, out_pps REAL,
+            PRIMARY KEY (ts, interface_id)
+        ) WITHOUT ROWID;
+    ''')
+    for table, _ in ROLLUP_TIERS:
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket_ts INTEGER NOT NULL,
+                interface_id INTEGER NOT NULL,
+                samples INTEGER,
+                avg_in_bps REAL, avg_out_bps REAL, max_in_bps REAL, max_out_bps REAL, max_in_pps REAL, max_out_pps REAL,
+                PRIMARY KEY (bucket_ts, interface_id)
+            ) WITHOUT ROWID;
+        ''')
+
+
+class InterfaceDictionary:
+    """Maps (firewall_id, interface name) to a stable integer id, creating ids on first sight."""
+    def __init__(self):
+        self._ids = {}
+
+    def ids_for(self, conn, firewall_id, names):
+        """Returns {name: interface_id} for one firewall's interfaces."""
+        missing = [name for name in names if (firewall_id, name) not in self._ids]
+        if missing:
+            conn.executemany('INSERT OR IGNORE INTO interfaces (firewall_id, name) VALUES (?, ?)', [(firewall_id, name) for name in missing])
+            for row in conn.execute('SELECT id, name FROM interfaces WHERE firewall_id = ?', (firewall_id,)).fetchall():
+                self._ids[(firewall_id, row[1])] = row[0]
+        return {name: self._ids[(firewall_id, name)] for name in names}
+
+    def forget(self, firewall_id):
+        for key in [k for k in self._ids if k[0] == firewall_id]:
+            del self._ids[key]
+
+
+def ingest(conn, dictionary, samples, ts=None):
+    """
+    Writes per-interface rates for a batch of polls. samples is [(firewall_id, {name: (in_bps, out_bps,
+    in_pps, out_pps)})]. Also refreshes each interface's latest rates for the 'now' view.
+    """
+    ts = int(ts or time.time())
+    rows = []
+    for firewall_id, rates in samples:
+        if not rates:
+            continue
+        ids = dictionary.ids_for(conn, firewall_id, list(rates))
+        rows.extend((ts, ids[name], *values) for name, values in rates.items())
+    conn.executemany('INSERT OR REPLACE INTO interface_stats (ts, interface_id, in_bps, out_bps, in_pps, out_pps) VALUES (?, ?, ?, ?, ?, ?)', rows)
+    conn.executemany('UPDATE interfaces SET last_ts = ?, in_bps = ?, out_bps = ?, in_pps = ?, out_pps = ? WHERE id = ?',
+                     [(row[0], row[2], row[3], row[4], row[5], row[1]) for row in rows])
+    return len(rows)
+
+
+def rollup(conn, now=None, since=None):
+    """
+    Rolls every complete bucket not yet rolled up into each tier, re-rolling each tier's latest bucket
+    and, with `since` (the oldest sample written since the last rollup), every bucket from the one
+    holding it, so samples written late (remote collectors catching up after an outage) reach every
+    tier. Idempotent. Returns rows written.
+    """
+    now = int(now or time.time())
+    written = 0
+    source, source_ts = 'interface_stats', 'ts'
+    aggregates = 'COUNT(*), AVG(in_bps), AVG(out_bps), MAX(in_bps), MAX(out_bps), MAX(in_pps), MAX(out_pps)'
+    for table, bucket in ROLLUP_TIERS:
+        end = now // bucket * bucket
+        start = conn.execute(f'SELECT MAX(bucket_ts) FROM {table}').fetchone()[0]
+        if start is not None and since is not None:
+            start = min(start, int(since) // bucket * bucket)
+        if start is None:
+            start = (conn.execute(f'SELECT MIN({source_ts}) FROM {source}').fetchone()[0] or end) // bucket * bucket
+        if start < end:
+            written += conn.execute(f'''
+                INSERT OR REPLACE INTO {table}
+                    (bucket_ts, interface_id, samples, avg_in_bps, avg_out_bps, max_in_bps, max_out_bps, max_in_pps, max_out_pps)
+                SELECT {source_ts} / {bucket} * {bucket}, interface_id, {aggregates}
+                FROM {source} WHERE {source_ts} >= ? AND {source_ts} < ?
+                GROUP BY {source_ts} / {bucket}, interface_id
+            ''', (start, end)).rowcount
+        # Coarser tiers combine this tier's buckets, weighting averages by sample count
+        source, source_ts = table, 'bucket_ts'
+        aggregates = ('SUM(samples), SUM(avg_in_bps * samples) / SUM(samples), SUM(avg_out_bps * samples) / SUM(samples), '
+                      'MAX(max_in_bps), MAX(max_out_bps), MAX(max_in_pps), MAX(max_out_pps)')
+    return written
+
+
+def prune(conn, raw_retention_days, rollup_retention_days, now=None):
+    """
+    Deletes raw samples and 5-minute rollups older than raw_retention_days, and hourly and daily
+    rollups older than rollup_retention_days. Returns rows deleted.
+    """
+    now = int(now or time.time())
+    raw_cutoff = now - raw_retention_days * 86400
+    deleted = conn.execute('DELETE FROM interface_stats WHERE ts < ?', (raw_cutoff,)).rowcount
+    for table, _ in ROLLUP_TIERS:
+        cutoff = raw_cutoff if table == ROLLUP_TIERS[0][0] else now - rollup_retention_days * 86400
+        deleted += conn.execute(f'DELETE FROM {table} WHERE bucket_ts < ?', (cutoff,)).rowcount
+    # Interfaces of firewalls that are no longer monitored
+    deleted += conn.execute('DELETE FROM interfaces WHERE firewall_id NOT IN (SELECT id FROM firewalls)').rowcount
+    return deleted
+
+
+def _tier_for(seconds):
+    for index, (_, bucket) in enumerate(ROLLUP_TIERS):
+        if seconds // bucket <= MAX_WINDOW_BUCKETS:
+            return index
+    return len(ROLLUP_TIERS) - 1
+
+
+def _window_sources(conn, tier, since):
+    """
+    (subquery, params) pairs covering [since, now]: the tier's rolled-up buckets, then each finer
+    tier from where the coarser one ends, then raw samples from where the 5-minute tier ends.
+    """
+    sources = []
+    for table, bucket in reversed(ROLLUP_TIERS[:tier + 1]):
+        last = conn.execute(f'SELECT MAX(bucket_ts) FROM {table}').fetchone()[0]
+        end = max(since, last + bucket) if last is not None else since
+        if end > since:
+            sources.append((f'SELECT interface_id, max_in_bps, max_out_bps, max_in_pps, max_out_pps FROM {table} WHERE bucket_ts >= ? AND bucket_ts < ?', (since, end)))
+        since = end
+    sources.append(('SELECT interface_id, in_bps AS max_in_bps, out_bps AS max_out_bps, in_pps AS max_in_pps, out_pps AS max_out_pps FROM interface_stats WHERE ts >= ?', (since,)))
+    return sources
+
+
+def top_interfaces(conn, window='now', metric='in_bps', limit=10, firewall_id=None, now=None):
+    """
+    Busiest interfaces fleet-wide (or on one firewall), ranked by their peak `metric` over `window`.
+    Returns dicts with firewall and interface names and the peak of each rate over the window.
+    """
+    metric = metric if metric in TOP_INTERFACE_METRICS else 'in_bps'
+    seconds = TOP_INTERFACE_WINDOWS.get(window, 0)
+    now = int(now or time.time())
+    fw_filter = 'i.firewall_id = ?' if firewall_id is not None else '1'
+    fw_params = (firewall_id,) if firewall_id is not None else ()
+
+    if seconds == 0:
+        query = f'''
+            SELECT i.id, in_bps, out_bps, in_pps, out_pps FROM interfaces i
+            WHERE last_ts >= ? AND {fw_filter} ORDER BY {metric} DESC LIMIT ?
+        '''
+        params = (now - NOW_MAX_AGE_SECONDS, *fw_params, limit)
+    else:
+        tier = _tier_for(seconds)
+        bucket = ROLLUP_TIERS[tier][1]
+        sources = _window_sources(conn, tier, (now - seconds) // bucket * bucket)
+        query = f'''
+            SELECT r.interface_id, MAX(r.max_in_bps), MAX(r.max_out_bps), MAX(r.max_in_pps), MAX(r.max_out_pps)
+            FROM ({' UNION ALL '.join(subquery for subquery, _ in sources)}) r
+            JOIN interfaces i ON i.id = r.interface_id
+            WHERE {fw_filter} GROUP BY r.interface_id ORDER BY MAX(r.{TOP_INTERFACE_METRICS[metric]}) DESC LIMIT ?
+        '''
+        params = (*[param for _, source_params in sources for param in source_params], *fw_params, limit)
+    ranked = conn.execute(query, params).fetchall()
+    if not ranked:
+        return []
+
+    # Names are looked up for the top rows only
+    ids = [row[0] for row in ranked]
+    names = {row[0]: row[1:] for row in conn.execute(f'''
+        SELECT i.id, i.name, i.firewall_id, f.ip_address, f.hostname FROM interfaces i JOIN firewalls f ON f.id = i.firewall_id
+        WHERE i.id IN ({', '.join('?' * len(ids))})
+    ''', ids).fetchall()}
+    results = []
+    for interface_id, in_bps, out_bps, in_pps, out_pps in ranked:
+        if interface_id not in names:
+            continue
+        name, fw_id, ip_address, hostname = names[interface_id]
+        results.append({'interface_id': interface_id, 'interface': name, 'firewall_id': fw_id, 'ip_address': ip_address, 'hostname': hostname,
+                        'in_bps': in_bps or 0, 'out_bps': out_bps or 0, 'in_pps': in_pps or 0, 'out_pps': out_pps or 0})
+    return results
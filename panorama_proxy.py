@@ -0,0 +1,111 @@
+import threading
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Default cap on API calls in flight through Panorama at once, to protect its management plane
+DEFAULT_MAX_CONCURRENT = 4
+
+# PAN-OS error codes for an invalid or expired key (403 Invalid credential, 16 Unauthorized)
+AUTH_ERROR_CODES = (b'code="403"', b'code="16"')
+
+
+class PanoramaConnection:
+    """
+    One authenticated, pooled connection to Panorama for proxied collection.
+
+    Every call made through a device handle from `for_device()` goes to Panorama with Panorama's API
+    key and `target=<serial>`, so Panorama forwards it to the managed firewall. All devices share one
+    keep-alive connection pool, and a semaphore caps how many calls are in flight at once. When
+    Panorama rejects the key (it was revoked, expired, or the admin's password changed), a connection
+    opened with `connect()` generates a new one and the call is retried once.
+    """
+    def __init__(self, host, api_key, max_concurrent=DEFAULT_MAX_CONCURRENT, scheme='https', verify=False):
+        self.host = host
+        self.api_key = api_key
+        self.scheme = scheme
+        self.verify = verify
+        self.max_concurrent = max_concurrent
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._credentials = None
+        self._keygen_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @classmethod
+    def connect(cls, host, user, password, timeout=10, **kwargs):
+        """Generates a Panorama API key and returns a connection. Raises on failure."""
+        conn = cls(host, None, **kwargs)
+        conn._credentials = (user, password)
+        conn.refresh_key(timeout=timeout)
+        return conn
+
+    def refresh_key(self, stale_key=None, timeout=10):
+        """
+        Runs keygen and stores the new key. With `stale_key`, does nothing if another thread has
+        already replaced that key, so a burst of rejected calls triggers one keygen. Raises on failure.
+        """
+        with self._keygen_lock:
+            if stale_key is not None and self.api_key != stale_key:
+                return self.api_key
+            if self._credentials is None:
+                raise ValueError("No Panorama credentials to generate a new API key with.")
+            user, password = self._credentials
+            response = self.session.get(f"{self.scheme}://{self.host}/api/", params={'type': 'keygen', 'user': user, 'password': password}, verify=self.verify, timeout=timeout)
+            response.raise_for_status()
+            api_key = ET.fromstring(response.content).findtext('.//key')
+            if not api_key:
+                raise ValueError("Failed to get API key from Panorama. Check credentials.")
+            self.api_key = api_key
+            return api_key
+
+    def for_device(self, serial):
+        """Returns a `requests`-like object whose get() proxies to the firewall with this serial."""
+        return _ProxiedDevice(self, serial)
+
+    def close(self):
+        self.session.close()
+
+
+class _ProxiedDevice:
+    """Drop-in for the `requests` module in the collection functions: rewrites firewall API URLs to Panorama."""
+    __slots__ = ('connection', 'serial')
+
+    def __init__(self, connection, serial):
+        self.connection = connection
+        self.serial = serial
+
+    def get(self, url, params=None, verify=None, timeout=None, **kwargs):
+        conn = self.connection
+        # The firewall's host and key in the URL/params are replaced by Panorama's, and target= added
+        query = [(k, v) for k, v in parse_qsl(urlsplit(url).query, keep_blank_values=True) if k != 'key']
+        query += [(k, v) for k, v in (params or {}).items() if k != 'key']
+        api_key = conn.api_key
+        response = self._send(query, api_key, timeout, **kwargs)
+        if conn._credentials is None or not _is_auth_failure(response):
+            return response
+        # The key was rejected: generate a new one (once across threads) and retry this call once
+        try:
+            api_key = conn.refresh_key(stale_key=api_key, timeout=timeout or 10)
+        except (requests.exceptions.RequestException, ET.ParseError, ValueError) as e:
+            print(f"Panorama keygen failed after an authentication error: {e}")
+            return response
+        return self._send(query, api_key, timeout, **kwargs)
+
+    def _send(self, query, api_key, timeout, **kwargs):
+        conn = self.connection
+        query = query + [('key', api_key), ('target', self.serial)]
+        with conn._slots:
+            return conn.session.get(f"{conn.scheme}://{conn.host}/api/?{urlencode(query)}", verify=conn.verify, timeout=timeout, **kwargs)
+
+
+def _is_auth_failure(response):
+    """True if Panorama rejected the API key: HTTP 403, or an error response with an auth error code."""
+    if response.status_code == 403:
+        return True
+    head = response.content[:256]
+    return b'status="error"' in head and any(code in head for code in AUTH_ERROR_CODES)
@@ -0,0 +1,217 @@
+import re
+import threading
+import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree as _lxml
+except ImportError:
+    _lxml = None
+
+# Parsers for the PAN-OS XML API responses the poller reads. Each is a pure function over the raw
+# response bytes (requests' response.content), so they can be benchmarked and checked against
+# recorded responses without a firewall; see benchmarks/bench_parsers.py and benchmarks/corpus.
+#
+# lxml is used when it is installed (it parses the large counter and session lists up to twice as
+# fast); otherwise the standard library's ElementTree. Both give the same results.
+
+_lxml_parsers = threading.local()
+
+def _lxml_fromstring(xml):
+    # lxml parsers are not shared between threads; the poller parses from a thread pool
+    parser = getattr(_lxml_parsers, 'parser', None)
+    if parser is None:
+        parser = _lxml_parsers.parser = _lxml.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+    return _lxml.fromstring(xml, parser)
+
+BACKENDS = {'ElementTree': ET.fromstring}
+if _lxml is not None:
+    BACKENDS['lxml'] = _lxml_fromstring
+    _LXML_COUNT_RESULT_ENTRIES = _lxml.XPath('count(//result/entry)')
+# Backend in use; set to another key of BACKENDS to compare them
+backend = 'lxml' if _lxml is not None else 'ElementTree'
+
+def fromstring(xml):
+    """Parses an API response (bytes) with the selected backend. Returns the root element."""
+    return BACKENDS[backend](xml)
+
+
+# --- <show><session><info/> ---
+
+def parse_session_info(xml):
+    """Returns (active_sessions, throughput_kbps). Raises if the response has no session count."""
+    root = fromstring(xml)
+    return int(root.find('.//num-active').text or 0), float(root.findtext('.//kbps') or 0)
+
+
+# --- <show><counter><interface>all ---
+
+_PHYSICAL_INTERFACE_RE = re.compile(r'^ethernet\d+/\d+(/\d+)?$')
+_AGGREGATE_INTERFACE_RE = re.compile(r'^ae\d+$')
+
+def is_physical_interface(name):
+    return _PHYSICAL_INTERFACE_RE.match(name) is not None
+
+def parse_interface_counters(xml, all_interfaces=False):
+    """
+    Returns {interface: (ibytes, obytes, ipackets, opackets)} for physical ports and AE bundles
+    (every interface with all_interfaces).
+    """
+    counters = {}
+    for entry in fromstring(xml).iter('entry'):
+        # Filtered on the name first: most entries on a large firewall are subinterfaces and tunnels
+        name = entry.findtext('name')
+        if not name or not (all_interfaces or _PHYSICAL_INTERFACE_RE.match(name) or _AGGREGATE_INTERFACE_RE.match(name)):
+            continue
+        ibytes = entry.findtext('ibytes')
+        if ibytes is None:
+            continue
+        counters[name] = (int(ibytes), int(entry.findtext('obytes') or 0), int(entry.findtext('ipackets') or 0), int(entry.findtext('opackets') or 0))
+    return counters
+
+
+# --- <show><system><resources/> (top output in CDATA) ---
+
+# Management CPU: the user space share from top's "%Cpu(s):  2.3 us, ..." line
+_MANAGEMENT_CPU_RE = re.compile(r"%Cpu\(s\):\s+([\d\.]+) us")
+# Memory: "KiB Mem : 16232260 total, ..." (older releases) or "MiB Mem :  16000.0 total, ..."
+_MEMORY_LINE_RE = re.compile(r"^.*(?:KiB|MiB) Mem.*$", re.MULTILINE)
+
+def parse_system_resources(xml):
+    """Returns (management_cpu_percent, memory_utilization_percent); 0.0 for what cannot be read."""
+    cpu_load = memory_utilization = 0.0
+    cdata = fromstring(xml).findtext('.//result')
+    if not cdata:
+        return cpu_load, memory_utilization
+
+    match = _MANAGEMENT_CPU_RE.search(cdata)
+    if match:
+        try:
+            cpu_load = float(match.group(1))
+        except ValueError:
+            pass
+
+    # Only the top of the output is searched; the process list below can run to hundreds of lines
+    match = _MEMORY_LINE_RE.search(cdata)
+    if match:
+        parts = match.group(0).split()
+        try:
+            # 'total' and 'used' values precede their labels
+            total_mem = float(parts[parts.index('total,') - 1])
+            used_mem = float(parts[parts.index('used,') - 1])
+            if total_mem > 0:
+                memory_utilization = (used_mem / total_mem) * 100
+        except (ValueError, IndexError):
+            pass
+    return cpu_load, memory_utilization
+
+
+# --- <show><running><resource-monitor><minute><last>1 ---
+
+def parse_dataplane_load(xml):
+    """Returns the average one-minute CPU load across every core of every dataplane processor (0.0 if none)."""
+    core_loads = []
+    data_processors = fromstring(xml).find('.//data-processors')
+    if data_processors is not None:
+        # One child per dataplane processor (dp0, dp1, ...), each with one <entry> per core
+        for value in data_processors.iterfind('*/minute/cpu-load-average/entry/value'):
+            if value.text:
+                core_loads.append(int(value.text))
+    return sum(core_loads) / len(core_loads) if core_loads else 0.0
+
+
+# --- <show><session><all><filter><ssl-decrypt>yes ---
+
+def count_ssl_decrypt_sessions(xml):
+    root = fromstring(xml)
+    if backend == 'lxml':
+        # Counted inside libxml2 instead of creating a Python object for every session
+        return int(_LXML_COUNT_RESULT_ENTRIES(root))
+    return len(root.findall('.//result/entry'))
+
+
+# --- <show><system><info/> ---
+
+def parse_system_info(xml):
+    """
+    Returns the firewall's model, hostname and PAN-OS version, plus 'advance_routing_enabled' (1/0)
+    when the firewall reports it (PAN-OS 10.2+), else None.
+    """
+    root = fromstring(xml)
+    advanced_routing = root.findtext('.//advanced-routing')
+    return {'model': root.findtext('.//model'), 'hostname': root.findtext('.//hostname'), 'sw_version': root.findtext('.//sw-version'),
+            'advance_routing_enabled': None if advanced_routing is None else int(advanced_routing.strip().lower() in ('on', 'yes', 'enabled'))}
+
+
+# --- <show><system><state><filter>cfg.general.* ---
+
+# Raw config names -> firewall_details columns
+SYSTEM_STATE_COLUMNS = {
+    'cfg.general.max-session': 'max_sessions',
+    'cfg.general.max-policy-rule': 'max_rules',
+    'cfg.general.max-nat-policy-rule': 'max_nat_rules',
+    'cfg.general.max-ssl-policy-rule': 'max_ssl_decrypt_rules',
+    'cfg.general.max-qos-policy-rule': 'max_qos_rules',
+    'cfg.general.max-pbf-policy-rule': 'max_pbf_rules',
+    'cfg.general.max-dos-policy-rule': 'max_dos_rules',
+    'cfg.general.max-zone': 'max_zones',
+    'cfg.general.max-vsys': 'max_vsys',
+    'cfg.general.max-vrouter': 'max_virtual_routers',
+    'cfg.general.max-vlan': 'max_vlans',
+    'cfg.general.max-ike-peers': 'max_ike_peers',
+    'cfg.general.max-tunnel': 'max_ipsec_tunnels',
+    'cfg.general.advance-routing-enabled': 'advance_routing_enabled',
+    'cfg.general.max-ssl-tunnel': 'max_ssl_tunnels',
+    'cfg.general.max-address-per-group': 'max_addr_per_group',
+    'cfg.general.max-cert-cache-entries': 'max_cert_cache',
+    'cfg.general.max-dns-cache': 'max_dns_cache',
+    'cfg.general.max-ip6addrtbl': 'max_ipv6_addrs',
+    'cfg.general.max-mac': 'max_mac_addrs',
+    'cfg.general.max-profile': 'max_security_profiles',
+    'cfg.general.max-url-pattern': 'max_url_patterns',
+    'cfg.general.max-vwire': 'max_vwires',
+    'cfg.general.max-hip': 'max_hip_objects',
+    'cfg.general.max-blacklist': 'max_custom_signatures',
+    'cfg.general.max-ifnet': 'max_interfaces',
+    'cfg.general.max-bfd-session': 'max_bfd_sessions',
+    'cfg.general.max-sdwan-policy-rule': 'max_sdwan_rules',
+    'cfg.general.max-mroute': 'max_mroutes',
+    'cfg.general.max-schedule': 'max_schedules',
+    'cfg.general.max-edl-objs': 'max_edl_objects',
+    'cfg.general.max-registered-ip-address': 'max_registered_ips',
+    'cfg.general.max-tsagents': 'max_ts_agents',
+    'cfg.general.max-proxy-session': 'max_proxy_sessions',
+    'cfg.general.max-auth-policy-rule': 'max_auth_rules',
+    'cfg.general.max-address': 'max_address_objects',
+    'cfg.general.max-address-group': 'max_address_groups',
+    'cfg.general.max-service': 'max_service_objects',
+    'cfg.general.max-service-group': 'max_service_groups',
+    'cfg.general.max-route': 'max_routes',
+    'cfg.general.max-arp': 'max_arp_entries'
+}
+
+def parse_system_state(xml):
+    """
+    Returns {firewall_details column: int} from the 'key: value' lines of the cfg.general.* state
+    (decimal or hex integers; True/False as 1/0), or None when the response is empty. Values that are
+    not integers (such as lists) and lines without a value are skipped.
+    """
+    cdata = fromstring(xml).findtext('.//result')
+    if not cdata:
+        return None
+    parsed_data = {}
+    for line in cdata.strip().split('\n'):
+        key, separator, value = line.partition(':')
+        db_column = SYSTEM_STATE_COLUMNS.get(key.strip()) if separator else None
+        if db_column is None:
+            continue
+        val_str = value.strip()
+        try:
+            if val_str.lower() == 'true':
+                parsed_data[db_column] = 1
+            elif val_str.lower() == 'false':
+                parsed_data[db_column] = 0
+            else:
+                parsed_data[db_column] = int(val_str, 16) if val_str.startswith('0x') else int(val_str)
+        except ValueError:
+            pass
+    return parsed_data
@@ -0,0 +1,236 @@
+import queue
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+import device_collection
+import device_health
+import poll_scheduler
+
+# The schedule/dispatch/collect loop shared by the local poller (app.background_worker_loop) and the
+# remote collector agent (remote_collector.run). Each firewall's due metric groups are dispatched to a
+# pool of collector threads as soon as they are due, staggered by device, without waiting for the rest
+# of the fleet. A firewall only ever has one poll in flight: groups that fall due meanwhile wait for it
+# to finish, and a group that is due again while its previous poll is still running is skipped (and
+# counted). Unreachable firewalls are backed off (device_health) and only probed.
+#
+# The caller owns the loop: it sets the firewalls and credentials, calls dispatch_due, collect and
+# dispatch_waiting, and decides what to do with the collected results (write them to the database or
+# push them to the web app). A PollLoop is used from one thread; only the collector threads'
+# completions arrive from others.
+
+# Upper bound on concurrent device collections so a large fleet does not open hundreds of sockets at once
+COLLECTION_MAX_WORKERS = 16
+# How often the poller re-reads the firewall list and settings, so new firewalls and changes are picked up promptly
+SCHEDULER_MAX_SLEEP = 5
+# Finished polls are written in one batch at most this often, instead of one transaction per device
+RESULT_FLUSH_INTERVAL = 1.0
+# A poll that starts more than this many seconds after it was due is counted as late
+LATE_POLL_TOLERANCE = 2.0
+# Firewalls whose model/hostname/version could not be discovered are retried this often
+DISCOVERY_RETRY_SECONDS = 300
+
+
+def _discovered(fw):
+    return bool(fw['model'] and fw['hostname'] and fw['sw_version'])
+
+
+def direct_access(fw):
+    """(http, api_key) for collecting from a firewall directly: requests, and its own cached key."""
+    return requests, None
+
+
+class PollerStats:
+    """Poller health counters (late/skipped polls and scheduling lag), read by the web workers."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            'dispatched': 0, 'late': 0, 'skipped': 0, 'in_flight': 0, 'unreachable': 0,
+            'last_lag_seconds': 0.0, 'max_lag_seconds': 0.0, 'avg_lag_seconds': 0.0,
+            'groups': {group: {'dispatched': 0, 'late': 0, 'skipped': 0} for group in poll_scheduler.METRIC_GROUPS},
+        }
+
+    def record_dispatched(self, group, lag):
+        """Counts a dispatched poll job and how long after its due time it started."""
+        with self._lock:
+            self._stats['dispatched'] += 1
+            self._stats['groups'][group]['dispatched'] += 1
+            if lag > LATE_POLL_TOLERANCE:
+                self._stats['late'] += 1
+                self._stats['groups'][group]['late'] += 1
+            self._stats['last_lag_seconds'] = lag
+            self._stats['max_lag_seconds'] = max(self._stats['max_lag_seconds'], lag)
+            # Exponentially weighted, so the average follows the recent scheduling lag
+            self._stats['avg_lag_seconds'] += 0.05 * (lag - self._stats['avg_lag_seconds'])
+
+    def record_skipped(self, group):
+        """Counts a poll job dropped because the previous poll of the same group was still running."""
+        with self._lock:
+            self._stats['skipped'] += 1
+            self._stats['groups'][group]['skipped'] += 1
+
+    def set_gauges(self, in_flight, unreachable):
+        with self._lock:
+            self._stats['in_flight'] = in_flight
+            self._stats['unreachable'] = unreachable
+
+    def snapshot(self):
+        """Returns a copy of the counters."""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['groups'] = {group: dict(counts) for group, counts in self._stats['groups'].items()}
+        return snapshot
+
+
+class PollLoop:
+    """One poller's scheduler, collector pool and per-device poll state."""
+    def __init__(self, workers=COLLECTION_MAX_WORKERS, stats=None, wakeup=None):
+        self.scheduler = poll_scheduler.PollScheduler()
+        self.health = device_health.DeviceHealth()
+        self.stats = stats if stats is not None else PollerStats()
+        self.wakeup = wakeup if wakeup is not None else threading.Event()
+        self.pool = ThreadPool(processes=workers)
+        self.completed = queue.Queue()
+        self.firewalls = {}        # firewall_id -> row with ip_address, model, hostname, sw_version, advance_routing_enabled (and serial)
+        self.api_keys = {}         # firewall_id -> cached API key
+        self.firewall_states = {}  # firewall_id -> interface counter snapshot
+        self.in_flight = {}        # firewall_id -> groups of the poll currently running
+        self.waiting = {}          # firewall_id -> {group: due} for groups that fell due while a poll was in flight
+        self.fw_user = self.fw_password = None
+        self.throughput_source = 'physical'
+        self.access = direct_access  # fw -> (http, api_key), e.g. a Panorama-proxied handle
+
+    def set_firewalls(self, firewalls, group_intervals, overrides, now):
+        """
+        Replaces the polled firewalls and their intervals. New firewalls are scheduled (those already
+        discovered skip the immediate discovery poll); state of the removed ones is dropped. Returns
+        the ids of the removed firewalls.
+        """
+        previous, self.firewalls = self.firewalls, firewalls
+        self.scheduler.configure(group_intervals, overrides)
+        discovered = [fw_id for fw_id, fw in firewalls.items() if _discovered(fw)]
+        self.scheduler.sync_devices(firewalls.keys(), now, discovered=discovered)
+        for state in (self.waiting, self.firewall_states, self.api_keys):
+            for firewall_id in [fw_id for fw_id in state if fw_id not in firewalls]:
+                del state[firewall_id]
+        for firewall_id in self.health.open_devices():
+            if firewall_id not in firewalls:
+                self.health.forget(firewall_id)
+        return [fw_id for fw_id in previous if fw_id not in firewalls]
+
+    def expedite(self, now, device_ids=None):
+        """Makes the dashboard groups of all (or the given) firewalls due now, e.g. for a manual poll."""
+        self.scheduler.expedite(poll_scheduler.FAST_GROUPS, now, device_ids=device_ids)
+
+    def _on_done(self, res):
+        self.completed.put(res)
+        self.wakeup.set()
+
+    def _on_error(self, firewall_id):
+        # Keep the device from being stuck 'in flight' if its collector raised
+        host = self.firewalls[firewall_id]['ip_address'] if firewall_id in self.firewalls else firewall_id
+        return lambda e: self._on_done({'firewall_id': firewall_id, 'host': host, 'status': 'error', 'api_key': None, 'groups': {},
+                                        'new_state': self.firewall_states.get(firewall_id, {})})
+
+    def _dispatch(self, firewall_id, jobs, now):
+        fw = self.firewalls[firewall_id]
+        if jobs == device_health.PROBE_GROUP:
+            ordered_groups = [device_health.PROBE_GROUP]
+        else:
+            for group, due in jobs.items():
+                self.stats.record_dispatched(group, now - due)
+                device_collection.collector.record_dispatch(firewall_id, group, now - due, now)
+            ordered_groups = [g for g in poll_scheduler.METRIC_GROUPS if g in jobs]
+        self.in_flight[firewall_id] = set(ordered_groups)
+        http, proxy_key = self.access(fw)
+        task = (firewall_id, fw['ip_address'], ordered_groups, proxy_key or self.api_keys.get(firewall_id), self.fw_user, self.fw_password,
+                self.firewall_states.get(firewall_id, {}), bool(fw['advance_routing_enabled']), fw['sw_version'], http, self.throughput_source)
+        device_collection.collector.job_queued()
+        self.pool.apply_async(device_collection.run_device_jobs, (task,), callback=self._on_done, error_callback=self._on_error(firewall_id))
+
+    def dispatch_due(self, now, skip=None):
+        """Dispatches the jobs that are due. Firewalls for which skip(firewall_id) is true are not polled."""
+        jobs_by_device = {}
+        for firewall_id, group, due in self.scheduler.pop_due(now):
+            self.scheduler.reschedule(firewall_id, group, due, now)
+            if skip is not None and skip(firewall_id):
+                continue
+            if self.health.is_open(firewall_id):
+                # Unreachable: no regular polls, just one cheap probe once the backoff expires
+                if firewall_id not in self.in_flight and self.health.probe_due(firewall_id, now):
+                    self._dispatch(firewall_id, device_health.PROBE_GROUP, now)
+                continue
+            if firewall_id in self.in_flight:
+                if group in self.in_flight[firewall_id] or group in self.waiting.get(firewall_id, {}):
+                    # Previous poll of this group has not finished: skip this run rather than queue up behind it
+                    self.stats.record_skipped(group)
+                else:
+                    self.waiting.setdefault(firewall_id, {})[group] = due
+                continue
+            jobs_by_device.setdefault(firewall_id, {})[group] = due
+        for firewall_id, jobs in jobs_by_device.items():
+            self._dispatch(firewall_id, jobs, now)
+
+    def dispatch_waiting(self, now):
+        """Dispatches the groups that fell due while their device was busy, once it no longer is."""
+        for firewall_id in [fw_id for fw_id in self.waiting if fw_id not in self.in_flight]:
+            self._dispatch(firewall_id, self.waiting.pop(firewall_id), now)
+
+    def has_results(self):
+        return not self.completed.empty()
+
+    def collect(self, now, keep=None):
+        """
+        Takes the finished polls and updates the API keys, counter state and device health from them.
+        Results of firewalls no longer polled (or for which keep(firewall_id) is false) are dropped.
+        Each returned result has 'status' 'unreachable' if its device is backed off, and 'state_changed'
+        if it carries a new counter snapshot.
+        """
+        results = []
+        while not self.completed.empty():
+            results.append(self.completed.get_nowait())
+        attempted_groups = {res['firewall_id']: self.in_flight.pop(res['firewall_id'], set()) for res in results}
+        results = [res for res in results if res['firewall_id'] in self.firewalls and (keep is None or keep(res['firewall_id']))]
+        for res in results:
+            firewall_id = res['firewall_id']
+            self.api_keys[firewall_id] = res['api_key']
+            res['state_changed'] = bool(res['new_state']) and res['new_state'] is not self.firewall_states.get(firewall_id)
+            self.firewall_states[firewall_id] = res['new_state']
+            if res['status'] == 'success':
+                if self.health.record_success(firewall_id):
+                    print(f"Firewall {res['host']} is reachable again; resuming polling.")
+                    self.expedite(now, device_ids=[firewall_id])
+            else:
+                if self.health.record_failure(firewall_id, now):
+                    print(f"Firewall {res['host']} failed {self.health.failure_threshold} polls in a row; backing off.")
+                    self.waiting.pop(firewall_id, None)
+                if self.health.is_open(firewall_id):
+                    res['status'] = 'unreachable'
+
+            info = res['groups'].get('system_info')
+            discovered = info and info['model'] and info['hostname'] and info['sw_version']
+            if not discovered and 'system_info' in attempted_groups[firewall_id] and not _discovered(self.firewalls[firewall_id]):
+                # Undiscovered firewalls are retried soon rather than on the slow system-info schedule
+                self.scheduler.schedule_at(firewall_id, 'system_info', now + DISCOVERY_RETRY_SECONDS)
+        return results
+
+    def record_gauges(self):
+        self.stats.set_gauges(len(self.in_flight), len(self.health.open_devices()))
+        device_collection.collector.record_queues(self.completed.qsize(), len(self.in_flight), sum(len(groups) for groups in self.waiting.values()))
+
+    def next_wake(self, now, last_flush, max_sleep=SCHEDULER_MAX_SLEEP):
+        """When to wake up: the next job falls due, or the next batch of finished polls should be taken."""
+        wake_at = now + max_sleep
+        next_due = self.scheduler.next_due()
+        if next_due is not None:
+            wake_at = min(wake_at, next_due)
+        if not self.completed.empty():
+            wake_at = min(wake_at, last_flush + RESULT_FLUSH_INTERVAL)
+        return wake_at
+
+    def sleep_until(self, wake_at):
+        """Sleeps until wake_at, a poll finishes, or the wakeup event is set (e.g. a manual poll)."""
+        self.wakeup.wait(timeout=max(0.0, wake_at - time.time()))
+        self.wakeup.clear()
@@ -0,0 +1,150 @@
+import heapq
+import itertools
+import zlib
+
+# Metric groups the collector polls, in the order they run when several are due for the same device
+# (discovery and details first, so capacity polling sees fresh capabilities), with default intervals.
+METRIC_GROUPS = {
+    'system_info': 6 * 3600,         # model, hostname, PAN-OS version
+    'details': 24 * 3600,            # cfg.general.* capacity limits
+    'throughput_sessions': 30,       # session info + interface counters
+    'cpu_memory': 30,                # system resources + resource monitor
+    'ssl_decrypt': 60,               # SSL decrypt session count
+    'capacity': 3600,                # object/route/ARP/... usage counts
+}
+
+# Groups that make up a stats sample on the dashboard (the old single-interval poll)
+FAST_GROUPS = ('throughput_sessions', 'cpu_memory', 'ssl_decrypt')
+
+# Settings key holding each group's fleet-wide interval. Throughput keeps the original POLL_INTERVAL key.
+GROUP_INTERVAL_SETTINGS = {
+    'throughput_sessions': 'POLL_INTERVAL',
+    'cpu_memory': 'POLL_INTERVAL_CPU_MEMORY',
+    'ssl_decrypt': 'POLL_INTERVAL_SSL_DECRYPT',
+    'capacity': 'POLL_INTERVAL_CAPACITY',
+    'system_info': 'POLL_INTERVAL_SYSTEM_INFO',
+    'details': 'POLL_INTERVAL_DETAILS',
+}
+
+# New devices' first polls are spread over at most this many seconds (or the group's interval, if shorter)
+MAX_STAGGER_SECONDS = 60
+
+# Golden-ratio conjugate: consecutive device ids land evenly spread across an interval
+_PHASE_STEP = 0.6180339887498949
+
+# Human-readable labels for the settings and firewall detail pages
+GROUP_LABELS = {
+    'throughput_sessions': 'Throughput & Sessions',
+    'cpu_memory': 'CPU & Memory',
+    'ssl_decrypt': 'SSL Decrypt Sessions',
+    'capacity': 'Capacity Counts',
+    'system_info': 'System Info (Model/Version)',
+    'details': 'Capacity Limits (Details)',
+}
+
+
+def group_intervals_from_settings(settings):
+    """Returns {group: seconds} from the settings table, falling back to the defaults."""
+    intervals = {}
+    for group, default in METRIC_GROUPS.items():
+        try:
+            intervals[group] = max(1, int(settings.get(GROUP_INTERVAL_SETTINGS[group], default)))
+        except (TypeError, ValueError):
+            intervals[group] = default
+    return intervals
+
+
+class PollScheduler:
+    """
+    Due-time priority queue of (device, metric group) poll jobs.
+
+    Each job is rescheduled one interval after it was due, using the device's override for that group
+    if one is set and the group's fleet-wide interval otherwise. Every device gets a fixed phase, so the
+    fleet's polls are spread across the interval instead of all landing at the same instant.
+    """
+    def __init__(self, group_intervals=None, max_stagger=MAX_STAGGER_SECONDS):
+        self.group_intervals = dict(METRIC_GROUPS)
+        if group_intervals:
+            self.group_intervals.update(group_intervals)
+        self.device_overrides = {}
+        self.max_stagger = max_stagger
+        self._heap = []
+        self._due = {}  # (device_id, group) -> due time of the live heap entry
+        self._seq = itertools.count()
+
+    def configure(self, group_intervals=None, device_overrides=None):
+        """Updates intervals. Changes apply from each job's next reschedule."""
+        if group_intervals is not None:
+            self.group_intervals.update(group_intervals)
+        if device_overrides is not None:
+            self.device_overrides = dict(device_overrides)
+
+    def interval(self, device_id, group):
+        return self.device_overrides.get((device_id, group), self.group_intervals[group])
+
+    @staticmethod
+    def phase(device_id):
+        """Fraction of an interval (0 <= phase < 1) this device's polls are offset by."""
+        if isinstance(device_id, int):
+            return (device_id * _PHASE_STEP) % 1.0
+        return zlib.crc32(str(device_id).encode()) / 2**32
+
+    def _push(self, device_id, group, due):
+        self._due[(device_id, group)] = due
+        heapq.heappush(self._heap, (due, next(self._seq), device_id, group))
+
+    def sync_devices(self, device_ids, now, discovered=()):
+        """
+        Schedules every group for new devices (staggered by the device's phase) and drops removed devices.
+        New devices in `discovered` already have their system info, so their first system_info poll is
+        spread over the whole interval instead.
+        """
+        device_ids = set(device_ids)
+        discovered = set(discovered)
+        known = {device_id for device_id, _ in self._due}
+        for device_id in device_ids - known:
+            phase = self.phase(device_id)
+            for group in METRIC_GROUPS:
+                window = self.interval(device_id, group)
+                if not (group == 'system_info' and device_id in discovered):
+                    window = min(window, self.max_stagger)
+                self._push(device_id, group, now + phase * window)
+        for job in [job for job in self._due if job[0] not in device_ids]:
+            del self._due[job]  # Heap entry is discarded lazily when popped
+
+    def pop_due(self, now):
+        """Removes and returns every (device_id, group, due) job due at or before now."""
+        jobs = []
+        while self._heap and self._heap[0][0] <= now:
+            due, _, device_id, group = heapq.heappop(self._heap)
+            if self._due.get((device_id, group)) == due:
+                del self._due[(device_id, group)]
+                jobs.append((device_id, group, due))
+        return jobs
+
+    def reschedule(self, device_id, group, due, now):
+        """Queues a finished job's next run. A job that fell a whole interval behind skips ahead."""
+        interval = self.interval(device_id, group)
+        next_due = due + interval
+        if next_due <= now:
+            next_due = now + interval
+        self._push(device_id, group, next_due)
+
+    def schedule_at(self, device_id, group, due):
+        """Moves one queued job to a specific due time (e.g. an earlier retry)."""
+        if (device_id, group) in self._due:
+            self._push(device_id, group, due)
+
+    def expedite(self, groups, now, device_ids=None):
+        """Makes the given groups due immediately for every device, or just device_ids (manual 'Refresh Now')."""
+        for device_id, group in [job for job in self._due if job[1] in groups and (device_ids is None or job[0] in device_ids)]:
+            self._push(device_id, group, now)
+
+    def next_due(self):
+        """Due time of the earliest queued job, or None."""
+        while self._heap:
+            due, _, device_id, group = self._heap[0]
+            if self._due.get((device_id, group)) == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
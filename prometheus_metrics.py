@@ -0,0 +1,170 @@
+import time
+
+# Prometheus text exposition (format 0.0.4) of the fleet's latest metrics and the collector's own
+# statistics. The poller keeps each firewall's series pre-rendered, re-rendering a firewall only when
+# its values change, and publishes the whole page after each batch of results; /metrics just returns
+# the last published page, so a scrape never touches the database and costs the same however often
+# it runs.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Latest fast-path values: (metric, help, key in the poller's latest values)
+FIREWALL_VALUES = [
+    ('panos_active_sessions', 'Active sessions.', 'active_sessions'),
+    ('panos_throughput_input_bits_per_second', 'Input throughput (bits per second) of the interfaces selected by the throughput source setting.', 'total_input_bps'),
+    ('panos_throughput_output_bits_per_second', 'Output throughput (bits per second) of the interfaces selected by the throughput source setting.', 'total_output_bps'),
+    ('panos_management_cpu_percent', 'Management plane CPU (user space) in percent.', 'cpu_load'),
+    ('panos_dataplane_cpu_percent', 'Average one-minute dataplane CPU load across all cores in percent.', 'dataplane_load'),
+    ('panos_memory_utilization_percent', 'Management plane memory utilization in percent.', 'memory_utilization'),
+    ('panos_ssl_decrypt_sessions', 'Active SSL decryption sessions.', 'ssl_decrypt_sessions'),
+]
+
+# Per-firewall families in page order: (metric, type, help)
+FIREWALL_FAMILIES = [
+    ('panos_firewall_info', 'gauge', 'Firewall hostname, model, PAN-OS version and serial number (always 1).'),
+    ('panos_firewall_reachable', 'gauge', '1 unless the firewall failed enough polls in a row to be backed off.'),
+] + [(name, 'gauge', help_text) for name, help_text, _ in FIREWALL_VALUES] + [
+    ('panos_last_sample_timestamp_seconds', 'gauge', 'Unix time the latest values were collected.'),
+    ('panos_capacity_utilization_percent', 'gauge', 'Current usage of a capacity resource as a percentage of the model limit.'),
+]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items() if value is not None)
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+def _family(name, kind, help_text, samples):
+    """samples: [(metric suffix, labels string, value)]"""
+    lines = [f"# HELP {name} {help_text}\n# TYPE {name} {kind}\n"]
+    for suffix, labels, value in samples:
+        lines.append(f"{name}{suffix}{{{labels}}} {_number(value)}\n" if labels else f"{name}{suffix} {_number(value)}\n")
+    return ''.join(lines)
+
+def _histogram(histogram, labels=''):
+    """Histogram samples from a collector_stats.LatencyHistogram.as_dict() (per-bucket counts, made cumulative)."""
+    samples, cumulative = [], 0
+    for bound, count in histogram['buckets'].items():
+        cumulative += count
+        samples.append(('_bucket', ','.join(filter(None, [labels, f'le="{bound}"'])), cumulative))
+    samples += [('_sum', labels, histogram['total_seconds']), ('_count', labels, histogram['count'])]
+    return samples
+
+
+class FleetMetrics:
+    """
+    Pre-rendered /metrics page. Written by the poller thread only (update, retain, publish); the web
+    workers read `body`, which publish replaces in a single assignment.
+    """
+    def __init__(self):
+        self._devices = {}   # firewall_id -> {'info', 'values', 'sample_time', 'reachable', 'capacity'}
+        self._lines = {}     # firewall_id -> {family: rendered sample lines}
+        self._render_seconds = 0.0
+        self.published = None
+        self.body = b''
+
+    def update(self, firewall_id, info=None, values=None, sample_time=None, reachable=None, capacity=None):
+        """
+        Sets any of a firewall's labels (info: host, hostname, model, sw_version, serial), latest
+        values (merged into the previous ones, so each metric group can update its own), collection
+        time, reachability and capacity utilizations ({resource: percent}). Its series are
+        re-rendered only if one of them changed.
+        """
+        device = self._devices.setdefault(firewall_id, {'info': None, 'values': {}, 'sample_time': None, 'reachable': True, 'capacity': None})
+        if values is not None:
+            values = {**device['values'], **values}
+        changed = False
+        for field, value in (('info', info), ('values', values), ('sample_time', sample_time), ('reachable', reachable), ('capacity', capacity)):
+            if value is not None and device[field] != value:
+                device[field] = dict(value) if isinstance(value, dict) else value
+                changed = True
+        if changed or firewall_id not in self._lines:
+            self._lines[firewall_id] = self._render_device(device)
+
+    def retain(self, firewall_ids):
+        """Drops the series of firewalls that are no longer configured."""
+        for firewall_id in [fw_id for fw_id in self._devices if fw_id not in firewall_ids]:
+            del self._devices[firewall_id]
+            self._lines.pop(firewall_id, None)
+
+    @staticmethod
+    def _render_device(device):
+        info = device['info']
+        if info is None:
+            return {}
+        # Series are identified by address only, so they survive a hostname or version change; the
+        # other labels are on panos_firewall_info (join with `* on (host) group_left (hostname) panos_firewall_info`)
+        labels = _labels(host=info['host'])
+        info_labels = _labels(host=info['host'], hostname=info.get('hostname') or '', model=info.get('model') or '', sw_version=info.get('sw_version') or '', serial=info.get('serial') or '')
+        lines = {
+            'panos_firewall_info': f"panos_firewall_info{{{info_labels}}} 1\n",
+            'panos_firewall_reachable': f"panos_firewall_reachable{{{labels}}} {int(bool(device['reachable']))}\n",
+        }
+        values = device['values']
+        if values:
+            for name, _, key in FIREWALL_VALUES:
+                if values.get(key) is not None:
+                    lines[name] = f"{name}{{{labels}}} {_number(values[key])}\n"
+        if device['sample_time'] is not None:
+            lines['panos_last_sample_timestamp_seconds'] = f"panos_last_sample_timestamp_seconds{{{labels}}} {_number(float(device['sample_time']))}\n"
+        if device['capacity']:
+            lines['panos_capacity_utilization_percent'] = ''.join(
+                f"panos_capacity_utilization_percent{{{labels},resource=\"{resource}\"}} {_number(float(percent))}\n"
+                for resource, percent in device['capacity'].items() if percent is not None)
+        return lines
+
+    def publish(self, collector_totals, poller_stats, now=None):
+        """Renders the page from the per-firewall series plus the collector's statistics and makes it the one served."""
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        parts = []
+        for name, kind, help_text in FIREWALL_FAMILIES:
+            lines = [device_lines[name] for device_lines in self._lines.values() if name in device_lines]
+            if lines:
+                parts.append(f"# HELP {name} {help_text}\n# TYPE {name} {kind}\n")
+                parts.extend(lines)
+        parts.append(self._render_collector(collector_totals, poller_stats))
+        parts.append(_family('panos_monitor_firewalls', 'gauge', 'Configured firewalls.', [('', '', len(self._devices))]))
+        parts.append(_family('panos_monitor_metrics_published_timestamp_seconds', 'gauge', 'Unix time this page was rendered.', [('', '', float(now))]))
+        parts.append(_family('panos_monitor_metrics_render_seconds', 'gauge', 'Time taken to render the previous page.', [('', '', self._render_seconds)]))
+        self.body = ''.join(parts).encode()
+        self.published = now
+        self._render_seconds = time.perf_counter() - start
+
+    @staticmethod
+    def _render_collector(totals, poller_stats):
+        commands = sorted(totals['commands'].items())
+        request_samples = []
+        for command, stats in commands:
+            request_samples += _histogram(stats, _labels(command=command))
+        groups = sorted(poller_stats['groups'].items())
+        return ''.join([
+            _family('panos_monitor_start_time_seconds', 'gauge', 'Unix time the collector started.', [('', '', float(totals['started']))]),
+            _family('panos_monitor_api_request_duration_seconds', 'histogram', 'PAN-OS API call latency by command.', request_samples),
+            _family('panos_monitor_api_request_errors_total', 'counter', 'PAN-OS API calls that failed or returned an HTTP error, by command.',
+                    [('', _labels(command=command), stats['errors']) for command, stats in commands]),
+            _family('panos_monitor_api_response_bytes_total', 'counter', 'PAN-OS API response bytes received, by command.',
+                    [('', _labels(command=command), stats['response_bytes']) for command, stats in commands]),
+            _family('panos_monitor_parse_seconds_total', 'counter', 'Time spent parsing PAN-OS API responses, by command.',
+                    [('', _labels(command=command), stats['parse_seconds']) for command, stats in commands]),
+            _family('panos_monitor_keygen_duration_seconds', 'histogram', 'API key generation latency.',
+                    _histogram(totals['keygen'])),
+            _family('panos_monitor_device_job_duration_seconds', 'histogram', 'Duration of one firewall\'s poll (all of its due metric groups).',
+                    _histogram(totals['jobs'])),
+            _family('panos_monitor_db_write_duration_seconds', 'histogram', 'Duration of writing one batch of poll results to the database.',
+                    _histogram(totals['db_writes'])),
+            _family('panos_monitor_polls_total', 'counter', 'Poll jobs dispatched, by metric group.',
+                    [('', _labels(group=group), counts['dispatched']) for group, counts in groups]),
+            _family('panos_monitor_polls_late_total', 'counter', 'Poll jobs started late, by metric group.',
+                    [('', _labels(group=group), counts['late']) for group, counts in groups]),
+            _family('panos_monitor_polls_skipped_total', 'counter', 'Poll jobs skipped because the previous poll of the group was still running, by metric group.',
+                    [('', _labels(group=group), counts['skipped']) for group, counts in groups]),
+            _family('panos_monitor_scheduling_lag_seconds', 'gauge', 'Lag of the most recently dispatched poll behind its due time.', [('', '', poller_stats['last_lag_seconds'])]),
+            _family('panos_monitor_firewalls_unreachable', 'gauge', 'Firewalls backed off after repeated failed polls.', [('', '', poller_stats['unreachable'])]),
+            _family('panos_monitor_queue_depth', 'gauge', 'Scheduler queues: finished polls not yet written, polls running, jobs waiting for a collector thread, groups waiting for their firewall.',
+                    [('', _labels(queue=queue), depth) for queue, depth in totals['queues'].items()]),
+        ])
@@ -0,0 +1,122 @@
+"""
+Remote collector agent: polls the firewalls assigned to it from a host near them (another region or
+site) and pushes the results to the web app's bulk ingest API in compressed batches. It runs the
+local collector's poll loop (poll_loop.py): same scheduler, per-device jobs and unreachable-device
+backoff.
+
+Add the collector under Settings > Remote Collectors (which shows its token once) and assign firewalls
+to it under Manage Firewalls. The agent uses its own firewall API credentials:
+
+    export PANOS_MONITOR_COLLECTOR_TOKEN=... PANOS_MONITOR_FW_PASSWORD=...
+    python remote_collector.py --server https://monitor.example.com --fw-user admin
+
+While the web app cannot be reached, results are buffered in memory (up to --max-buffered, the
+oldest being dropped beyond that) and pushed once it is back.
+"""
+import argparse
+import getpass
+import os
+import time
+
+import requests
+
+import poll_loop
+import poll_scheduler
+import remote_ingest
+
+ASSIGNMENT_REFRESH_SECONDS = 15   # How often assignment and polling settings are fetched
+STATUS_REPORT_SECONDS = 300
+
+
+def compact_groups(groups, latest_values):
+    """
+    The fast-path groups of a result share one data dict. It is sent once: under throughput_sessions
+    with the latest values of the other fast-path groups carried in (as the local poller does for its
+    stats samples), so every sample is complete whichever web worker writes it.
+    """
+    fast = [group for group in poll_scheduler.FAST_GROUPS if group in groups]
+    if not fast:
+        return groups
+    data = groups[fast[0]]
+    latest_values.update((key, value) for key, value in data.items() if key != 'interfaces')
+    compact = {group: value for group, value in groups.items() if group not in poll_scheduler.FAST_GROUPS}
+    if 'throughput_sessions' in fast:
+        compact['throughput_sessions'] = dict(latest_values, interfaces=data.get('interfaces'))
+    else:
+        compact[fast[0]] = data
+    return compact
+
+
+def run(client, fw_user, fw_password, workers):
+    """Polling loop: the local poller's poll_loop.PollLoop, whose results go to `client` instead of the database."""
+    loop = poll_loop.PollLoop(workers)
+    loop.fw_user, loop.fw_password = fw_user, fw_password
+    latest_values = {}    # firewall_id -> latest fast-path values
+    assignment_loaded_at = last_flush = last_report = 0.0
+    manual_poll_handled_at = time.time()
+
+    while True:
+        now = time.time()
+
+        # --- FETCH ASSIGNMENT AND POLLING SETTINGS ---
+        if now - assignment_loaded_at >= ASSIGNMENT_REFRESH_SECONDS or client.assignment_stale:
+            assignment_loaded_at = now
+            try:
+                assignment = client.fetch_assignment()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Could not fetch the assignment from {client.server} ({e}); polling the last known firewalls.")
+            else:
+                firewalls = {fw['id']: fw for fw in assignment['firewalls']}
+                if set(firewalls) != set(loop.firewalls):
+                    print(f"Collector '{assignment['collector']}': {len(firewalls)} firewall(s) assigned.")
+                loop.throughput_source = assignment['throughput_source']
+                overrides = {(fw_id, group): seconds for fw_id, group, seconds in assignment['overrides']}
+                for firewall_id in loop.set_firewalls(firewalls, assignment['intervals'], overrides, now):
+                    latest_values.pop(firewall_id, None)
+                if assignment['manual_poll_requested_at'] > manual_poll_handled_at:
+                    manual_poll_handled_at = assignment['manual_poll_requested_at']
+                    loop.expedite(now)
+
+        # --- DISPATCH DUE JOBS ---
+        loop.dispatch_due(now)
+
+        # --- BUFFER RESULTS FOR THE NEXT PUSH ---
+        if loop.has_results() and now - last_flush >= poll_loop.RESULT_FLUSH_INTERVAL:
+            last_flush = now
+            client.add([{'firewall_id': res['firewall_id'], 'status': res['status'], 'timestamp': now,
+                         'groups': compact_groups(res['groups'], latest_values.setdefault(res['firewall_id'], {}))}
+                        for res in loop.collect(now)])
+            loop.dispatch_waiting(now)
+        loop.record_gauges()
+
+        if now - last_report >= STATUS_REPORT_SECONDS:
+            last_report = now
+            stats = loop.stats.snapshot()
+            print(f"{len(loop.firewalls)} firewall(s), {stats['unreachable']} unreachable, {stats['late']} late and {stats['skipped']} skipped poll(s); "
+                  f"results pushed {client.pushed}, buffered {client.buffered}, rejected {client.rejected}, dropped {client.dropped}.")
+
+        loop.sleep_until(loop.next_wake(now, last_flush))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', required=True, help="URL of the web app, e.g. https://monitor.example.com")
+    parser.add_argument('--token', default=os.environ.get('PANOS_MONITOR_COLLECTOR_TOKEN'), help="collector token (default: $PANOS_MONITOR_COLLECTOR_TOKEN)")
+    parser.add_argument('--fw-user', required=True, help="firewall API user (password from $PANOS_MONITOR_FW_PASSWORD, else prompted)")
+    parser.add_argument('--workers', type=int, default=poll_loop.COLLECTION_MAX_WORKERS, help="firewalls polled concurrently")
+    parser.add_argument('--batch-size', type=int, default=remote_ingest.BATCH_SIZE)
+    parser.add_argument('--max-buffered', type=int, default=remote_ingest.MAX_BUFFERED_RESULTS)
+    parser.add_argument('--insecure', action='store_true', help="do not verify the web app's TLS certificate")
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("a collector token is required (--token or $PANOS_MONITOR_COLLECTOR_TOKEN)")
+
+    fw_password = os.environ.get('PANOS_MONITOR_FW_PASSWORD') or getpass.getpass(f"API password for {args.fw_user}: ")
+    client = remote_ingest.IngestClient(args.server, args.token, batch_size=args.batch_size, max_buffered=args.max_buffered, verify=not args.insecure)
+    client.start()
+    print(f"Remote collector pushing to {client.server}.")
+    run(client, args.fw_user, fw_password, args.workers)
+
+
+if __name__ == '__main__':
+    main()
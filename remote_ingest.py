@@ -0,0 +1,270 @@
+import collections
+import gzip
+import hashlib
+import json
+import secrets
+import threading
+import time
+
+import requests
+
+# Remote collectors: agents (remote_collector.py) that poll the firewalls assigned to them from
+# near the devices and push the results to the web app's bulk ingest API (/api/ingest) in gzip'd
+# JSON batches. Each agent has a name and a token; firewalls are assigned to at most one agent
+# (firewalls.collector), the local poller skips assigned firewalls, and the ingest API only accepts
+# an agent's results for the firewalls assigned to it.
+#
+# Batch format: {"run": str, "seq": int, "results": [{"firewall_id": int, "status": "success" |
+# "error" | "unreachable", "timestamp": epoch seconds of collection, "groups": {metric group: parsed
+# data}}]}. "run" identifies one run of the agent and "seq" numbers the batch's first result within
+# it; the server records how far each agent's run has been written, so a batch pushed again (its
+# response was lost) is not written twice. Both are optional.
+#
+# The web workers only check and queue the results they accept (remote_results); the collector
+# process writes them, oldest first, for the firewalls of the shards it holds. That keeps the
+# per-firewall state of the writer (streaming alert rules, carried-forward metrics, interface ids,
+# rollup timer) in one process however many web workers take pushes.
+
+BATCH_SIZE = 500             # Results per request
+PUSH_INTERVAL_SECONDS = 5    # A partial batch is pushed after this long
+MAX_BUFFERED_RESULTS = 100000
+MAX_RETRY_SECONDS = 60
+RESULT_STATUSES = ('success', 'error', 'unreachable')
+QUEUE_WRITE_BATCH = 5000     # Queued results the collector writes per transaction
+
+
+def create_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS remote_collectors (
+            name TEXT PRIMARY KEY,
+            token_hash TEXT NOT NULL UNIQUE,
+            created_at REAL NOT NULL,
+            last_seen REAL,
+            last_address TEXT,
+            batches INTEGER NOT NULL DEFAULT 0,
+            results INTEGER NOT NULL DEFAULT 0,
+            push_run TEXT,
+            next_seq INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS remote_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            firewall_id INTEGER NOT NULL,
+            received_at REAL NOT NULL,
+            result TEXT NOT NULL,
+            FOREIGN KEY (firewall_id) REFERENCES firewalls (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_remote_results_firewall ON remote_results (firewall_id)')
+    # Delivery position of the agent's current run, for databases created before it was tracked
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(remote_collectors)').fetchall()}
+    if 'push_run' not in columns:
+        conn.execute('ALTER TABLE remote_collectors ADD COLUMN push_run TEXT')
+        conn.execute('ALTER TABLE remote_collectors ADD COLUMN next_seq INTEGER')
+
+
+def _hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def register(conn, name):
+    """Adds a remote collector and returns its token (only its hash is stored). Raises sqlite3.IntegrityError if the name is taken."""
+    token = secrets.token_urlsafe(32)
+    conn.execute('INSERT INTO remote_collectors (name, token_hash, created_at) VALUES (?, ?, ?)', (name, _hash_token(token), time.time()))
+    return token
+
+
+def authenticate(conn, authorization):
+    """Name of the remote collector an 'Authorization: Bearer <token>' header belongs to, or None."""
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    row = conn.execute('SELECT name FROM remote_collectors WHERE token_hash = ?', (_hash_token(token.strip()),)).fetchone()
+    return row[0] if row else None
+
+
+def record_contact(conn, name, address, now, results=None):
+    """Updates a collector's last-seen time and address, and its ingest counters when `results` (accepted) is given."""
+    if results is None:
+        conn.execute('UPDATE remote_collectors SET last_seen = ?, last_address = ? WHERE name = ?', (now, address, name))
+    else:
+        conn.execute('UPDATE remote_collectors SET last_seen = ?, last_address = ?, batches = batches + 1, results = results + ? WHERE name = ?',
+                     (now, address, results, name))
+
+
+def undelivered(conn, name, results, position):
+    """
+    The results of a batch not already written for this collector, given the batch's (run, seq)
+    position, and records the batch as written. Call inside the transaction that writes them.
+    """
+    if position is None:
+        return results
+    run, seq = position
+    row = conn.execute('SELECT push_run, next_seq FROM remote_collectors WHERE name = ?', (name,)).fetchone()
+    end = seq + len(results)
+    if row and row[0] == run and row[1] is not None:
+        results = results[min(len(results), max(0, row[1] - seq)):]
+        end = max(end, row[1])
+    conn.execute('UPDATE remote_collectors SET push_run = ?, next_seq = ? WHERE name = ?', (run, end, name))
+    return results
+
+
+def enqueue(conn, results, now):
+    """Queues accepted results for the collector process to write. Call inside the transaction that accepts them."""
+    conn.executemany('INSERT INTO remote_results (firewall_id, received_at, result) VALUES (?, ?, ?)',
+                     [(res['firewall_id'], now, json.dumps(res, separators=(',', ':'))) for res in results])
+
+
+def has_queued(conn):
+    return conn.execute('SELECT 1 FROM remote_results LIMIT 1').fetchone() is not None
+
+
+def take_queued(conn, shards, held, limit=QUEUE_WRITE_BATCH):
+    """
+    Removes and returns up to `limit` queued results (oldest first) of the firewalls in the `held`
+    shards out of `shards` (see collector_lease.shard_of), and whether more of them are queued. Call inside the transaction that
+    writes them.
+    """
+    if not held:
+        return [], False
+    shard_filter = f"firewall_id % ? IN ({', '.join('?' * len(held))})"
+    params = (shards, *sorted(held))
+    rows = conn.execute(f'SELECT id, result FROM remote_results WHERE {shard_filter} ORDER BY id LIMIT ?', (*params, limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        conn.execute(f'DELETE FROM remote_results WHERE id <= ? AND {shard_filter}', (rows[-1][0], *params))
+    return [json.loads(row[1]) for row in rows], more
+
+
+def encode_batch(results, compress=True, position=None):
+    """Request body and headers for a batch of results; position is its (run, seq), see above."""
+    batch = {'results': results}
+    if position is not None:
+        batch['run'], batch['seq'] = position
+    body = json.dumps(batch, separators=(',', ':')).encode()
+    headers = {'Content-Type': 'application/json'}
+    if compress:
+        body = gzip.compress(body, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+    return body, headers
+
+
+def decode_batch(body, content_encoding=None):
+    """
+    Validated list of results from a request body, and the batch's (run, seq) position or None.
+    Raises ValueError on a malformed batch.
+    """
+    try:
+        if content_encoding == 'gzip':
+            body = gzip.decompress(body)
+        batch = json.loads(body)
+    except (OSError, EOFError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"unreadable batch: {e}")
+    results = batch.get('results') if isinstance(batch, dict) else None
+    if not isinstance(results, list):
+        raise ValueError("batch has no 'results' list")
+    for res in results:
+        if not (isinstance(res, dict) and isinstance(res.get('firewall_id'), int) and res.get('status') in RESULT_STATUSES
+                and isinstance(res.get('timestamp'), (int, float)) and isinstance(res.get('groups'), dict)):
+            raise ValueError(f"malformed result: {str(res)[:200]}")
+    run, seq = batch.get('run'), batch.get('seq')
+    if run is None and seq is None:
+        return results, None
+    if not (isinstance(run, str) and run and isinstance(seq, int) and seq >= 0):
+        raise ValueError("batch 'run' must be a string and 'seq' a non-negative integer")
+    return results, (run, seq)
+
+
+class IngestClient:
+    """
+    An agent's connection to the central web app: fetches its assignment and pushes buffered results.
+    Results wait in a bounded in-memory buffer (the oldest are dropped when it is full) until a push
+    succeeds, so a central outage only delays them. A batch whose response was lost is pushed again
+    and the server skips what it already wrote. start() pushes from a background thread.
+    """
+    def __init__(self, server, token, batch_size=BATCH_SIZE, push_interval=PUSH_INTERVAL_SECONDS,
+                 max_buffered=MAX_BUFFERED_RESULTS, compress=True, verify=True):
+        self.server = server.rstrip('/')
+        self.batch_size = batch_size
+        self.push_interval = push_interval
+        self.compress = compress
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {token}'
+        self.session.verify = verify
+        self._buffer = collections.deque(maxlen=max_buffered)
+        self._run = secrets.token_hex(8)  # Identifies this run's sequence numbers to the server
+        self._head = 0                  # Sequence number of the oldest buffered result
+        self._lock = threading.Lock()
+        self._full_batch = threading.Event()
+        self.pushed = self.rejected = self.dropped = self.failures = 0
+        self.assignment_stale = False   # Set when the server rejected results (firewalls reassigned)
+
+    def fetch_assignment(self):
+        response = self.session.get(f'{self.server}/api/collector/assignment', timeout=30)
+        response.raise_for_status()
+        self.assignment_stale = False
+        return response.json()
+
+    def add(self, results):
+        with self._lock:
+            overflow = len(self._buffer) + len(results) - self._buffer.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+                self._head += overflow
+            self._buffer.extend(results)
+            if len(self._buffer) >= self.batch_size:
+                self._full_batch.set()
+
+    @property
+    def buffered(self):
+        return len(self._buffer)
+
+    def push_once(self):
+        """Pushes up to one batch. Returns the number of results delivered; raises on failure (they stay buffered)."""
+        with self._lock:
+            batch = [self._buffer[i] for i in range(min(self.batch_size, len(self._buffer)))]
+            first = self._head
+        if not batch:
+            return 0
+        body, headers = encode_batch(batch, self.compress, position=(self._run, first))
+        response = self.session.post(f'{self.server}/api/ingest', data=body, headers=headers, timeout=60)
+        if response.status_code == 400:
+            # Never going to be accepted; dropped rather than left blocking the buffer
+            print(f"Batch of {len(batch)} result(s) refused by {self.server}: {response.text[:200]}")
+            rejected = len(batch)
+        else:
+            response.raise_for_status()
+            rejected = response.json().get('rejected', 0)
+        with self._lock:
+            # Results the buffer dropped meanwhile were the oldest, i.e. part of this batch
+            delivered = max(0, first + len(batch) - self._head)
+            for _ in range(delivered):
+                self._buffer.popleft()
+            self._head += delivered
+            if len(self._buffer) < self.batch_size:
+                self._full_batch.clear()
+        if rejected:
+            self.rejected += rejected
+            self.assignment_stale = True
+        self.pushed += len(batch) - rejected
+        return len(batch)
+
+    def _push_loop(self):
+        retry_delay = 1
+        while True:
+            self._full_batch.wait(self.push_interval)
+            while self._buffer:
+                try:
+                    self.push_once()
+                    retry_delay = 1
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    self.failures += 1
+                    print(f"Push to {self.server} failed ({e}); {len(self._buffer)} result(s) buffered, retrying in {retry_delay}s.")
+                    time.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, MAX_RETRY_SECONDS)
+                    break
+
+    def start(self):
+        threading.Thread(target=self._push_loop, daemon=True).start()
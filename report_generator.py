@@ -4,14 +4,54 @@ import tempfile
 import os
 from datetime import datetime
 import matplotlib # Keep this import
-import matplotlib.pyplot as plt # Keep this import
 
-# Use a backend that doesn't require a GUI
+# Use a backend that doesn't require a GUI. Set before pyplot is imported, since this module is
+# imported lazily from a report worker thread rather than at application startup.
 matplotlib.use('Agg')
+import matplotlib.pyplot as plt # Keep this import
 
-from app import get_firewall_stats_for_timespan as _fetch_and_process_data, PDF
+# Imported as a module (not 'from app import ...') so app and report_generator can import each other in any order
+import app
+from fpdf import FPDF
 from fpdf.outline import TableOfContents
 
+# --- Custom PDF class for branded header and footer ---
+class PDF(FPDF):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.PANW_RED = (255, 69, 0)
+        self.PANW_GRAY = (70, 70, 70)
+        # Correctly join path relative to the app's location
+        self.LOGO_PATH = os.path.join(os.path.dirname(__file__), 'static', 'panw-logo.png')
+        self._draw_header_footer = True
+
+    def set_draw_header_footer(self, draw):
+        self._draw_header_footer = draw
+
+    def header(self):
+        if not self._draw_header_footer: return
+        if os.path.exists(self.LOGO_PATH):
+            self.image(self.LOGO_PATH, 10, 8, 33)
+        self.set_font('Helvetica', 'B', 20)
+        self.set_text_color(*self.PANW_RED)
+        self.cell(0, 10, 'PAN-OS Performance & Capacity Report', 0, 1, 'C')
+        self.ln(5)
+        # Draw a line under the header
+        self.set_draw_color(*self.PANW_RED)
+        self.line(10, 30, self.w - 10, 30)
+        self.ln(10)
+
+    def footer(self):
+        if not self._draw_header_footer: return
+        self.set_y(-15)
+        self.set_font('Helvetica', 'I', 8)
+        # Add a watermark logo
+        if os.path.exists(self.LOGO_PATH):
+            self.image(self.LOGO_PATH, x=self.w - 40, y=self.h - 12, w=8, link='', type='PNG')
+        self.set_text_color(128)
+        self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
+
+
 # --- NEW: Remove import from pa_models.py ---
 # from pa_models import SPECS_MAP
 
@@ -134,11 +174,12 @@ def create_capacity_report_page(pdf, firewalls, conn):
 
     query = """
         SELECT
-            f.id, f.hostname, f.ip_address, f.model, f.sw_version, d.max_ssl_decrypt_sessions,
+            f.id, f.hostname, f.ip_address, f.model, f.sw_version, m.max_ssl_decrypt_sessions,
             d.max_rules, d.max_nat_rules, d.max_address_objects, d.max_service_objects, d.max_ipsec_tunnels, d.max_routes, d.max_mroutes, d.max_arp_entries, d.max_bfd_sessions, d.max_dns_cache, d.max_registered_ips,
             u.current_rules, u.current_nat_rules, u.current_address_objects, u.current_service_objects, u.current_ipsec_tunnels, u.last_updated, u.current_routes, u.current_registered_ips, u.current_ssl_decrypt_sessions,
             u.current_mroutes, u.current_arp_entries, u.current_bfd_sessions, u.current_dns_cache
         FROM firewalls f
+        LEFT JOIN firewall_models m ON f.model = m.model
         LEFT JOIN firewall_details d ON f.id = d.firewall_id
         LEFT JOIN firewall_current_usage u ON f.id = u.firewall_id
         WHERE f.id = ?
@@ -227,7 +268,8 @@ def generate_report_pdf(db_file, report_type, timespan=None, start_date=None, en
     create_title_page(pdf, report_title)
     
     # --- NEW: Add a placeholder for the Table of Contents ---
-    pdf.insert_toc_placeholder(TableOfContents().render_toc)
+    # ** FIX: One ToC page holds ~15 entries; let it grow with the fleet instead of failing the report **
+    pdf.insert_toc_placeholder(TableOfContents().render_toc, allow_extra_pages=True)
 
     # Handle the three different report types
     if report_type == 'table_only':
@@ -261,7 +303,7 @@ def generate_report_pdf(db_file, report_type, timespan=None, start_date=None, en
             pdf.cell(0, 10, f"Model: {model} | Generation: {generation}", 0, 1, 'C')
             pdf.ln(5)
             
-            chart_data = _fetch_and_process_data(conn, fw['id'], timespan=timespan, start_date=start_date, end_date=end_date)
+            chart_data = app.get_firewall_stats_for_timespan(conn, fw['id'], timespan=timespan, start_date=start_date, end_date=end_date)
             if not chart_data:
                 pdf.set_font("Helvetica", "", 12)
                 pdf.cell(0, 10, "No data for this period.", 0, 1, 'L')
@@ -297,7 +339,7 @@ def generate_report_pdf(db_file, report_type, timespan=None, start_date=None, en
             pdf.cell(0, 10, f"Model: {model} | Generation: {generation}", 0, 1, 'C')
             pdf.ln(5)
             
-            chart_data = _fetch_and_process_data(conn, fw['id'], timespan=timespan, start_date=start_date, end_date=end_date)
+            chart_data = app.get_firewall_stats_for_timespan(conn, fw['id'], timespan=timespan, start_date=start_date, end_date=end_date)
             if not chart_data:
                 pdf.set_font("Helvetica", "", 12)
                 pdf.cell(0, 10, "No data for this period.", 0, 1, 'L')
@@ -0,0 +1,267 @@
+import collections
+import cProfile
+import io
+import itertools
+import pstats
+import sqlite3
+import threading
+import time
+
+# Opt-in profiling of the web app's requests: total time split into SQL, template rendering and the
+# Python in between, every SQL statement a request ran with its duration and rows, a slow-query log,
+# and one-shot cProfile captures. Nothing is measured while profiling is disabled, and database
+# connections opened outside a profiled request (the poller, report workers) are never traced.
+
+SLOW_QUERY_MS = 100          # Statements slower than this go to the slow-query log
+RECENT_REQUESTS = 200        # Profiled requests kept (with their statements)
+SLOW_QUERY_LOG_SIZE = 200
+CAPTURES_KEPT = 10
+CAPTURE_TOP_FUNCTIONS = 40   # Lines of cProfile output kept per capture
+
+_active = threading.local()  # .profile: the RequestProfile of the request this thread is serving
+
+
+class RequestProfile:
+    """Timings of one request. Statements are recorded by the connections it opens."""
+    def __init__(self, request_id, method, path, endpoint):
+        self.id = request_id
+        self.method = method
+        self.path = path
+        self.endpoint = endpoint
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.statements = []         # [sql, seconds, rows] in execution order
+        self.render_seconds = 0.0
+        self._render_start = None
+        self.profiler = None         # cProfile.Profile while a capture is running
+        self.seconds = self.status = None
+
+    @property
+    def started_str(self):
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))
+
+    @property
+    def sql_seconds(self):
+        return sum(statement[1] for statement in self.statements)
+
+    def statement_summary(self):
+        """Statements grouped by SQL text: [(sql, executions, seconds, rows)], slowest first."""
+        grouped = {}
+        for sql, seconds, rows in self.statements:
+            entry = grouped.setdefault(sql, [sql, 0, 0.0, 0])
+            entry[1] += 1
+            entry[2] += seconds
+            entry[3] += rows
+        return sorted((tuple(entry) for entry in grouped.values()), key=lambda entry: entry[2], reverse=True)
+
+
+def _normalize(sql):
+    return ' '.join(sql.split())
+
+# Statements SQLite runs for the sqlite3 module's implicit transaction handling
+_TRANSACTION_CONTROL = ('BEGIN', 'COMMIT', 'ROLLBACK')
+
+def _timed_call(statement, sql, call, *args):
+    """
+    Runs call(*args) and adds its duration to a statement record: a new one for `sql` when it
+    executes a statement, else `statement` (a fetch). The trace callback records what SQLite starts
+    meanwhile; it sees statements with their parameters bound (one per executemany row), so those
+    are folded into the record of `sql`, and only implicit transaction control is kept separately.
+    Returns (result, statement record or None).
+    """
+    profile = getattr(_active, 'profile', None)
+    if profile is None:
+        return call(*args), statement
+    traced = len(profile.statements)
+    start = time.perf_counter()
+    try:
+        result = call(*args)
+    finally:
+        seconds = time.perf_counter() - start
+        started = profile.statements[traced:]
+        if sql is not None:
+            del profile.statements[traced:]
+            profile.statements.extend(entry for entry in started if entry[0] in _TRANSACTION_CONTROL)
+            statement = [_normalize(sql), 0.0, 0]
+            profile.statements.append(statement)
+        elif statement is None and started:
+            statement = started[-1]
+        if statement is not None:
+            statement[1] += seconds
+    return result, statement
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Adds the time spent executing and fetching to the statement the cursor ran."""
+    _statement = None
+
+    def _timed(self, method, *args, sql=None):
+        result, self._statement = _timed_call(self._statement, sql, method, self, *args)
+        return result
+
+    def execute(self, sql, parameters=()):
+        return self._timed(sqlite3.Cursor.execute, sql, parameters, sql=sql)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(sqlite3.Cursor.executemany, sql, seq_of_parameters, sql=sql)
+
+    def executescript(self, sql_script):
+        return self._timed(sqlite3.Cursor.executescript, sql_script, sql=sql_script)
+
+    def _fetched(self, rows):
+        if self._statement is not None:
+            self._statement[2] += rows
+
+    def fetchone(self):
+        row = self._timed(sqlite3.Cursor.fetchone)
+        self._fetched(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(sqlite3.Cursor.fetchmany, self.arraysize if size is None else size)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(sqlite3.Cursor.fetchall)
+        self._fetched(len(rows))
+        return rows
+
+    def __next__(self):
+        row = self._timed(sqlite3.Cursor.__next__)
+        self._fetched(1)
+        return row
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """
+    Connection opened during a profiled request. sqlite3's trace callback records every statement
+    SQLite starts (including implicit BEGIN/COMMIT); ProfiledCursor adds the time spent in it.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(self._trace)
+
+    @staticmethod
+    def _trace(sql):
+        profile = getattr(_active, 'profile', None)
+        if profile is not None:
+            profile.statements.append([_normalize(sql), 0.0, 0])
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        _timed_call(None, None, sqlite3.Connection.commit, self)
+
+
+class RequestProfiler:
+    """Collects RequestProfiles into per-endpoint totals, a recent-requests ring, a slow-query log and cProfile captures."""
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.enabled = False
+        self.slow_query_ms = slow_query_ms
+        self.recent = collections.deque(maxlen=RECENT_REQUESTS)
+        self.slow_queries = collections.deque(maxlen=SLOW_QUERY_LOG_SIZE)   # (time string, duration, sql, rows, method, path)
+        self.captures = collections.deque(maxlen=CAPTURES_KEPT)              # (request profile, pstats text)
+        self.endpoints = {}          # endpoint -> {'count', 'seconds', 'max_seconds', 'sql_seconds', 'statements', 'render_seconds'}
+        self._capture_path = None    # Path prefix of the next request to run under cProfile ('' = any)
+
+    def connection_factory(self):
+        """sqlite3.connect() factory for the calling thread: traced only while it serves a profiled request."""
+        return ProfiledConnection if getattr(_active, 'profile', None) is not None else sqlite3.Connection
+
+    def arm_capture(self, path_prefix=''):
+        """Runs the next request whose path starts with path_prefix under cProfile."""
+        with self._lock:
+            self._capture_path = path_prefix
+
+    @property
+    def capture_pending(self):
+        return self._capture_path
+
+    def results(self):
+        """Copies of the results: per-endpoint totals (most time first), recent requests (slowest first), slow queries and captures (newest first)."""
+        with self._lock:
+            return {
+                'endpoints': sorted(((endpoint, dict(totals)) for endpoint, totals in self.endpoints.items()), key=lambda item: item[1]['seconds'], reverse=True),
+                'recent': sorted(self.recent, key=lambda profile: profile.seconds, reverse=True),
+                'slow_queries': list(reversed(self.slow_queries)),
+                'captures': list(reversed(self.captures)),
+            }
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self.slow_queries.clear()
+            self.captures.clear()
+            self.endpoints.clear()
+
+    # --- Request hooks ---
+
+    def begin(self, method, path, endpoint):
+        if not self.enabled:
+            return None
+        profile = _active.profile = RequestProfile(next(self._ids), method, path, endpoint)
+        with self._lock:
+            capture = self._capture_path is not None and path.startswith(self._capture_path)
+            if capture:
+                self._capture_path = None
+        if capture:
+            profile.profiler = cProfile.Profile()
+            profile.profiler.enable()
+        return profile
+
+    def template_started(self):
+        profile = getattr(_active, 'profile', None)
+        if profile is not None:
+            profile._render_start = time.perf_counter()
+
+    def template_finished(self):
+        profile = getattr(_active, 'profile', None)
+        if profile is not None and profile._render_start is not None:
+            profile.render_seconds += time.perf_counter() - profile._render_start
+            profile._render_start = None
+
+    def end(self, status):
+        profile = getattr(_active, 'profile', None)
+        if profile is None:
+            return None
+        _active.profile = None
+        profile.seconds = time.perf_counter() - profile.start
+        profile.status = status
+        capture = None
+        if profile.profiler is not None:
+            profile.profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profile.profiler, stream=out).sort_stats('cumulative').print_stats(CAPTURE_TOP_FUNCTIONS)
+            capture = out.getvalue()
+            profile.profiler = None
+
+        slow = [(sql, seconds, rows) for sql, seconds, rows in profile.statements if seconds * 1000 >= self.slow_query_ms]
+        for sql, seconds, rows in slow:
+            print(f"Slow query ({seconds * 1000:.0f} ms, {rows} rows) in {profile.method} {profile.path}: {sql[:300]}")
+        with self._lock:
+            self.recent.append(profile)
+            for sql, seconds, rows in slow:
+                self.slow_queries.append((profile.started_str, seconds, sql, rows, profile.method, profile.path))
+            if capture is not None:
+                self.captures.append((profile, capture))
+            totals = self.endpoints.setdefault(profile.endpoint or profile.path, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'sql_seconds': 0.0, 'statements': 0, 'render_seconds': 0.0})
+            totals['count'] += 1
+            totals['seconds'] += profile.seconds
+            totals['max_seconds'] = max(totals['max_seconds'], profile.seconds)
+            totals['sql_seconds'] += profile.sql_seconds
+            totals['statements'] += len(profile.statements)
+            totals['render_seconds'] += profile.render_seconds
+        return profile